@@ -0,0 +1,117 @@
+import argparse
+import glob
+import itertools
+import multiprocessing
+import time as systime
+
+from coincidence_analyse import read_channel_times, read_record_state, read_g2_cache, g2_cache_status, g2_cached, g2_group_name
+
+"""
+Calculates g2 for many files and many sets of parameters at once.
+
+Each file is read once by one worker process, which then works through every combination of channel pair,
+bin width and tau range, writing the results to the file's processed/ group (see g2_group_name). Results
+already there are reused or brought up to date with any records added since (see g2_cached). Files are
+spread over a pool of processes, so a batch of files takes about as long as the slowest file once there
+are as many workers as cores.
+
+To run:
+python batch_analyse.py "data/*.hdf" --pairs 0,1 0,0 --bin-widths 50E-9 1E-6 --tau-ranges 700E-6:800E-6 0:100E-6
+"""
+
+
+def parameter_grid(pairs, bin_widths, tau_ranges):
+    # Every combination of the parameters, as a list of dicts of g2_from_times arguments
+    grid = []
+    for channels, bin_width, (tau_min, tau_max) in itertools.product(pairs, bin_widths, tau_ranges):
+        grid.append({'channels':tuple(channels), 'bin_width':bin_width, 'tau_min':tau_min, 'tau_max':tau_max})
+    return grid
+
+
+def analyse_file(hdf_name, grid):
+    # Runs in a worker process. Returns (hdf_name, {'cached':n, 'incremental':n, 'full':n}, error message or None, time taken).
+    # Results that are already saved and up to date are reused, and results for fewer records than the file now has are
+    # updated with just the new records (see g2_cached). The whole file is only read if something needs it, and only once.
+    # Parameter sets with a channel that has no records are skipped.
+    t0 = systime.time()
+    num_results = {'cached':0, 'incremental':0, 'full':0}
+    try:
+        total_entries, clock_correction = read_record_state(hdf_name)
+        needs_full_read = False
+        for params in grid:
+            cache = read_g2_cache(hdf_name, g2_group_name(params['channels'], params['bin_width'], params['tau_min'], params['tau_max']))
+            if g2_cache_status(cache, dict(params, clock_correction=clock_correction), total_entries) == 'full':
+                needs_full_read = True
+        channel_times = read_channel_times(hdf_name)[0] if needs_full_read else None
+        for params in grid:
+            if channel_times is not None and (not len(channel_times[params['channels'][0]]) or not len(channel_times[params['channels'][1]])):
+                continue
+            g2, tau, how = g2_cached(hdf_name, params['channels'], params['bin_width'], params['tau_min'], params['tau_max'], channel_times=channel_times)
+            num_results[how] += 1
+    except (OSError, KeyError, ValueError) as ex:
+        # One bad file shouldn't stop the rest of the batch
+        return hdf_name, num_results, str(ex), systime.time() - t0
+    return hdf_name, num_results, None, systime.time() - t0
+
+
+def analyse_file_job(job):
+    return analyse_file(*job)
+
+
+def analyse_files(hdf_names, grid, processes=None):
+    # Analyses every file with every set of parameters in grid, printing progress as each file finishes.
+    # Returns a list of the files that failed, with the reason.
+    failed = []
+    t0 = systime.time()
+    results_total = len(hdf_names)*len(grid)
+    results_done = 0
+    with multiprocessing.Pool(processes) as pool:
+        jobs = [(hdf_name, grid) for hdf_name in hdf_names]
+        for file_idx, (hdf_name, num_results, error, time_taken) in enumerate(pool.imap_unordered(analyse_file_job, jobs)):
+            results_done += len(grid)
+            if error:
+                failed.append((hdf_name, error))
+                status = 'failed: ' + error
+            else:
+                status = '{full} calculated, {incremental} updated, {cached} up to date'.format(**num_results) + ' in {:.1f} s'.format(time_taken)
+            print('[{}/{} files, {}/{} results, {:.0f} s] {}: {}'.format(file_idx + 1, len(hdf_names), results_done, results_total, systime.time() - t0, hdf_name, status), flush=True)
+    return failed
+
+
+def expand_file_patterns(patterns):
+    # Glob patterns are expanded here as well, since the Windows command prompt doesn't do it
+    hdf_names = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        hdf_names.extend(hdf_name for hdf_name in matches if hdf_name not in hdf_names)
+    return hdf_names
+
+
+def parse_pair(text):
+    return tuple(int(channel) for channel in text.split(','))
+
+
+def parse_tau_range(text):
+    tau_min, tau_max = text.split(':')
+    return float(tau_min), float(tau_max)
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calculate g2 for many files and sets of parameters.')
+    parser.add_argument('files', nargs='+', help='hdf files or glob patterns like "data/*.hdf"')
+    parser.add_argument('--pairs', nargs='+', type=parse_pair, default=[(0, 1)], help='Channel pairs like 0,1')
+    parser.add_argument('--bin-widths', nargs='+', type=float, default=[50E-9], help='Bin widths in seconds')
+    parser.add_argument('--tau-ranges', nargs='+', type=parse_tau_range, default=[(700E-6, 800E-6)], help='tau ranges in seconds like 700E-6:800E-6')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    hdf_names = expand_file_patterns(args.files)
+    grid = parameter_grid(args.pairs, args.bin_widths, args.tau_ranges)
+    print('{} files x {} parameter sets'.format(len(hdf_names), len(grid)))
+    failed = analyse_files(hdf_names, grid, args.processes)
+    if failed:
+        print('{} files failed:'.format(len(failed)))
+        for hdf_name, error in failed:
+            print('  {}: {}'.format(hdf_name, error))
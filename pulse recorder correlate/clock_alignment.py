@@ -0,0 +1,225 @@
+import numpy as np
+import h5py
+import argparse
+import time as systime
+from numba import jit
+
+"""
+Estimates the clock offset and drift between two recordings of the same light source, for example from two
+Pulse Recorders, or one recorded to two files. Times are in 5ns clock cycles (ticks) throughout.
+
+The offset is first found roughly from the FFT cross-correlation of the two streams binned at a coarse
+resolution, then refined by histogramming the time differences of nearby pulses with smaller and smaller
+bins, down to single ticks. Drift is found by doing the same on segments of the recording and fitting a
+line to the offsets.
+
+The result is saved as a ClockCorrection in the 'processed/clock_correction' group of the second recording.
+Nothing else in the file is changed: readers apply it when they read the times (see corrected_times).
+
+To run:
+python clock_alignment.py run_a.hdf run_b.hdf --channel-a 0 --channel-b 0 --max-offset 1.0
+"""
+
+clock_period = 5E-9
+correction_group_name = 'processed/clock_correction'
+
+
+class ClockCorrection:
+    ''' Maps the times of one recording onto the clock of another:
+    t_corrected = t + offset + drift*(t - reference_tick), all in ticks. '''
+    def __init__(self, offset=0, drift=0.0, reference_tick=0, reference=''):
+        # Fitted offsets are fractional, so round to the nearest tick rather than towards zero
+        self.offset = int(round(offset))
+        self.drift = float(drift)
+        self.reference_tick = int(reference_tick)
+        # What the times are corrected to, for example the file name of the other recording
+        self.reference = reference
+
+    def apply(self, times):
+        times = np.asarray(times, dtype=np.int64)
+        if self.drift:
+            return times + self.offset + np.round(self.drift*(times - self.reference_tick)).astype(np.int64)
+        return times + self.offset
+
+    def save(self, hdf_group):
+        group = hdf_group.require_group(correction_group_name)
+        group.attrs['offset'] = self.offset
+        group.attrs['drift'] = self.drift
+        group.attrs['reference_tick'] = self.reference_tick
+        group.attrs['reference'] = self.reference
+
+    @classmethod
+    def load(cls, hdf_group):
+        ''' Returns the correction saved in hdf_group (a file, or a device group), or None if there isn't one. '''
+        if correction_group_name not in hdf_group:
+            return None
+        attrs = hdf_group[correction_group_name].attrs
+        return cls(attrs['offset'], attrs['drift'], attrs['reference_tick'], attrs.get('reference', ''))
+
+    def __repr__(self):
+        return 'ClockCorrection(offset={}, drift={:.3e}, reference_tick={})'.format(self.offset, self.drift, self.reference_tick)
+
+
+def corrected_times(hdf_group, times):
+    ''' Applies the clock correction saved in hdf_group (if any) to times read from it. '''
+    correction = ClockCorrection.load(hdf_group)
+    if correction is None:
+        return times
+    return correction.apply(times)
+
+def read_channel_times(hdf_name, channel, group_name=None, apply_correction=True):
+    ''' Returns the times (in ticks) of the records with the channel's tag set. group_name is the device
+    group for files recorded from several devices. '''
+    with h5py.File(hdf_name, 'r') as hdf_file:
+        root = hdf_file if group_name is None else hdf_file[group_name]
+        total_entries = root['total_entries'][0]
+        records = root['records'][:total_entries]
+        times = records['time'][records['ch{}'.format(channel)] == 1]
+        if apply_correction:
+            times = corrected_times(root, times)
+    return times
+
+###############################################################################
+
+@jit(nopython=True, cache=True)
+def difference_histogram(times_a, times_b, lag_min, bin_width, num_bins):
+    # Histogram of times_b - times_a over all pairs with a difference in [lag_min, lag_min + bin_width*num_bins).
+    # Both must be sorted. The work is proportional to the number of pairs in the window.
+    counts = np.zeros(num_bins, dtype=np.int64)
+    lag_max = lag_min + bin_width*num_bins
+    b_start = 0
+    length_b = times_b.shape[0]
+    for i in range(times_a.shape[0]):
+        window_start = times_a[i] + lag_min
+        window_end = times_a[i] + lag_max
+        while b_start < length_b and times_b[b_start] < window_start:
+            b_start += 1
+        j = b_start
+        while j < length_b and times_b[j] < window_end:
+            counts[(times_b[j] - window_start)//bin_width] += 1
+            j += 1
+    return counts
+
+def coarse_lag(times_a, times_b, lag_min, lag_max, coarse_bins):
+    ''' Finds the lag (times_b - times_a, in ticks) with the most coincidences at a coarse resolution, by
+    FFT cross-correlation of the binned streams. Returns (lag, bin_width); the lag is good to about a bin.'''
+    t0 = min(times_a[0], times_b[0])
+    span = max(times_a[-1], times_b[-1]) - t0 + 1
+    bin_width = max(int(np.ceil(span/coarse_bins)), 1)
+    num_bins = int(np.ceil(span/bin_width))
+    binned_a = np.bincount((times_a - t0)//bin_width, minlength=num_bins).astype(np.float64)
+    binned_b = np.bincount((times_b - t0)//bin_width, minlength=num_bins).astype(np.float64)
+    # Removing the means stops the shrinking overlap at large lags from biasing the result
+    binned_a -= binned_a.mean()
+    binned_b -= binned_b.mean()
+    # Zero padded to at least twice the length, so the correlation isn't circular. A power of 2 keeps the FFT fast.
+    fft_length = 1 << int(np.ceil(np.log2(2*num_bins)))
+    correlation = np.fft.irfft(np.conj(np.fft.rfft(binned_a, fft_length))*np.fft.rfft(binned_b, fft_length), fft_length)
+    lags = np.arange(int(np.floor(lag_min/bin_width)), int(np.ceil(lag_max/bin_width)) + 1)
+    lags = lags[np.abs(lags) < num_bins]
+    best = lags[np.argmax(correlation[lags % fft_length])]
+    return int(best*bin_width), bin_width
+
+def fine_lag(times_a, times_b, lag, window, fine_bins=256, max_events=2000000):
+    ''' Refines a lag known to within +-window down to a single tick. Only max_events pulses of times_a are
+    used for the first (widest) step, which is the only slow one. Returns (lag, significance), where
+    significance is the height of the peak above the background in standard deviations, at the step it
+    was clearest (a peak smeared by drift stands out better in wider bins).'''
+    step = max(times_a.size//max_events, 1)
+    sampled_a = times_a[::step]
+    significance = 0.0
+    while True:
+        bin_width = max(int(np.ceil(2*window/fine_bins)), 1)
+        lag_min = lag - window
+        counts = difference_histogram(sampled_a if bin_width > 1 else times_a, times_b, lag_min, bin_width, fine_bins)
+        peak = int(np.argmax(counts))
+        lag = lag_min + peak*bin_width + bin_width//2
+        background = np.median(counts)
+        significance = max(significance, (counts[peak] - background)/np.sqrt(background + 1))
+        if bin_width == 1:
+            return lag, significance
+        window = 2*bin_width
+
+def estimate_lag(times_a, times_b, lag_min, lag_max, coarse_bins=2**22, fine_bins=256, max_events=2000000):
+    ''' The lag of times_b relative to times_a (times_b = times_a + lag), searched for in [lag_min, lag_max].
+    Returns (lag, significance).'''
+    span = max(times_a[-1], times_b[-1]) - min(times_a[0], times_b[0]) + 1
+    if lag_max - lag_min <= 4*span/coarse_bins:
+        # The range is already narrower than a couple of coarse bins
+        return fine_lag(times_a, times_b, (lag_min + lag_max)//2, (lag_max - lag_min)//2 + 1, fine_bins, max_events)
+    lag, coarse_bin_width = coarse_lag(times_a, times_b, lag_min, lag_max, coarse_bins)
+    return fine_lag(times_a, times_b, lag, 2*coarse_bin_width, fine_bins, max_events)
+
+def estimate_clock_correction(times_a, times_b, max_offset, segments=8, max_drift=1E-4, min_significance=5.0, coarse_bins=2**22, max_iterations=5, max_events=2000000):
+    ''' Estimates the ClockCorrection that puts times_b on the clock of times_a. Both are sorted times in ticks
+    of the same source (or correlated sources) and max_offset is the largest offset to look for, in ticks.
+
+    The offset is found over the whole recording first. Then each of the segments of times_b is aligned on its
+    own, looking within max_drift*(length of the recording) of that offset, and a line is fitted to the lags
+    of the segments with a clear peak. Drift smears the peak of each segment, so this is repeated on the
+    corrected times until the correction stops changing. With fewer than two clear segments the drift is
+    taken to be 0. Returns (correction, lags) where lags is a list of (segment middle, remaining lag,
+    significance) from the last iteration.'''
+    lag, significance = estimate_lag(times_a, times_b, -max_offset, max_offset, coarse_bins, max_events=max_events)
+    reference_tick = int(times_b[0])
+    correction = ClockCorrection(-lag, 0.0, reference_tick)
+    lags = []
+    if segments < 2:
+        return correction, lags
+    drift_window = int(max_drift*(times_b[-1] - times_b[0])) + 1
+    for iteration in range(max_iterations):
+        # The correction keeps times_b in order, so the corrected times are still sorted
+        corrected_b = correction.apply(times_b)
+        edges = np.linspace(corrected_b[0], corrected_b[-1] + 1, segments + 1).astype(np.int64)
+        lags = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            segment_b = corrected_b[np.searchsorted(corrected_b, start):np.searchsorted(corrected_b, end)]
+            segment_a = times_a[np.searchsorted(times_a, start - drift_window):np.searchsorted(times_a, end + drift_window)]
+            if segment_a.size < 2 or segment_b.size < 2:
+                continue
+            segment_lag, segment_significance = estimate_lag(segment_a, segment_b, -drift_window, drift_window, coarse_bins//segments, max_events=max_events//segments)
+            lags.append(((start + end)//2, segment_lag, segment_significance))
+        good_lags = [(middle, segment_lag) for middle, segment_lag, segment_significance in lags if segment_significance >= min_significance]
+        if len(good_lags) < 2:
+            break
+        middles, segment_lags = np.array(good_lags, dtype=np.float64).T
+        residual_drift, residual_offset = np.polyfit(middles - reference_tick, segment_lags, 1)
+        # Compose the correction with the one removing the remaining lag residual_offset + residual_drift*(t - reference_tick)
+        correction = ClockCorrection(correction.offset - residual_offset - residual_drift*correction.offset, correction.drift - residual_drift*(1 + correction.drift), reference_tick)
+        if abs(residual_offset) < 1 and abs(residual_drift)*(times_b[-1] - times_b[0]) < 1:
+            break
+        drift_window = int(np.max(np.abs(segment_lags))) + 64
+    return correction, lags
+
+def align_recordings(hdf_name_a, hdf_name_b, channel_a=0, channel_b=0, group_a=None, group_b=None, max_offset_seconds=1.0, segments=8, save=True):
+    ''' Estimates the clock correction of recording b relative to recording a from one channel of each, and
+    saves it in recording b (see ClockCorrection.save). Any correction already saved in b is ignored.'''
+    t0 = systime.time()
+    times_a = read_channel_times(hdf_name_a, channel_a, group_a)
+    times_b = read_channel_times(hdf_name_b, channel_b, group_b, apply_correction=False)
+    correction, lags = estimate_clock_correction(times_a, times_b, int(max_offset_seconds/clock_period), segments)
+    correction.reference = '{}:{}'.format(hdf_name_a, group_a) if group_a else str(hdf_name_a)
+    for middle, segment_lag, significance in lags:
+        print('  t = {:10.3f} s  lag = {:14,} ticks  ({:.1f} sigma)'.format(middle*clock_period, segment_lag, significance))
+    print('{} found in {:.1f} s'.format(correction, systime.time() - t0))
+    if save:
+        with h5py.File(hdf_name_b, 'a') as hdf_file:
+            correction.save(hdf_file if group_b is None else hdf_file[group_b])
+    return correction
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Estimate the clock offset and drift of recording b relative to recording a.')
+    parser.add_argument('hdf_name_a')
+    parser.add_argument('hdf_name_b')
+    parser.add_argument('--channel-a', type=int, default=0)
+    parser.add_argument('--channel-b', type=int, default=0)
+    parser.add_argument('--group-a', default=None, help='Device group in a, for files recorded from several devices')
+    parser.add_argument('--group-b', default=None)
+    parser.add_argument('--max-offset', type=float, default=1.0, help='Largest offset to look for, in seconds')
+    parser.add_argument('--segments', type=int, default=8, help='Number of segments used to estimate the drift (1 for no drift)')
+    parser.add_argument('--dry-run', action='store_true', help="Don't save the correction")
+    args = parser.parse_args()
+    align_recordings(args.hdf_name_a, args.hdf_name_b, args.channel_a, args.channel_b, args.group_a, args.group_b, args.max_offset, args.segments, not args.dry_run)
@@ -1,8 +1,16 @@
 from pylab import *
 import h5py
 import time as systime
+import sys
+import pathlib
 from numba import jit
 
+from clock_alignment import corrected_times, ClockCorrection
+
+# The GUI's modules are in the folder above, for reading the parts of the file only they know the layout of
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+import pulse_recorder_storage as prStorage
+
 ###############################################################################
 #input/output
 #These are just some helper functions to make make it easy to read/write hdf files. You don't have to use them
@@ -27,7 +35,8 @@ def hdf_write(data_file_name, field_names, fields):
         except TypeError:
             try:
                 data_file.create_dataset(field_name, data = field)
-            except RuntimeError:
+            except (RuntimeError, ValueError):
+                # h5py 3 raises ValueError if the name already exists
                 del data_file[field_name]
                 data_file.create_dataset(field_name, data = field)
     data_file.close()
@@ -102,61 +111,201 @@ def calc_overlap_function_jit(binned_x1, binned_x2, tau, bin_width, bins_tot):
     return overlap_function
 
 
-def g2_calc(hdf_name):
-    #Set parametes for the correlation
-    bin_width = 50E-9
-    tau_min = 700E-6
-    tau_max = 800E-6
-    # change the group name to whatever you want. Be sure to update the name in the plotting function
-    processed_data_group_name = 'processed/50ns_bin/'
-
-    hdf_file = h5py.File(hdf_name, 'a')
+def read_channel_times(hdf_name, start=0, stop=None):
+    # Reads records start to stop (all of them by default) once and returns the times (in seconds) of each of the 4 channels
+    hdf_file = h5py.File(hdf_name, 'r')
     total_entries = hdf_file['total_entries'][:][0]
     dset_records = hdf_file['records']
-    times_all = dset_records['time'][:total_entries]*5E-9
-    ch0 = dset_records['ch0'][:total_entries]
-    ch1 = dset_records['ch1'][:total_entries]
-    ch2 = dset_records['ch2'][:total_entries]
-    ch3 = dset_records['ch3'][:total_entries]
+    stop = total_entries if stop is None else min(stop, total_entries)
+    records = dset_records[start:stop]
+    # Any clock correction saved by clock_alignment.py is applied here, as the times are read
+    times_all = corrected_times(hdf_file, records['time'])*5E-9
+    hdf_file.close()
+    channel_times = [times_all[records['ch{}'.format(channel)]==1] for channel in range(4)]
+    return channel_times, total_entries
+
+
+def read_record_state(hdf_name):
+    # The number of records, and the clock correction (as text) that will be applied to them
+    hdf_file = h5py.File(hdf_name, 'r')
+    total_entries = hdf_file['total_entries'][:][0]
+    correction = ClockCorrection.load(hdf_file)
+    hdf_file.close()
+    return total_entries, repr(correction) if correction else ''
 
-    times_ch0 = times_all[ch0==1]
-    times_ch1 = times_all[ch1==1]
-    times_ch2 = times_all[ch2==1]
-    times_ch3 = times_all[ch3==1]
 
-    # Choose which channels you want to perform the g2 mesurement over
-    # It is fine to make them both the same channel
-    times_x1 = times_ch0
-    times_x2 = times_ch1
+def g2_group_name(channels, bin_width, tau_min, tau_max):
+    # Where the results for a set of parameters go, like 'processed/g2_ch0_ch1_50ns_bin_700us_800us/'
+    return 'processed/g2_ch{}_ch{}_{:g}ns_bin_{:g}us_{:g}us/'.format(channels[0], channels[1], bin_width*1E9, tau_min*1E6, tau_max*1E6)
+
+
+def tau_values(bin_width, tau_min, tau_max):
+    tau_range = tau_max - tau_min
+    tau_element_n = round(tau_range/bin_width)
+    return arange(tau_element_n)*bin_width + tau_min
 
-    t_min = min([times_x1.min(), times_x2.min()])
-    t_max = max([times_x1.max(), times_x2.max()])
-    t_range = t_max - t_min
 
+def coincidence_counts(times_x1, times_x2, t_min, bin_width, tau):
+    # The number of pairs of events at each tau, with times binned from t_min.
+    # With bins_tot = 1 the overlap function is just the number of pairs.
     binned_x1 = floor((times_x1 - t_min)/bin_width)
     binned_x2 = floor((times_x2 - t_min)/bin_width)
+    return rint(calc_overlap_function_jit(binned_x1, binned_x2, tau, bin_width, 1))
 
-    bins_tot = ceil(t_range/bin_width)
 
-    ave_I_x1 = len(binned_x1)/bins_tot
-    ave_I_x2 = len(binned_x2)/bins_tot
+def g2_from_counts(counts, n1, n2, t_min, t_max, bin_width):
+    # g2 = overlap/(ave_I_x1*ave_I_x2), where overlap = counts/bins_tot and ave_I = n/bins_tot
+    bins_tot = ceil((t_max - t_min)/bin_width)
+    return counts*bins_tot/(n1*n2)
 
-    tau_range = tau_max - tau_min
-    tau_element_n = round(tau_range/bin_width)
-    tau = arange(tau_element_n)*bin_width + tau_min
 
+def g2_state_from_times(times_x1, times_x2, bin_width, tau_min, tau_max):
+    # Everything needed to update g2 later without starting again: the raw counts, number of events and time range
+    t_min = min([times_x1.min(), times_x2.min()])
+    t_max = max([times_x1.max(), times_x2.max()])
+    tau = tau_values(bin_width, tau_min, tau_max)
+    counts = coincidence_counts(times_x1, times_x2, t_min, bin_width, tau)
+    return {'counts':counts, 'tau':tau, 'n1':len(times_x1), 'n2':len(times_x2), 't_min':t_min, 't_max':t_max}
+
+
+def g2_from_times(times_x1, times_x2, bin_width, tau_min, tau_max):
+    state = g2_state_from_times(times_x1, times_x2, bin_width, tau_min, tau_max)
+    g2 = g2_from_counts(state['counts'], state['n1'], state['n2'], state['t_min'], state['t_max'], bin_width)
+    return g2, state['tau']
+
+
+def write_g2_result(hdf_name, processed_data_group_name, g2, tau, params, counts=None):
+    # Saves g2 and tau (and the raw counts, if given), with the parameters that produced them as attributes of the group.
+    # Anything already in the group is deleted first, since a result for other parameters can have other shapes.
+    hdf_file = h5py.File(hdf_name, 'a')
+    if processed_data_group_name in hdf_file:
+        del hdf_file[processed_data_group_name]
+    hdf_file.close()
+    field_names = [processed_data_group_name + 'g2', processed_data_group_name + 'tau']
+    fields = [g2, tau]
+    if counts is not None:
+        field_names.append(processed_data_group_name + 'counts')
+        fields.append(counts)
+    hdf_write(hdf_name, field_names, fields)
+    hdf_file = h5py.File(hdf_name, 'a')
+    group = hdf_file[processed_data_group_name]
+    for name, value in params.items():
+        group.attrs[name] = value
+    hdf_file.close()
+
+
+def read_g2_cache(hdf_name, processed_data_group_name):
+    # Returns the attributes, counts, g2 and tau saved by g2_cached as a dict, or None if there aren't any
+    hdf_file = h5py.File(hdf_name, 'r')
+    cache = None
+    if processed_data_group_name in hdf_file:
+        group = hdf_file[processed_data_group_name]
+        if 'counts' in group and 'n1' in group.attrs:
+            cache = dict(group.attrs)
+            for field_name in ['counts', 'g2', 'tau']:
+                cache[field_name] = group[field_name][...]
+    hdf_file.close()
+    return cache
+
+
+def g2_cache_status(cache, params, total_entries):
+    # 'cached' if the saved result is up to date, 'incremental' if it can be updated with the records added
+    # since, or 'full' if it has to be calculated from the start (it was made with other parameters, or the file shrank)
+    if cache is None:
+        return 'full'
+    for name, value in params.items():
+        if name not in cache or not array_equal(cache[name], value):
+            return 'full'
+    if cache['total_entries'] == total_entries:
+        return 'cached'
+    if cache['total_entries'] < total_entries:
+        return 'incremental'
+    return 'full'
+
+
+def read_tail_times(hdf_name, stop, t_from):
+    # The channel times of the records before row stop, going back far enough to include every record from time t_from
+    hdf_file = h5py.File(hdf_name, 'r')
+    dset_records = hdf_file['records']
+    start = stop
+    step = 1000
+    while start > 0:
+        start = max(start - step, 0)
+        if corrected_times(hdf_file, dset_records[start:start + 1]['time'])[0]*5E-9 < t_from:
+            break
+        step *= 2
+    hdf_file.close()
+    channel_times, total_entries = read_channel_times(hdf_name, start, stop)
+    return [times[times >= t_from] for times in channel_times]
+
+
+def g2_incremental_state(hdf_name, cache, channels, bin_width, tau_min, tau_max, total_entries):
+    # Updates the saved counts with the records added since they were saved. Only pairs with at least one new
+    # event are missing, and their other event is at most the largest |tau| before the first new one, so
+    # C_new = C(tail_old + new) - C(tail_old), where tail_old is the old events within that window.
+    # Returns None if the new records don't all come after the old ones (the timer was zeroed, say).
+    new_times, _ = read_channel_times(hdf_name, cache['total_entries'], total_entries)
+    new_x1 = new_times[channels[0]]
+    new_x2 = new_times[channels[1]]
+    state = {name:cache[name] for name in ['counts', 'tau', 'n1', 'n2', 't_min', 't_max']}
+    if not len(new_x1) and not len(new_x2):
+        return state
+    new_t_min = min([times.min() for times in [new_x1, new_x2] if len(times)])
+    if new_t_min < cache['t_max']:
+        return None
+    window = max(abs(tau_min), abs(tau_max)) + 2*bin_width
+    tail_times = read_tail_times(hdf_name, cache['total_entries'], new_t_min - window)
+    tail_x1 = tail_times[channels[0]]
+    tail_x2 = tail_times[channels[1]]
+    tau = cache['tau']
+    counts_tail_and_new = coincidence_counts(concatenate([tail_x1, new_x1]), concatenate([tail_x2, new_x2]), cache['t_min'], bin_width, tau)
+    counts_tail = coincidence_counts(tail_x1, tail_x2, cache['t_min'], bin_width, tau)
+    state['counts'] = cache['counts'] + counts_tail_and_new - counts_tail
+    state['n1'] = cache['n1'] + len(new_x1)
+    state['n2'] = cache['n2'] + len(new_x2)
+    state['t_max'] = max([times.max() for times in [new_x1, new_x2] if len(times)])
+    return state
+
+
+def g2_cached(hdf_name, channels=(0, 1), bin_width=50E-9, tau_min=700E-6, tau_max=800E-6, processed_data_group_name=None, channel_times=None):
+    # Returns (g2, tau, how), where how says if the result was 'cached', updated ('incremental') or calculated in 'full'.
+    # The result is saved with its parameters, raw counts and the number of records it covers, so asking again returns
+    # it straight away, and after more records have been saved only those have to be correlated.
+    # channel_times (from read_channel_times) saves reading the file again if it has already been read.
+    if processed_data_group_name is None:
+        processed_data_group_name = g2_group_name(channels, bin_width, tau_min, tau_max)
+    total_entries, clock_correction = read_record_state(hdf_name)
+    params = {'channels':channels, 'bin_width':bin_width, 'tau_min':tau_min, 'tau_max':tau_max, 'clock_correction':clock_correction}
+    cache = read_g2_cache(hdf_name, processed_data_group_name)
+    how = g2_cache_status(cache, params, total_entries)
+    if how == 'cached':
+        return cache['g2'], cache['tau'], how
+    state = None
+    if how == 'incremental':
+        state = g2_incremental_state(hdf_name, cache, channels, bin_width, tau_min, tau_max, total_entries)
+    if state is None:
+        how = 'full'
+        if channel_times is None:
+            channel_times, total_entries = read_channel_times(hdf_name)
+        state = g2_state_from_times(channel_times[channels[0]], channel_times[channels[1]], bin_width, tau_min, tau_max)
+    g2 = g2_from_counts(state['counts'], state['n1'], state['n2'], state['t_min'], state['t_max'], bin_width)
+    params.update({'total_entries':total_entries, 'n1':state['n1'], 'n2':state['n2'], 't_min':state['t_min'], 't_max':state['t_max']})
+    write_g2_result(hdf_name, processed_data_group_name, g2, state['tau'], params, state['counts'])
+    return g2, state['tau'], how
+
+
+def g2_calc(hdf_name, channels=(0, 1), bin_width=50E-9, tau_min=700E-6, tau_max=800E-6, processed_data_group_name='processed/50ns_bin/'):
+    # Choose which channels you want to perform the g2 mesurement over with channels
+    # It is fine to make them both the same channel
+    # change the group name to whatever you want. Be sure to update the name in the plotting function
     t0 = systime.time()
     print('Calculating overlap function...')
-    overlap_function = calc_overlap_function_jit(binned_x1, binned_x2, tau, bin_width, bins_tot)
+    g2, tau, how = g2_cached(hdf_name, channels, bin_width, tau_min, tau_max, processed_data_group_name)
 
-    print('Finished calculating overlap function...')
+    print('Finished calculating overlap function ({})...'.format({'cached':'saved result was up to date', 'incremental':'only new records correlated', 'full':'all records correlated'}[how]))
     t1 = systime.time()
     time_taken = t1-t0
     print('Calculation time = '+str(int(floor(time_taken/(60*60))))+'hrs '+str(int(floor(mod(time_taken, 60*60)/60)))+'mins '+str(int(mod(time_taken, 60)))+'secs')
-    
-    g2 = overlap_function/(ave_I_x1 * ave_I_x2)
-    
-    hdf_write(hdf_name, [processed_data_group_name + 'g2', processed_data_group_name + 'tau'], [g2, tau])
 
 
 def plot_g2(hdf_name):
@@ -186,7 +335,8 @@ def histogram_of_deltas(hdf_name):
     hdf_file = h5py.File(hdf_name, 'a')
     total_entries = hdf_file['total_entries'][:][0]
     dset_records = hdf_file['records']
-    times_all = dset_records['time'][:total_entries]*5E-9
+    # Any clock correction saved by clock_alignment.py is applied here, as the times are read
+    times_all = corrected_times(hdf_file, dset_records['time'][:total_entries])*5E-9
     ch0 = dset_records['ch0'][:total_entries]
     times_ch0 = times_all[ch0==1]
 
@@ -206,6 +356,25 @@ def histogram_of_deltas(hdf_name):
     show()
 
 
+def plot_rate_history(hdf_name, level_name='10s'):
+    # Plots the count rate history from the rate pyramid written during acquisition, so the records themselves are never read.
+    # level_name is one of '1ms', '100ms', '10s' or '1000s'. Rows with the same bin time (possible after zeroing the timer) are summed.
+    hdf_file = h5py.File(hdf_name, 'r')
+    bin_times, summed, bin_width = prStorage.read_rate_history(hdf_file, level_name)
+    hdf_file.close()
+
+    fig = figure()
+    ax1 = fig.add_subplot(111)
+    for field in ['counts', 'ch0', 'ch1', 'ch2', 'ch3']:
+        ax1.step(bin_times, summed[field]/bin_width, where='post', label=field)
+    ax1.set_xlabel(r'$\rm{t}$ $\rm{(s)}$')
+    ax1.set_ylabel(r'$\rm{Count}$ $\rm{rate}$ $\rm{(s^{-1})}$')
+    ax1.legend()
+    tight_layout()
+    savefig('rate_history_{}_bins.pdf'.format(level_name))
+    show()
+
+
 ###############################################################################
 #Make program run now...
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+import argparse
+import json
+import time as systime
+
+import numpy as np
+import h5py
+
+"""
+Converts recordings between the HDF layout written by SerialThread.start_saving (a 'records' dataset plus
+'total_entries') and Parquet or Arrow IPC files, for tools that read those rather than HDF. The records are
+converted a chunk at a time, so memory use doesn't grow with the file. pyarrow is only needed to run this.
+
+Layouts (--layout):
+columns     time (int64 clock cycles), ch0, ch1, ch2, ch3 (uint8): the same columns as the HDF records
+packed      one int64 per record: time << 4 | ch3 << 3 | ch2 << 2 | ch1 << 1 | ch0
+tags        one row per pulse, as most time-tagger software uses: channel (dictionary of uint8), time.
+            A record with pulses on several channels becomes several rows with the same time, and a record
+            with no pulses has no rows.
+
+Parquet files store time (and packed) with DELTA_BINARY_PACKED, which only keeps the small differences between
+consecutive times, and the channel columns dictionary encoded. Arrow IPC has no delta encoding, so the columns
+are written as they are and the file compressed (zstd by default). In the tags layout the channel column is
+dictionary encoded in both formats.
+
+The attributes and events of the recording, the layout and the clock period go in the schema metadata under
+'pulse_recorder', so importing gives back the same HDF layout. Times are always in clock cycles (5 ns).
+
+To run:
+python convert_records.py export pulse_record.hdf pulse_record.parquet --layout columns
+python convert_records.py export pulse_record.hdf pulse_record.arrow --layout tags
+python convert_records.py import pulse_record.parquet pulse_record_copy.hdf
+python convert_records.py read-speed pulse_record.hdf pulse_record.parquet pulse_record.arrow
+"""
+
+clock_period = 5E-9
+layouts = ('columns', 'packed', 'tags')
+channel_bits = 4
+
+# The same as pulse_recorder_storage
+record_types = [('time', np.int64), ('ch0', np.uint8), ('ch1', np.uint8), ('ch2', np.uint8), ('ch3', np.uint8)]
+event_types = [('host_time', np.float64), ('record_index', np.int64), ('kind', 'S16'), ('value', np.float64)]
+
+
+def import_pyarrow():
+    # pyarrow is only imported when converting, so the rest of the analysis scripts don't need it
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError('Converting to Parquet or Arrow needs pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+def file_format(file_name):
+    # 'parquet', 'arrow' or 'hdf', from the first bytes of the file
+    with open(file_name, 'rb') as data_file:
+        magic = data_file.read(8)
+    if magic[:4] == b'PAR1':
+        return 'parquet'
+    if magic[:6] == b'ARROW1':
+        return 'arrow'
+    if magic == b'\x89HDF\r\n\x1a\n':
+        return 'hdf'
+    raise ValueError('{} is not a Parquet, Arrow IPC or HDF file'.format(file_name))
+
+
+def output_format(file_name):
+    # The format to write, from the file extension
+    return 'parquet' if str(file_name).lower().endswith(('.parquet', '.pq')) else 'arrow'
+
+
+def arrow_schema(pa, layout, metadata):
+    if layout == 'columns':
+        fields = [pa.field('time', pa.int64())] + [pa.field('ch{}'.format(channel), pa.uint8()) for channel in range(4)]
+    elif layout == 'packed':
+        fields = [pa.field('packed', pa.int64())]
+    elif layout == 'tags':
+        fields = [pa.field('channel', pa.dictionary(pa.int8(), pa.uint8())), pa.field('time', pa.int64())]
+    else:
+        raise ValueError('layout must be one of {}'.format(layouts))
+    return pa.schema(fields, metadata={'pulse_recorder':json.dumps(metadata)})
+
+
+def records_to_batch(pa, schema, layout, records):
+    # records is a structured array of record_types
+    if layout == 'columns':
+        arrays = [pa.array(records[name]) for name in schema.names]
+    elif layout == 'packed':
+        packed = records['time'] << channel_bits
+        for channel in range(4):
+            packed |= (records['ch{}'.format(channel)] != 0).astype(np.int64) << channel
+        arrays = [pa.array(packed)]
+    else:
+        # One row per pulse, in time order, and in channel order for pulses at the same time
+        flags = np.stack([records['ch{}'.format(channel)] != 0 for channel in range(4)], axis=1)
+        record_idx, channels = np.nonzero(flags)
+        dictionary = pa.array(np.arange(4, dtype=np.uint8))
+        arrays = [pa.DictionaryArray.from_arrays(pa.array(channels.astype(np.int8)), dictionary), pa.array(records['time'][record_idx])]
+    return pa.record_batch(arrays, schema=schema)
+
+
+def batch_to_records(layout, batch):
+    # The opposite of records_to_batch, for the columns and packed layouts
+    if layout == 'columns':
+        records = np.empty(batch.num_rows, dtype=record_types)
+        for name in records.dtype.names:
+            records[name] = batch.column(name).to_numpy(zero_copy_only=False)
+    else:
+        packed = batch.column('packed').to_numpy(zero_copy_only=False)
+        records = np.empty(len(packed), dtype=record_types)
+        records['time'] = packed >> channel_bits
+        for channel in range(4):
+            records['ch{}'.format(channel)] = (packed >> channel) & 1
+    return records
+
+
+def tags_to_records(channels, times):
+    # Merges consecutive rows with the same time into one record
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(times)) + 1)) if len(times) else np.zeros(0, dtype=np.int64)
+    records = np.zeros(len(starts), dtype=record_types)
+    records['time'] = times[starts]
+    record_idx = np.cumsum(np.concatenate(([False], np.diff(times) != 0))) if len(times) else times
+    for channel in range(4):
+        on_channel = channels == channel
+        records['ch{}'.format(channel)][record_idx[on_channel]] = 1
+    return records
+
+
+def hdf_attrs(attrs):
+    # Attributes as plain JSON values
+    plain = {}
+    for name, value in attrs.items():
+        if isinstance(value, bytes):
+            value = value.decode()
+        elif isinstance(value, (np.generic, np.ndarray)):
+            value = value.tolist()
+        plain[name] = value
+    return plain
+
+
+def export_records(hdf_name, out_name, layout='columns', group_name=None, chunk_size=1000000, compression='zstd'):
+    # Writes the records of hdf_name (or its group_name) to out_name, as Parquet if it ends in .parquet and
+    # Arrow IPC otherwise. Each chunk becomes one row group (Parquet) or record batch (Arrow). Returns the records written.
+    pa = import_pyarrow()
+    t0 = systime.time()
+    hdf_file = h5py.File(hdf_name, 'r')
+    root = hdf_file if group_name is None else hdf_file[group_name]
+    dset_records = root['records']
+    total_entries = int(root['total_entries'][0])
+    events = root['events'][...] if 'events' in root else np.zeros(0, dtype=event_types)
+    metadata = {'layout':layout, 'clock_period':clock_period, 'total_entries':total_entries,
+                'attrs':hdf_attrs(root.attrs),
+                'events':[[float(event['host_time']), int(event['record_index']), event['kind'].decode(), float(event['value'])] for event in events]}
+    schema = arrow_schema(pa, layout, metadata)
+    if output_format(out_name) == 'parquet':
+        time_columns = ['packed'] if layout == 'packed' else ['time']
+        writer = pa.parquet.ParquetWriter(out_name, schema, compression=compression,
+                                          use_dictionary=[name for name in schema.names if name not in time_columns],
+                                          column_encoding={name:'DELTA_BINARY_PACKED' for name in time_columns})
+        write_batch = lambda batch: writer.write_batch(batch, row_group_size=batch.num_rows)
+    else:
+        writer = pa.ipc.new_file(out_name, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+        write_batch = writer.write_batch
+    try:
+        for start in range(0, total_entries, chunk_size):
+            records = dset_records[start:min(start + chunk_size, total_entries)]
+            write_batch(records_to_batch(pa, schema, layout, records))
+            elapsed = systime.time() - t0
+            print('[{:.0f} s] {:,} of {:,} records, {:,.0f} records/s'.format(elapsed, start + len(records), total_entries, (start + len(records))/max(elapsed, 1E-9)), flush=True)
+    finally:
+        writer.close()
+        hdf_file.close()
+    return total_entries
+
+
+def read_metadata(file_name):
+    # The 'pulse_recorder' schema metadata of a Parquet or Arrow file written by export_records
+    pa = import_pyarrow()
+    if file_format(file_name) == 'parquet':
+        schema = pa.parquet.read_schema(file_name)
+    else:
+        with pa.memory_map(str(file_name), 'r') as source:
+            schema = pa.ipc.open_file(source).schema
+    if not schema.metadata or b'pulse_recorder' not in schema.metadata:
+        raise ValueError('{} was not written by convert_records.py'.format(file_name))
+    return json.loads(schema.metadata[b'pulse_recorder'])
+
+
+def iter_batches(file_name, batch_size=1000000):
+    # The Arrow record batches of a Parquet or Arrow file, a few at a time
+    pa = import_pyarrow()
+    if file_format(file_name) == 'parquet':
+        yield from pa.parquet.ParquetFile(file_name).iter_batches(batch_size=batch_size)
+    else:
+        with pa.memory_map(str(file_name), 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for batch_idx in range(reader.num_record_batches):
+                yield reader.get_batch(batch_idx)
+
+
+def read_records(file_name, batch_size=1000000):
+    # Yields the records of a Parquet, Arrow or HDF file as structured arrays of record_types, in order and a
+    # batch at a time, whatever the layout. For analysis that reads from whichever format is fastest.
+    if file_format(file_name) == 'hdf':
+        with h5py.File(file_name, 'r') as hdf_file:
+            total_entries = int(hdf_file['total_entries'][0])
+            for start in range(0, total_entries, batch_size):
+                yield hdf_file['records'][start:min(start + batch_size, total_entries)]
+        return
+    layout = read_metadata(file_name)['layout']
+    if layout != 'tags':
+        for batch in iter_batches(file_name, batch_size):
+            yield batch_to_records(layout, batch)
+        return
+    # The pulses of the last record of a batch may carry on into the next batch, so it is held back until then
+    held_channels = np.zeros(0, dtype=np.int8)
+    held_times = np.zeros(0, dtype=np.int64)
+    for batch in iter_batches(file_name, batch_size):
+        # Parquet may give the channels back as plain uint8 rather than as a dictionary, which to_numpy handles either way
+        channels = np.concatenate((held_channels, batch.column('channel').to_numpy(zero_copy_only=False).astype(np.int8)))
+        times = np.concatenate((held_times, batch.column('time').to_numpy(zero_copy_only=False)))
+        if not len(times):
+            continue
+        last_start = len(times) - np.argmax(times[::-1] != times[-1]) if (times != times[-1]).any() else 0
+        held_channels, held_times = channels[last_start:], times[last_start:]
+        if last_start:
+            yield tags_to_records(channels[:last_start], times[:last_start])
+    if len(held_times):
+        yield tags_to_records(held_channels, held_times)
+
+
+def import_records(in_name, hdf_name, group_name=None, batch_size=1000000):
+    # Writes a Parquet or Arrow file made by export_records back to the HDF layout, with its attributes and events.
+    # Returns the records written.
+    t0 = systime.time()
+    metadata = read_metadata(in_name)
+    with h5py.File(hdf_name, 'a' if group_name is not None else 'w') as hdf_file:
+        root = hdf_file if group_name is None else hdf_file.create_group(group_name)
+        for name, value in metadata['attrs'].items():
+            root.attrs[name] = value
+        root.attrs['converted_from'] = str(in_name)
+        events = np.array([tuple(event) for event in metadata['events']], dtype=event_types)
+        root.create_dataset('events', data=events, maxshape=(None,), chunks=True)
+        dset_records = root.create_dataset('records', shape=(0,), dtype=record_types, maxshape=(None,), chunks=True)
+        dset_total_entries = root.create_dataset('total_entries', data=np.array([0], dtype=np.int64))
+        total_entries = 0
+        for records in read_records(in_name, batch_size):
+            dset_records.resize(total_entries + len(records), axis=0)
+            dset_records[total_entries:total_entries + len(records)] = records
+            total_entries += len(records)
+            dset_total_entries[0] = total_entries
+            elapsed = systime.time() - t0
+            print('[{:.0f} s] {:,} of {:,} records, {:,.0f} records/s'.format(elapsed, total_entries, metadata['total_entries'], total_entries/max(elapsed, 1E-9)), flush=True)
+    return total_entries
+
+
+def read_speed(file_name, batch_size=1000000):
+    # Reads every record of file_name, returning (records, seconds taken)
+    t0 = systime.time()
+    num_records = 0
+    for records in read_records(file_name, batch_size):
+        num_records += len(records)
+    return num_records, systime.time() - t0
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert recordings between HDF and Parquet or Arrow IPC.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='HDF to Parquet (.parquet) or Arrow IPC (anything else)')
+    export_parser.add_argument('hdf_name')
+    export_parser.add_argument('out_name')
+    export_parser.add_argument('--layout', choices=layouts, default='columns')
+    export_parser.add_argument('--group', default=None, help='Device group, for files recorded from several devices')
+    export_parser.add_argument('--chunk-size', type=int, default=1000000, help='Records per row group or record batch')
+    export_parser.add_argument('--compression', default='zstd', help='zstd, lz4 or none (Parquet can also use snappy or gzip)')
+    import_parser = commands.add_parser('import', help='Parquet or Arrow IPC back to HDF')
+    import_parser.add_argument('in_name')
+    import_parser.add_argument('hdf_name')
+    import_parser.add_argument('--group', default=None, help='Add the records to this group of hdf_name instead of making a new file')
+    speed_parser = commands.add_parser('read-speed', help='Time reading every record of each file')
+    speed_parser.add_argument('file_names', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_records(args.hdf_name, args.out_name, args.layout, args.group, args.chunk_size, None if args.compression == 'none' else args.compression)
+    elif args.command == 'import':
+        import_records(args.in_name, args.hdf_name, args.group)
+    else:
+        for file_name in args.file_names:
+            num_records, seconds = read_speed(file_name)
+            print('{}: {:,} records in {:.2f} s, {:,.0f} records/s'.format(file_name, num_records, seconds, num_records/max(seconds, 1E-9)))
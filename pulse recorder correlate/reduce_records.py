@@ -0,0 +1,219 @@
+import argparse
+import json
+import multiprocessing
+import time as systime
+
+import numpy as np
+import h5py
+
+"""
+Makes a smaller copy of a recording, keeping only the records that pass the filters given. It is for recordings
+made without the retention filter, which can be shrunk by orders of magnitude before they are archived or sent.
+
+Filters (any combination, all in seconds):
+--start/--stop          only records with start <= time < stop
+--channels              only records with a pulse on one of these channels. Pulses on the other channels are cleared.
+--retention-interval    only records within this time of the record before or after them, as the retention filter
+                        (savecheck) does while recording
+--coincidence A B W     only the channel A and B pulses within W of a pulse on the other channel. A record is
+                        kept if either of its A or B pulses is.
+The retention and coincidence filters look at the records left by the start/stop and channel filters.
+The attributes and events of the recording are copied, with the record_index of each event moved to the row of
+the reduced records it comes before.
+
+The records are read and filtered a chunk at a time, so memory use doesn't grow with the file. Chunks are spread
+over a pool of processes, and the results written in order by this one. Each chunk also reads as many of the
+records either side of it as the retention and coincidence filters need, so records at the edges of chunks are
+treated as if the file were filtered in one go.
+
+To run:
+python reduce_records.py pulse_record.hdf reduced.hdf --retention-interval 1E-6 --channels 0 1
+"""
+
+clock_period = 5E-9
+
+
+def channel_flags(records, channels):
+    # A (N, len(channels)) bool array of which of the channels each record has a pulse on
+    return np.stack([records['ch{}'.format(channel)] != 0 for channel in channels], axis=1) if len(channels) else np.zeros((len(records), 0), dtype=bool)
+
+
+def select_records(records, filters):
+    # The start/stop and channel filters, which only look at each record on its own. Returns a copy of the records
+    # kept, and their rows in records.
+    keep = np.ones(len(records), dtype=bool)
+    if filters['start'] is not None:
+        keep &= records['time'] >= filters['start']
+    if filters['stop'] is not None:
+        keep &= records['time'] < filters['stop']
+    if filters['channels'] is not None:
+        keep &= channel_flags(records, filters['channels']).any(axis=1)
+    records = records[keep]
+    if filters['channels'] is not None:
+        for channel in range(4):
+            if channel not in filters['channels']:
+                records['ch{}'.format(channel)] = 0
+    return records, np.flatnonzero(keep)
+
+
+def retention_mask(times, retention_interval):
+    # Keeps both records of every consecutive pair no more than retention_interval apart, as savecheck does
+    close = np.diff(times) <= retention_interval
+    keep = np.zeros(len(times), dtype=bool)
+    keep[:-1] |= close
+    keep[1:] |= close
+    return keep
+
+
+def within_window(times, other_times, window):
+    # Whether each of times has one of other_times within window of it
+    other_times = np.sort(other_times)
+    if not len(other_times):
+        return np.zeros(len(times), dtype=bool)
+    idx = np.searchsorted(other_times, times - window)
+    return (idx < len(other_times)) & (other_times[np.minimum(idx, len(other_times) - 1)] <= times + window)
+
+
+def coincidence_mask(records, channel_a, channel_b, window):
+    # Clears the channel A and B pulses without a pulse on the other channel within window, and returns which records still have one
+    times = records['time']
+    on_a = records['ch{}'.format(channel_a)] != 0
+    on_b = records['ch{}'.format(channel_b)] != 0
+    keep_a = on_a.copy()
+    keep_a[on_a] = within_window(times[on_a], times[on_b], window)
+    keep_b = on_b.copy()
+    keep_b[on_b] = within_window(times[on_b], times[on_a], window)
+    return keep_a, keep_b
+
+
+def context_needed(filters):
+    # How far either side of a chunk the neighbourhood filters look, in ticks (or None if they don't)
+    reaches = []
+    if filters['retention_interval'] is not None:
+        reaches.append(filters['retention_interval'])
+    if filters['coincidence'] is not None:
+        reaches.append(filters['coincidence'][2])
+    return max(reaches) if reaches else None
+
+
+def read_context(dset_records, start, stop, total_entries, reach, filters, before):
+    # Reads the selected records just before start (or from stop on), doubling how many are read until they cover
+    # reach from the chunk, or there are no more. Records further away can't change what happens to the chunk's.
+    num_rows = 1024
+    while True:
+        if before:
+            context_start, context_stop = max(start - num_rows, 0), start
+        else:
+            context_start, context_stop = stop, min(stop + num_rows, total_entries)
+        if context_start >= context_stop:
+            return select_records(dset_records[0:0], filters)[0]
+        raw = dset_records[context_start:context_stop]
+        selected = select_records(raw, filters)[0]
+        edge_time = dset_records[start]['time'] if before else dset_records[stop - 1]['time']
+        at_end = context_start == 0 if before else context_stop == total_entries
+        covered = raw['time'][0] < edge_time - reach if before else raw['time'][-1] > edge_time + reach
+        if at_end or covered:
+            return selected
+        num_rows *= 2
+
+
+def reduce_chunk(job):
+    # Runs in a worker process. Returns (chunk start, the records of rows start to stop that pass, the rows they were
+    # in, rows read)
+    hdf_name, group_name, start, stop, filters = job
+    with h5py.File(hdf_name, 'r') as hdf_file:
+        root = hdf_file if group_name is None else hdf_file[group_name]
+        dset_records = root['records']
+        total_entries = int(root['total_entries'][0])
+        records, rows = select_records(dset_records[start:stop], filters)
+        rows += start
+        reach = context_needed(filters)
+        if reach is None or not len(records):
+            return start, records, rows, stop - start
+        before = read_context(dset_records, start, stop, total_entries, reach, filters, before=True)
+        after = read_context(dset_records, start, stop, total_entries, reach, filters, before=False)
+    records_all = np.concatenate((before, records, after))
+    chunk = slice(len(before), len(before) + len(records))
+    keep = np.ones(len(records_all), dtype=bool)
+    if filters['retention_interval'] is not None:
+        keep &= retention_mask(records_all['time'], filters['retention_interval'])
+    if filters['coincidence'] is not None:
+        channel_a, channel_b, window = filters['coincidence']
+        keep_a, keep_b = coincidence_mask(records_all, channel_a, channel_b, window)
+        records_all['ch{}'.format(channel_a)] = keep_a
+        records_all['ch{}'.format(channel_b)] = keep_b
+        keep &= keep_a | keep_b
+    records = records_all[chunk][keep[chunk]]
+    return start, records, rows[keep[chunk]], stop - start
+
+
+def reduce_records(hdf_name, reduced_name, filters, group_name=None, chunk_size=4000000, processes=None):
+    # Writes the records of hdf_name (or its group_name) that pass the filters to reduced_name, along with the
+    # attributes and events of the original. The record_index of each event is changed to the row of the reduced
+    # records it comes before. Returns (records read, records kept).
+    t0 = systime.time()
+    with h5py.File(hdf_name, 'r') as hdf_file:
+        root = hdf_file if group_name is None else hdf_file[group_name]
+        total_entries = int(root['total_entries'][0])
+        record_dtype = root['records'].dtype
+        attrs = dict(root.attrs)
+        events = root['events'][...] if 'events' in root else None
+    jobs = [(hdf_name, group_name, start, min(start + chunk_size, total_entries), filters) for start in range(0, total_entries, chunk_size)]
+    records_read = 0
+    records_kept = 0
+    with h5py.File(reduced_name, 'w') as reduced_file:
+        for name, value in attrs.items():
+            reduced_file.attrs[name] = value
+        reduced_file.attrs['reduced_from'] = str(hdf_name) if group_name is None else '{}:{}'.format(hdf_name, group_name)
+        reduced_file.attrs['reduction_filters'] = json.dumps(filters)
+        # How many of the records kept were before each event
+        if events is not None:
+            event_indices = np.zeros(len(events), dtype=np.int64)
+        dset_records = reduced_file.create_dataset('records', shape=(0,), dtype=record_dtype, maxshape=(None,), chunks=True)
+        dset_total_entries = reduced_file.create_dataset('total_entries', data=np.array([0], dtype=np.int64))
+        with multiprocessing.Pool(processes) as pool:
+            # imap keeps the chunks in order
+            for chunk_idx, (start, records, rows, rows_read) in enumerate(pool.imap(reduce_chunk, jobs)):
+                if events is not None:
+                    event_indices += np.searchsorted(rows, events['record_index'])
+                dset_records.resize(records_kept + len(records), axis=0)
+                dset_records[records_kept:records_kept + len(records)] = records
+                records_kept += len(records)
+                records_read += rows_read
+                dset_total_entries[0] = records_kept
+                elapsed = systime.time() - t0
+                print('[{}/{} chunks, {:.0f} s] {:,} records read, {:,} kept ({:.2%}), {:,.0f} records/s'.format(chunk_idx + 1, len(jobs), elapsed, records_read, records_kept, records_kept/max(records_read, 1), records_read/max(elapsed, 1E-9)), flush=True)
+        if events is not None:
+            events['record_index'] = event_indices
+            reduced_file.create_dataset('events', data=events, maxshape=(None,), chunks=True)
+    return records_read, records_kept
+
+
+def make_filters(start=None, stop=None, channels=None, retention_interval=None, coincidence=None):
+    # The filters as a dict of plain numbers in clock ticks, from times in seconds
+    def ticks(seconds):
+        return None if seconds is None else int(round(seconds/clock_period))
+    return {'start':ticks(start), 'stop':ticks(stop), 'channels':sorted(set(channels)) if channels is not None else None,
+            'retention_interval':ticks(retention_interval),
+            'coincidence':None if coincidence is None else [int(coincidence[0]), int(coincidence[1]), ticks(coincidence[2])]}
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a copy of a recording with only the records that pass the filters.')
+    parser.add_argument('hdf_name')
+    parser.add_argument('reduced_name')
+    parser.add_argument('--group', default=None, help='Device group, for files recorded from several devices')
+    parser.add_argument('--start', type=float, default=None, help='Earliest record time to keep, in seconds')
+    parser.add_argument('--stop', type=float, default=None, help='Keep records before this time, in seconds')
+    parser.add_argument('--channels', nargs='+', type=int, default=None, help='Keep only these channels')
+    parser.add_argument('--retention-interval', type=float, default=None, help='Keep records within this many seconds of the one before or after')
+    parser.add_argument('--coincidence', nargs=3, type=float, default=None, metavar=('A', 'B', 'WINDOW'), help='Keep channel A and B pulses within WINDOW seconds of each other')
+    parser.add_argument('--chunk-size', type=int, default=4000000, help='Records per chunk')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    filters = make_filters(args.start, args.stop, args.channels, args.retention_interval, args.coincidence)
+    records_read, records_kept = reduce_records(args.hdf_name, args.reduced_name, filters, args.group, args.chunk_size, args.processes)
+    print('Kept {:,} of {:,} records'.format(records_kept, records_read))
@@ -1,15 +1,23 @@
+import time
+# Taken before anything else is imported, so the startup times include the imports
+program_start = time.perf_counter()
+
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtWidgets import QMessageBox
 import numpy as np
-import time
 import pathlib
-import serial
-import serial.tools.list_ports
 import sys
+import logging
 import qdarkstyle
 
 import pulse_recorder_mainwindow_design
 import pulse_recorder_additional_classes as prExtras
+import pulse_recorder_storage as prStorage
+import pulse_recorder_metrics as prMetrics
+import pulse_recorder_plots as prPlots
+
+prMetrics.program_start = program_start
+logger = logging.getLogger(__name__)
 
 """
 To run code:
@@ -66,86 +74,135 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
         self.checkBoxRetention.stateChanged.connect(self.retention_enable)
         self.lineEditRetention.editingFinished.connect(self.set_retention)
 
-        #setup serial port
-        self.ser = serial.Serial()
-        self.ser.timeout = 0.1          #block for 100ms second
-        self.ser.writeTimeout = 1     #timeout for write
-        self.ser.baudrate = 12000000
-        self.ser.port = 'COM6'
+        # Menus for settings that don't have a place in the main window
+        self.menuFile = self.menubar.addMenu('File')
+        self.actionRotation = self.menuFile.addAction('Segment rotation...')
+        self.actionRotation.triggered.connect(self.set_rotation)
+        self.actionFlushInterval = self.menuFile.addAction('Flush interval...')
+        self.actionFlushInterval.triggered.connect(self.set_flush_interval)
+        self.actionFsync = self.menuFile.addAction('Sync to disk after each flush')
+        self.actionFsync.setCheckable(True)
+        self.actionFsync.toggled.connect(self.set_fsync)
+        self.actionMetricsFile = self.menuFile.addAction('Metrics file...')
+        self.actionMetricsFile.triggered.connect(self.set_metrics_file)
+        self.menuSettings = self.menubar.addMenu('Settings')
+        self.actionBackpressure = self.menuSettings.addAction('Backpressure control...')
+        self.actionBackpressure.triggered.connect(self.set_backpressure)
+        self.actionDevices = self.menuSettings.addAction('Devices...')
+        self.actionDevices.triggered.connect(self.set_devices)
+        self.actionRecordServer = self.menuSettings.addAction('Streaming server...')
+        self.actionRecordServer.triggered.connect(self.set_record_server)
+        self.menuView = self.menubar.addMenu('View')
+        self.actionMetrics = self.menuView.addAction('Acquisition metrics')
+        self.actionMetrics.triggered.connect(self.show_metrics)
+        self.actionDeltaHistogram = self.menuView.addAction('Time between pulses')
+        self.actionDeltaHistogram.setCheckable(True)
+        self.actionDeltaHistogram.setChecked(True)
+        self.actionDeltaHistogram.toggled.connect(self.show_delta_histogram)
+        self.actionDeltaHistogramSettings = self.menuView.addAction('Time between pulses settings...')
+        self.actionDeltaHistogramSettings.triggered.connect(self.set_delta_histogram)
+        self.actionRateHistory = self.menuView.addAction('Count rate history')
+        self.actionRateHistory.setCheckable(True)
+        self.actionRateHistory.setChecked(True)
+        self.actionRateHistory.toggled.connect(self.show_rate_history)
+
+        # Live histogram of the time between pulses, below the controls
+        self.delta_histogram_view = prPlots.DeltaHistogramView(self.centralwidget)
+        self.verticalLayout.addWidget(self.delta_histogram_view)
+        # and the count rates over the whole run, below that
+        self.rate_history_view = prPlots.RateHistoryView(self.centralwidget)
+        self.verticalLayout.addWidget(self.rate_history_view)
+        self.resize(self.width(), self.height() + 440)
 
         # setting some default values
         self.file_directory = pathlib.Path.home()/'Desktop/pulse_record.hdf'
         self.btnStopSaving.setEnabled(False)
-        self.last_counts = (0, 0)
         self.last_holdoff = 10E-9
-
-        #Setting up serial read thread
-        self.serial_thread = prExtras.SerialThread(self.ser)
-
-        self.serial_thread.finished.connect(self.callback_finished)
-        self.serial_thread.error.connect(self.callback_error)
-
-        self.serial_thread.serialecho.connect(self.callback_echo)
-        self.serial_thread.easyprint.connect(self.callback_easyprint)
-        self.serial_thread.devicestatus.connect(self.callback_devicestatus)
-        self.serial_thread.internal_error.connect(self.callback_internalerror)
-
-        self.authantication_byte = None
-        self.valid_ports = []
+        # (bin width, dt min, dt max) of the time between pulses histogram, in clock cycles
+        self.delta_histogram_configuration = (200, 0, 400000)
+        # Serves the live records to other programs when started from the settings menu
+        self.record_server = None
+        self.num_devices = 1
+        self.device_layout = 'groups'
+        # Port of each connected serial thread, the status versions shown last, and the bytes dropped so far by each
+        self.connected_ports = {}
+        self.status_versions = []
+        self.last_bytes_dropped_total = {}
 
         self.status_timer = QtCore.QTimer()
         self.status_timer.setInterval(500)
-        self.status_timer.timeout.connect(self.serial_thread.update_status)
-        
+        self.status_timer.timeout.connect(self.update_status)
+
+        # All the labels and plots are updated from this timer, so the GUI's work doesn't grow with the message rate
+        self.display_timer = QtCore.QTimer()
+        self.display_timer.setInterval(50)
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.display_timer.start()
+
+        #Setting up a serial read thread for each device
+        self.create_serial_threads()
         self.connect_serial()
+        # Seconds from the program starting to the window being shown
+        self.time_to_window = None
+
+    def create_serial_threads(self):
+        self.serial_threads = [prExtras.SerialThread() for device_idx in range(self.num_devices)]
+        # The first thread's settings are the ones shown and changed through the GUI. The flush policy is shared.
+        self.serial_thread = self.serial_threads[0]
+        for device_idx, serial_thread in enumerate(self.serial_threads):
+            serial_thread.flush_policy = self.serial_thread.flush_policy
+            serial_thread.device_layout = self.device_layout if self.num_devices > 1 else None
+            serial_thread.device_index = device_idx
+            serial_thread.record_server = self.record_server
+
+            serial_thread.finished.connect(self.callback_finished)
+            serial_thread.error.connect(self.callback_error)
+
+            serial_thread.serialecho.connect(self.callback_echo)
+            serial_thread.easyprint.connect(self.callback_easyprint)
+            serial_thread.internal_error.connect(self.callback_internalerror)
+            serial_thread.commandack.connect(self.callback_commandack)
+            serial_thread.connected.connect(self.callback_connected)
+            serial_thread.disconnected.connect(self.callback_disconnected)
+        self.connected_ports = {}
+        self.status_versions = []
+        self.last_bytes_dropped_total = {}
+        for serial_thread in self.serial_threads:
+            serial_thread.delta_histogram.configure(*self.delta_histogram_configuration)
+        self.delta_histogram_view.set_histograms([serial_thread.delta_histogram for serial_thread in self.serial_threads])
+        self.rate_history_view.set_rate_histories([serial_thread.rate_history for serial_thread in self.serial_threads])
+        if hasattr(self, 'metrics_dialog'):
+            self.metrics_dialog.set_serial_threads(self.serial_threads)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.time_to_window is None:
+            # Once the events already queued (including painting the window) have been handled
+            QtCore.QTimer.singleShot(0, self.window_shown)
+
+    def window_shown(self):
+        if self.time_to_window is None:
+            self.time_to_window = time.perf_counter() - prMetrics.program_start
+            logger.info('Window shown %.0f ms after the program started', self.time_to_window*1E3)
 
     def connect_serial(self):
-        if self.valid_ports:
-            # now try a port
-            comport = self.valid_ports.pop(0)
-            self.ser.port = comport.device
-            try:
-                self.ser.open()
-            except Exception as ex:
-                #if port throws an error on open, wait a bit, then try a new one
-                QtCore.QTimer.singleShot(100, self.connect_serial)
-                return
-            self.ser.reset_input_buffer()
-            self.ser.reset_output_buffer()
-            self.serial_thread.start()
-            self.tested_authantication_byte = np.random.bytes(1)
-            self.serial_thread.write_command(prExtras.encode_echo(self.tested_authantication_byte))
-            QtCore.QTimer.singleShot(1000, self.check_authantication_byte)
-        else:
-            # if there are no ports left in the list, add any valid ports to the list  
-            comports = list(serial.tools.list_ports.comports())
-            for comport in comports:
-                if 'vid' in vars(comport) and 'pid' in vars(comport):
-                    if vars(comport)['vid'] == 1027 and vars(comport)['pid'] == 24592:
-                        self.valid_ports.append(comport)
-            if self.valid_ports:
-                self.connect_serial()
-            else:
-                QtCore.QTimer.singleShot(1000, self.connect_serial)
-
-    def check_authantication_byte(self):
-        if self.authantication_byte == self.tested_authantication_byte:
-            if self.serial_thread.saving_records:
-                self.update_statuslabel(saving='Saving records')    
-            self.update_statuslabel(connection=f'Connected to {self.ser.port}')
-            self.set_holdoff()
-            self.serial_thread.write_command(prExtras.encode_settings(enable_record=True, enable_send_record=True))
-            self.status_timer.start()
-        else:
-            self.safe_close_serial_thread()
-            QtCore.QTimer.singleShot(1000, self.connect_serial)
+        # Each serial thread finds, authenticates and reconnects to a different device itself
+        for serial_thread in self.serial_threads:
+            if not serial_thread.isRunning():
+                serial_thread.start()
 
     def safe_close_serial_thread(self):
-        self.serial_thread.stop()
-        self.serial_thread.wait()
-        self.ser.close()
+        self.status_timer.stop()
+        for serial_thread in self.serial_threads:
+            serial_thread.stop()
+        for serial_thread in self.serial_threads:
+            serial_thread.wait()
         self.update_statuslabel(connection='Not connected', saving='Not saving records')    
 
+    def update_status(self):
+        for serial_thread in self.serial_threads:
+            serial_thread.update_status()
+
     def update_statuslabel(self, saving=None, connection=None):
         if saving: self.status_saving = saving
         if connection: self.status_connection = connection
@@ -167,11 +224,172 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
         if state == 2:
             # enable
             self.lineEditRetention.setEnabled(True)
-            self.serial_thread.enable_retention_interval_filter = True
+            for serial_thread in self.serial_threads:
+                serial_thread.enable_retention_interval_filter = True
         else:
             #disable
             self.lineEditRetention.setEnabled(False)
-            self.serial_thread.enable_retention_interval_filter = False
+            for serial_thread in self.serial_threads:
+                serial_thread.enable_retention_interval_filter = False
+
+    def set_rotation(self):
+        options = ['Single file', 'By size (MB)', 'By record count', 'By time (minutes)']
+        option, ok = QtWidgets.QInputDialog.getItem(self, 'Segment rotation', 'Start a new segment file:', options, 0, False)
+        if not ok:
+            return
+        if option == 'Single file':
+            rotation_policy = None
+        elif option == 'By size (MB)':
+            value, ok = QtWidgets.QInputDialog.getDouble(self, 'Segment rotation', 'Maximum segment size (MB):', 1000, 1, 1E6, 0)
+            rotation_policy = prStorage.RotationPolicy(max_bytes=int(value*1E6))
+        elif option == 'By record count':
+            value, ok = QtWidgets.QInputDialog.getInt(self, 'Segment rotation', 'Maximum records per segment:', 100000000, 1000, 2**31-1)
+            rotation_policy = prStorage.RotationPolicy(max_records=value)
+        else:
+            value, ok = QtWidgets.QInputDialog.getDouble(self, 'Segment rotation', 'Maximum segment duration (minutes):', 60, 1, 1E5, 1)
+            rotation_policy = prStorage.RotationPolicy(max_seconds=value*60)
+        if ok:
+            # Takes effect the next time saving is started
+            for serial_thread in self.serial_threads:
+                serial_thread.rotation_policy = rotation_policy
+            self.statusbar.showMessage('Segment rotation: {}'.format(option), 5000)
+
+    def set_flush_interval(self):
+        flush_policy = self.serial_thread.flush_policy
+        value, ok = QtWidgets.QInputDialog.getInt(self, 'Flush interval', 'Maximum time records wait in memory (ms):', int(flush_policy.max_seconds*1000), 10, 600000)
+        if ok:
+            flush_policy.max_seconds = value/1000
+
+    def set_fsync(self, checked):
+        self.serial_thread.flush_policy.fsync = checked
+
+    def set_metrics_file(self):
+        caption = 'Set Metrics File'
+        metrics_file, fileformat = QtWidgets.QFileDialog.getSaveFileName(self, caption=caption, directory=str(self.file_directory.with_name('pulse_recorder_metrics.jsonl')), filter='JSON lines (*.jsonl);;Prometheus textfile (*.prom)', options=QtWidgets.QFileDialog.DontConfirmOverwrite)
+        if metrics_file:
+            metrics_file = pathlib.Path(metrics_file)
+            for device_idx, serial_thread in enumerate(self.serial_threads):
+                # One file per device, since each thread writes its own
+                if len(self.serial_threads) > 1:
+                    device_metrics_file = metrics_file.with_name('{}_{}{}'.format(metrics_file.stem, device_idx, metrics_file.suffix))
+                else:
+                    device_metrics_file = metrics_file
+                serial_thread.metrics_exporter = prMetrics.MetricsExporter(device_metrics_file, serial_thread.metrics)
+            self.statusbar.showMessage('Writing metrics to {}'.format(metrics_file), 5000)
+
+    def show_metrics(self):
+        if not hasattr(self, 'metrics_dialog'):
+            self.metrics_dialog = MetricsDialog(self.serial_threads, self)
+        self.metrics_dialog.show()
+        self.metrics_dialog.raise_()
+
+    def show_delta_histogram(self, checked):
+        self.delta_histogram_view.setVisible(checked)
+
+    def show_rate_history(self, checked):
+        self.rate_history_view.setVisible(checked)
+
+    def set_delta_histogram(self):
+        bin_width, dt_min, dt_max = self.delta_histogram_configuration
+        bin_width_us, ok = QtWidgets.QInputDialog.getDouble(self, 'Time between pulses', 'Bin width (μs):', bin_width*5E-3, 0.005, 1E6, 3)
+        if not ok:
+            return
+        dt_min_us, ok = QtWidgets.QInputDialog.getDouble(self, 'Time between pulses', 'Shortest time (μs):', dt_min*5E-3, 0, 1E7, 3)
+        if not ok:
+            return
+        dt_max_us, ok = QtWidgets.QInputDialog.getDouble(self, 'Time between pulses', 'Longest time (μs):', dt_max*5E-3, dt_min_us + bin_width_us, 1E7, 3)
+        if not ok:
+            return
+        bin_width = max(int(round(bin_width_us/5E-3)), 1)
+        dt_min = int(round(dt_min_us/5E-3))
+        dt_max = int(round(dt_max_us/5E-3))
+        if (dt_max - dt_min)//bin_width > 100000:
+            QMessageBox.warning(self, 'Time between pulses', 'That would be more than 100,000 bins. Use wider bins or a shorter range.')
+            return
+        self.delta_histogram_configuration = (bin_width, dt_min, dt_max)
+        # The serial threads start the histograms again with the new settings at their next batch of records
+        for serial_thread in self.serial_threads:
+            serial_thread.delta_histogram.configure(bin_width, dt_min, dt_max)
+
+    def set_backpressure(self):
+        options = ['Off', 'Raise holdoff', 'Pause recording', 'Save raw bytes']
+        option, ok = QtWidgets.QInputDialog.getItem(self, 'Backpressure control', 'When the device memory is nearly full:', options, 0, False)
+        if not ok:
+            return
+        if option == 'Off':
+            # Each serial thread restores the normal settings itself, if its controller had stepped in
+            for serial_thread in self.serial_threads:
+                serial_thread.set_backpressure(None)
+            return
+        threshold, ok = QtWidgets.QInputDialog.getDouble(self, 'Backpressure control', 'Step in when the memory is this full (%):', 75, 5, 99, 0)
+        if not ok:
+            return
+        holdoff_time = 198
+        if option == 'Raise holdoff':
+            holdoff_us, ok = QtWidgets.QInputDialog.getDouble(self, 'Backpressure control', 'Holdoff time while stepping in (μs):', 1, 0.01, 1E6, 2)
+            if not ok:
+                return
+            holdoff_time = max(int(round(holdoff_us*1E-6/5E-9)) - 2, 0)
+        policy = {'Raise holdoff':'holdoff', 'Pause recording':'pause', 'Save raw bytes':'raw'}[option]
+        for serial_thread in self.serial_threads:
+            serial_thread.set_backpressure(prExtras.BackpressureController(serial_thread, policy=policy, threshold=threshold/100, holdoff_time=holdoff_time))
+        self.statusbar.showMessage('Backpressure control: {}'.format(option), 5000)
+
+    def set_devices(self):
+        if any(serial_thread.saving_records for serial_thread in self.serial_threads):
+            QMessageBox.information(self, 'Devices', 'Stop saving records before changing the number of devices.')
+            return
+        num_devices, ok = QtWidgets.QInputDialog.getInt(self, 'Devices', 'Number of Pulse Recorders to record from:', self.num_devices, 1, 16)
+        if not ok:
+            return
+        if num_devices > 1:
+            options = ['One group per device in the file', 'One file per device']
+            option, ok = QtWidgets.QInputDialog.getItem(self, 'Devices', 'Save the records of each device in:', options, 0 if self.device_layout == 'groups' else 1, False)
+            if not ok:
+                return
+            self.device_layout = 'groups' if option == options[0] else 'files'
+        old_serial_thread = self.serial_thread
+        self.safe_close_serial_thread()
+        self.num_devices = num_devices
+        self.create_serial_threads()
+        # Keep the settings made so far. Backpressure control and metrics files have to be set up again.
+        for serial_thread in self.serial_threads:
+            serial_thread.flush_policy = old_serial_thread.flush_policy
+            serial_thread.rotation_policy = old_serial_thread.rotation_policy
+            serial_thread.enable_retention_interval_filter = old_serial_thread.enable_retention_interval_filter
+            serial_thread.retention_interval = old_serial_thread.retention_interval
+        self.connect_serial()
+
+    def set_record_server(self):
+        current = ''
+        if self.record_server is not None:
+            address = self.record_server.address
+            current = '{}:{}'.format(*address) if isinstance(address, tuple) else address
+        text, ok = QtWidgets.QInputDialog.getText(self, 'Streaming server', 'Serve live records on (host:port or a port number, or a Unix socket path).\nLeave empty to stop serving:', text=current or '0.0.0.0:5405')
+        if not ok:
+            return
+        text = text.strip()
+        if self.record_server is not None:
+            for serial_thread in self.serial_threads:
+                serial_thread.record_server = None
+            self.record_server.stop()
+            self.record_server = None
+            self.statusbar.showMessage('Stopped serving records', 10000)
+        if not text:
+            return
+        # Imported here, since most runs don't serve records and asyncio adds to the startup time
+        import pulse_recorder_server as prServer
+        address = prServer.parse_address(text)
+        record_server = prServer.RecordServer(address)
+        try:
+            record_server.start()
+        except OSError as ex:
+            QMessageBox.warning(self, 'Streaming server', 'Could not serve records on {}:\n{}'.format(text, ex))
+            return
+        self.record_server = record_server
+        for serial_thread in self.serial_threads:
+            serial_thread.record_server = record_server
+        self.statusbar.showMessage('Serving records on {}'.format('{}:{}'.format(*address) if isinstance(address, tuple) else address), 10000)
 
     def start_saving(self):
         if self.lineEditSaveFile.text() == '':
@@ -179,31 +397,37 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
                 return
         self.btnStopSaving.setEnabled(True)
         self.btnStartSaving.setEnabled(False)
-        self.serial_thread.start_saving(self.file_directory)
+        for serial_thread in self.serial_threads:
+            serial_thread.start_saving(self.file_directory)
         if self.serial_thread.alive:
             self.update_statuslabel(saving='Saving records')
 
     def stop_saving(self):
-        self.serial_thread.stop_saving()
+        for serial_thread in self.serial_threads:
+            serial_thread.stop_saving()
         self.btnStopSaving.setEnabled(False)
         self.btnStartSaving.setEnabled(True)
         self.update_statuslabel(saving='Not saving records')
 
     def zero_timer(self):
-        command = prExtras.encode_settings(zero_pulse_timer=True)
-        self.serial_thread.write_command(command)
+        # Every device is zeroed at once, and the time each was zeroed is saved so their records can be merged
+        for serial_thread in self.serial_threads:
+            serial_thread.zero_timer()
 
     def purge_memory(self):
         command = prExtras.encode_settings(purge_memory=True)
-        self.serial_thread.write_command(command)
+        for serial_thread in self.serial_threads:
+            serial_thread.write_command(command)
 
     def enable_send(self):
         command = prExtras.encode_settings(enable_send_record=True)
-        self.serial_thread.write_command(command)
+        for serial_thread in self.serial_threads:
+            serial_thread.write_command(command, coalesce_key='send')
 
     def disable_send(self):
         command = prExtras.encode_settings(enable_send_record=False)
-        self.serial_thread.write_command(command)
+        for serial_thread in self.serial_threads:
+            serial_thread.write_command(command, coalesce_key='send')
 
     def set_holdoff(self):
         txt = self.lineEditHoldoff.text()
@@ -227,9 +451,7 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
         except ValueError:
             num = self.last_holdoff
         self.last_holdoff = num
-        num = min(num, 1.3)
-        num = max(num, 10E-9)
-        cycles = round(num/5E-9)
+        cycles, setting = prExtras.holdoff_setting(num)
         secs = cycles*5E-9
         if secs >= 1.0:
             disp_txt = '{:.9f}'.format(secs).rstrip('0').rstrip('.') + 's'
@@ -240,8 +462,8 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
         else:
             disp_txt = '{:d}ns'.format(int(secs*1E9))
         self.lineEditHoldoff.setText(disp_txt)
-        command = prExtras.encode_settings(holdoff_time=int(cycles-2))
-        self.serial_thread.write_command(command)
+        for serial_thread in self.serial_threads:
+            serial_thread.set_holdoff(setting)
         self.lineEditHoldoff.clearFocus()
 
     def set_retention(self):
@@ -276,21 +498,57 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
         else:
             disp_txt = '{:d}ns'.format(int(secs*1E9))
         self.lineEditRetention.setText(disp_txt)
-        self.serial_thread.retention_interval = np.int64(cycles)
+        for serial_thread in self.serial_threads:
+            serial_thread.retention_interval = np.int64(cycles)
         self.lineEditRetention.clearFocus()
 
     def callback_finished(self, serial_thread_terminated):
-        if serial_thread_terminated:
+        # Threads replaced by set_devices can finish after the new ones have started
+        if self.sender() not in self.serial_threads:
+            return
+        self.status_timer.stop()
+        self.update_statuslabel(connection='Not connected', saving='Not saving records')
+
+    def callback_connected(self, port, device_version):
+        serial_thread = self.sender()
+        if serial_thread not in self.serial_threads:
+            return
+        if serial_thread.saving_records:
+            self.update_statuslabel(saving='Saving records')    
+        self.connected_ports[serial_thread] = port
+        self.update_connection_label()
+        self.statusbar.showMessage('Firmware version: {}'.format(device_version), 10000)
+        self.set_holdoff()
+        # If backpressure control has paused recording, the device stays paused until the controller restores it
+        backpressure = serial_thread.backpressure
+        paused = backpressure is not None and backpressure.engaged and backpressure.policy == 'pause'
+        serial_thread.write_command(prExtras.encode_settings(enable_record=not paused, enable_send_record=True))
+        if not self.status_timer.isActive():
+            self.status_timer.start()
+
+    def callback_disconnected(self, reason):
+        serial_thread = self.sender()
+        if serial_thread not in self.serial_threads:
+            return
+        self.connected_ports.pop(serial_thread, None)
+        self.status_versions = []
+        if not self.connected_ports:
             self.status_timer.stop()
-            self.ser.close()
-            self.update_statuslabel(connection='Not connected', saving='Not saving records')
-            self.connect_serial()
+        self.update_connection_label()
+
+    def update_connection_label(self):
+        ports = [self.connected_ports[serial_thread] for serial_thread in self.serial_threads if serial_thread in self.connected_ports]
+        if len(ports) == len(self.serial_threads):
+            self.update_statuslabel(connection='Connected to {}'.format(', '.join(ports)))
+        elif ports:
+            self.update_statuslabel(connection='Connected to {} ({} of {} devices)'.format(', '.join(ports), len(ports), len(self.serial_threads)))
+        else:
+            self.update_statuslabel(connection='Reconnecting...' if self.serial_thread.device_serial_number else 'Not connected')
     
     def callback_error(self, error):
         self.statusbar.showMessage(error, 5000)
 
     def callback_echo(self, message):
-        self.authantication_byte = message['echoed_byte']
         self.statusbar.showMessage('Firmware version: {}'.format(message['device_version']), 10000)
 
     def callback_easyprint(self, message):
@@ -299,17 +557,99 @@ class MainWindow(QtWidgets.QMainWindow, pulse_recorder_mainwindow_design.Ui_Main
     def callback_internalerror(self, message):
         pass
 
-    def callback_devicestatus(self, message):
-        current_rate = (message['counts_received'] - self.last_counts[0])/0.5 + (message['slots_used'] - self.last_counts[1])*2/0.5
-        self.last_counts = (message['counts_received'], message['slots_used'])
-        self.labelCountRateIndicator.setText('{:,} cps'.format(int(current_rate)))
-        self.labelSavedCounts.setText('{:,}'.format(message['saved_counts']))
-        self.labelMemoryIndicator.setText('{:,}\n/32,000,000'.format(message['slots_used']*2))
-        self.barMemoryIndicator.setValue(message['slots_used']/160000)
-        if message['bytes_dropped']:
-            self.statusbar.showMessage('Bytes dropped', 1000)
+    def callback_commandack(self, coalesce_key, success):
+        if not success:
+            self.statusbar.showMessage('Failed to send {} command'.format(coalesce_key if coalesce_key else 'a'), 5000)
+
+    def refresh_display(self):
+        # Called by the display timer at a fixed rate, however often the serial threads publish their status.
+        # Labels are only updated when a serial thread has published a new status since the last frame.
+        versions = [serial_thread.status_model.read() for serial_thread in self.serial_threads]
+        if [version for version, snapshot in versions] != self.status_versions:
+            self.status_versions = [version for version, snapshot in versions]
+            self.show_status([snapshot for version, snapshot in versions])
+        self.delta_histogram_view.redraw()
+        self.rate_history_view.redraw()
+
+    def show_status(self, snapshots):
+        # With several devices the rates and saved counts are totals, and the memory is that of the fullest device
+        connected = [snapshot for serial_thread, snapshot in zip(self.serial_threads, snapshots) if serial_thread in self.connected_ports and snapshot]
+        total_rate = sum(snapshot['count_rate'] for snapshot in connected)
+        total_saved_counts = sum(snapshot.get('saved_counts', 0) for snapshot in snapshots)
+        slots_used = max([snapshot['slots_used'] for snapshot in connected] + [0])
+        self.labelCountRateIndicator.setText('{:,} cps'.format(int(total_rate)))
+        self.labelSavedCounts.setText('{:,}'.format(total_saved_counts))
+        self.labelMemoryIndicator.setText('{:,}\n/32,000,000'.format(slots_used*2))
+        self.barMemoryIndicator.setValue(int(slots_used/160000))
+        for serial_thread, snapshot in zip(self.serial_threads, snapshots):
+            bytes_dropped_total = snapshot.get('bytes_dropped_total', 0)
+            bytes_dropped = bytes_dropped_total - self.last_bytes_dropped_total.get(serial_thread, 0)
+            self.last_bytes_dropped_total[serial_thread] = bytes_dropped_total
+            if bytes_dropped > 0:
+                port = self.connected_ports.get(serial_thread, '')
+                self.statusbar.showMessage('{} {:,} bytes dropped ({:,} dropped and {:,} resyncs in total)'.format(port, bytes_dropped, bytes_dropped_total, snapshot['resync_events']).strip(), 5000)
         
+class MetricsDialog(QtWidgets.QDialog):
+    ''' Shows the serial threads' HotPathMetrics, refreshed once a second while the dialog is open, with a plot
+    of the device FIFO slots used over the last hour. '''
+    def __init__(self, serial_threads, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Acquisition metrics')
+        self.serial_threads = serial_threads
+        self.textMetrics = QtWidgets.QPlainTextEdit()
+        self.textMetrics.setReadOnly(True)
+        self.textMetrics.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.plotSlotsUsed = prPlots.PlotWidget()
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.textMetrics)
+        layout.addWidget(QtWidgets.QLabel('Device FIFO slots used'))
+        layout.addWidget(self.plotSlotsUsed)
+        self.resize(560, 480)
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setInterval(1000)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
+    def set_serial_threads(self, serial_threads):
+        self.serial_threads = serial_threads
+        self.refresh()
+
+    def refresh(self):
+        self.plot_slots_used()
+        if len(self.serial_threads) == 1:
+            self.textMetrics.setPlainText(self.serial_threads[0].metrics.summary())
+            return
+        summaries = []
+        for device_idx, serial_thread in enumerate(self.serial_threads):
+            port = serial_thread.ser.port if serial_thread.ser is not None else 'not connected'
+            summaries.append('Device {} ({})\n{}'.format(device_idx, port, serial_thread.metrics.summary()))
+        self.textMetrics.setPlainText('\n\n'.join(summaries))
+
+    def plot_slots_used(self):
+        now = time.time()
+        histories = [np.array(serial_thread.metrics.slots_used_since(now - 3600), dtype=float).reshape(-1, 2) for serial_thread in self.serial_threads]
+        if not histories:
+            self.plotSlotsUsed.set_envelopes([], np.zeros(0), 'Minutes ago')
+            return
+        # Devices send status messages at different times, so each is shown against the times of the first
+        times = histories[0][:, 0]
+        envelopes = []
+        for device_idx, history in enumerate(histories):
+            if len(history) and len(times):
+                slots_used = np.interp(times, history[:, 0], history[:, 1])
+                envelopes.append(('{}:slots_used'.format(device_idx) if len(histories) > 1 else 'slots_used', slots_used, slots_used))
+        self.plotSlotsUsed.set_envelopes(envelopes, (times - now)/60, 'Minutes ago')
+
 def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     app = QtWidgets.QApplication(sys.argv)
     # app.setStyle('Fusion')
     # app.setStyle('Windows')
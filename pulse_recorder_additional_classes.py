@@ -1,11 +1,185 @@
-from PyQt5 import QtWidgets, QtCore, QtGui
+from PyQt5 import QtCore
 
-import h5py
 import serial
-import struct
+import serial.tools.list_ports
 import numpy as np
 import time
-from numba import jit
+import threading
+import itertools
+import collections
+import logging
+import concurrent.futures
+import types
+
+import pulse_recorder_storage as prStorage
+import pulse_recorder_metrics as prMetrics
+import pulse_recorder_plots as prPlots
+import pulse_recorder_protocol as prProtocol
+
+logger = logging.getLogger(__name__)
+
+# USB vendor and product ids of the Pulse Recorder's serial interface
+device_vid = 1027
+device_pid = 24592
+
+# Ports held by a SerialThread (or being probed by one), so that several threads can each find a different device
+claimed_ports = set()
+claimed_ports_lock = threading.Lock()
+
+# The messages sent to the device are encoded from the tables in pulse_recorder_protocol
+encode_echo = prProtocol.encode_echo
+encode_general_debug = prProtocol.encode_general_debug
+encode_settings = prProtocol.encode_settings
+msgin_identifier = prProtocol.identifiers_in
+msgout_identifier = prProtocol.identifiers_out
+
+# pulse_recorder_kernels, once load_kernels() has imported it. numba takes a while to import, so it isn't done at startup.
+prKernels = None
+
+
+class CommandQueue:
+    ''' Thread safe queue of encoded commands waiting to be written by the SerialThread.
+
+    Commands put with the same coalesce_key replace each other, so only the most recent one is written.
+    The replaced command keeps its place in the queue, and all of the callbacks given for it are called
+    once the command that replaced it has been written. Commands without a key are never coalesced.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = collections.OrderedDict()
+        self.uncoalesced_idx = itertools.count()
+
+    def put(self, encoded_command, coalesce_key=None, callback=None):
+        callbacks = [] if callback is None else [callback]
+        with self.lock:
+            if coalesce_key is None:
+                self.commands[('uncoalesced', next(self.uncoalesced_idx))] = (encoded_command, None, callbacks)
+            elif coalesce_key in self.commands:
+                self.commands[coalesce_key] = (encoded_command, coalesce_key, self.commands[coalesce_key][2] + callbacks)
+            else:
+                self.commands[coalesce_key] = (encoded_command, coalesce_key, callbacks)
+
+    def take_all(self):
+        ''' Returns a list of (encoded_command, coalesce_key, callbacks) and empties the queue. '''
+        with self.lock:
+            commands = list(self.commands.values())
+            self.commands.clear()
+        return commands
+
+
+class StatusModel:
+    ''' The latest status of a SerialThread, for the GUI to read whenever it likes (on its display timer).
+    Each publish replaces the snapshot with a new read-only dict and never changes a published one, so
+    readers don't need a lock however often the SerialThread publishes. '''
+    def __init__(self):
+        self.snapshot = types.MappingProxyType({})
+        self.version = 0
+
+    def publish(self, status):
+        self.snapshot = types.MappingProxyType(dict(status))
+        # Incremented after the snapshot is replaced, so a changed version always comes with a new snapshot
+        self.version += 1
+
+    def read(self):
+        ''' Returns (version, snapshot). The version changes each time there is a new snapshot. '''
+        version = self.version
+        return version, self.snapshot
+
+
+class BackpressureController:
+    ''' Watches the device memory (slots_used in the status messages) and steps in before it overflows.
+
+    It intervenes when slots_used reaches threshold (a fraction of the device memory), or earlier if the
+    smoothed trend says the memory will be full within lookahead seconds. What it does depends on policy:
+        'holdoff'   raises the holdoff time to holdoff_time (clock cycles, as for encode_settings) so fewer records are made.
+                    A holdoff already longer than that is kept.
+        'pause'     stops the device recording new records, so the backlog can drain.
+        'raw'       stops decoding and filtering on the host and saves the raw bytes instead (see decode_raw_capture).
+                    Status messages can't be seen while doing this, so it is held for raw_capture_hold seconds at a time.
+    Normal settings are restored once slots_used drops below restore_threshold. Each intervention is logged,
+    reported through the serial thread's error signal and stored as an event in the hdf file.
+    '''
+    fifo_slots = 16000000   # each slot holds 2 records
+    policies = ['holdoff', 'pause', 'raw']
+
+    def __init__(self, serial_thread, policy='holdoff', threshold=0.75, restore_threshold=0.1, lookahead=10.0, holdoff_time=198, raw_capture_hold=5.0, trend_smoothing=0.3):
+        if policy not in self.policies:
+            raise ValueError('policy must be one of {}'.format(self.policies))
+        self.serial_thread = serial_thread
+        self.policy = policy
+        self.threshold = threshold
+        self.restore_threshold = restore_threshold
+        self.lookahead = lookahead
+        self.holdoff_time = holdoff_time
+        self.raw_capture_hold = raw_capture_hold
+        self.trend_smoothing = trend_smoothing
+        self.engaged = False
+        self.engaged_at = 0
+        self.trend = 0.0
+        self.last_slots_used = None
+        self.last_update = None
+        self.interventions = 0
+
+    def update(self, slots_used):
+        ''' Called with each device status message. '''
+        now = time.perf_counter()
+        if self.last_slots_used is not None and now > self.last_update:
+            slope = (slots_used - self.last_slots_used)/(now - self.last_update)
+            self.trend = self.trend_smoothing*slope + (1 - self.trend_smoothing)*self.trend
+        self.last_slots_used = slots_used
+        self.last_update = now
+        if not self.engaged:
+            predicted_slots_used = slots_used + max(self.trend, 0)*self.lookahead
+            if slots_used >= self.threshold*self.fifo_slots or predicted_slots_used >= self.fifo_slots:
+                self.engage(slots_used)
+        elif slots_used <= self.restore_threshold*self.fifo_slots:
+            self.release(slots_used)
+
+    def update_raw(self):
+        ''' Called for each read while raw capturing, since no status messages are decoded then. '''
+        if self.engaged and time.perf_counter() - self.engaged_at >= self.raw_capture_hold:
+            # Go back to decoding. If the memory is still too full the next status message starts another capture
+            self.release(self.last_slots_used)
+
+    def engage(self, slots_used):
+        thread = self.serial_thread
+        if self.policy == 'holdoff':
+            thread.write_command(encode_settings(holdoff_time=self.raised_holdoff(thread.holdoff_time)), coalesce_key='holdoff')
+        elif self.policy == 'pause':
+            thread.write_command(encode_settings(enable_record=False), coalesce_key='record')
+        elif self.policy == 'raw':
+            if not thread.saving_records:
+                # Nothing is being written, so there is nothing to save time on
+                return
+            thread.record_writer.add_event('raw_capture', thread.record_writer.raw_position())
+            thread.raw_capture = True
+        self.engaged = True
+        self.engaged_at = time.perf_counter()
+        self.interventions += 1
+        thread.metrics.counters['backpressure_interventions'] += 1
+        self.report('Device memory at {:,} slots (trend {:+,.0f}/s): backpressure {} on'.format(slots_used, self.trend, self.policy), 'backpressure_on', slots_used)
+
+    def raised_holdoff(self, holdoff_time):
+        ''' The holdoff to send while stepped in, given the one set by the user (None if it hasn't been). '''
+        return self.holdoff_time if holdoff_time is None else max(self.holdoff_time, holdoff_time)
+
+    def release(self, slots_used):
+        thread = self.serial_thread
+        if self.policy == 'holdoff':
+            if thread.holdoff_time is not None:
+                thread.write_command(encode_settings(holdoff_time=thread.holdoff_time), coalesce_key='holdoff')
+        elif self.policy == 'pause':
+            thread.write_command(encode_settings(enable_record=True), coalesce_key='record')
+        elif self.policy == 'raw':
+            thread.raw_capture = False
+        self.engaged = False
+        self.report('Device memory at {:,} slots: backpressure {} off after {:.1f} s'.format(slots_used, self.policy, time.perf_counter() - self.engaged_at), 'backpressure_off', slots_used)
+
+    def report(self, text, event_kind, slots_used):
+        logger.info(text)
+        self.serial_thread.error.emit(text)
+        if self.serial_thread.record_writer:
+            self.serial_thread.record_writer.add_event(event_kind, slots_used)
 
 
 class SerialThread(QtCore.QThread):
@@ -15,47 +189,79 @@ class SerialThread(QtCore.QThread):
     devicestatus = QtCore.pyqtSignal(object)
     finished = QtCore.pyqtSignal(bool)
     error = QtCore.pyqtSignal(str)
-    def __init__(self, ser):
+    commandack = QtCore.pyqtSignal(object, bool)
+    connected = QtCore.pyqtSignal(str, str)
+    disconnected = QtCore.pyqtSignal(str)
+    def __init__(self, ser=None):
         super().__init__()
         self.alive = False
         self.serial_read_thread_terminated = False
+        # If ser is given and already open it is used as is, otherwise the thread finds a device itself
         self.ser = ser
-
-        self.status = {'saved_counts':0, 'slots_used':0, 'counts_received':0, 'bytes_dropped':False}
+        if ser is not None:
+            claim_ports([ser.port])
+        self.device_serial_number = None
+        self.device_version = ''
+        self.pending_data = b''
+        self.scan_interval = 1.0
+        self.reconnect_scan_interval = 0.01
+        self.reconnect_fast_scan_period = 5.0
+
+        self.status = {'saved_counts':0, 'slots_used':0, 'counts_received':0, 'bytes_dropped':0, 'bytes_dropped_total':0, 'resync_events':0, 'count_rate':0.0}
+        self.status_model = StatusModel()
+        # (host time, counts_received, slots_used) at the last status message, for the count rate
+        self.last_status_counts = None
         self.counts_received = 0
 
         self.enable_retention_interval_filter = False
         self.retention_interval = np.int64(1/5E-9)
         self.close_hdf_file = False
-        self.hdf_file = None
-        self.bytes_dropped = False
-        self.save_now = False
+        self.record_writer = None
+        self.rotation_policy = None
+        self.flush_policy = prStorage.FlushPolicy()
+        self.bytes_dropped = 0
+        self.bytes_dropped_total = 0
+        self.resync_events = 0
+        self.resync_frames = 3
+        self.holdoff_time = None
+        self.backpressure = None
+        # A new backpressure controller (in a list, since None turns it off) waiting for this thread to switch to it
+        self.pending_backpressure = None
+        self.backpressure_lock = threading.Lock()
+        self.raw_capture = False
         self.saving_records = False
         self.save_temp_when_done = False
-        self.dset_records_name = 'records'
-        self.dset_num_entries_name = 'total_entries'
         self.blocksize = 10000
         self.pad_byte = bytes(1)
         self.time_mask = 2**52-1
         self.request_status_encoded_command = encode_settings(request_status=True) #A tiny time saver so I don't have to encode each call
+        self.command_queue = CommandQueue()
+        self.metrics = prMetrics.HotPathMetrics()
+        self.metrics_exporter = None
+        # When recording from several devices: 'groups' puts each device in its own group of the file, 'files'
+        # in its own file. None keeps the single device layout (records at the top of the file).
+        self.device_layout = None
+        # Host time the pulse timer was last zeroed, recorded in the file so devices zeroed together can be lined up
+        self.zero_timer_time = None
+        # Live histograms of the time between pulses, filled from every record received
+        self.delta_histogram = prPlots.DeltaHistogram()
+        # Pulses received on each channel, and the history of count rates worked out from them at each status message
+        self.channel_counts = np.zeros(4, dtype=np.int64)
+        self.rate_history = prPlots.RateHistory()
+        # A pulse_recorder_server.RecordServer to hand the records to as they are decoded, and this device's index in it
+        self.record_server = None
+        self.device_index = 0
 
     def update_status(self):
-        self.save_now = True
-        self.write_command(self.request_status_encoded_command)
+        self.write_command(self.request_status_encoded_command, coalesce_key='request_status')
 
     def start_saving(self, file_directory):
-        self.hdf_file = h5py.File(str(file_directory), 'a')
-        record_types = [ ('time', np.int64), ('ch0', np.uint8), ('ch1', np.uint8), ('ch2', np.uint8), ('ch3', np.uint8)]
-        if self.dset_records_name in self.hdf_file:
-            self.dset_records = self.hdf_file[self.dset_records_name]
-            self.dset_num_entries = self.hdf_file[self.dset_num_entries_name]
-        else:
-            self.dset_records = self.hdf_file.create_dataset(self.dset_records_name, shape=(self.blocksize,), dtype=record_types, maxshape=(None,), chunks=True)
-            self.dset_num_entries = self.hdf_file.create_dataset(self.dset_num_entries_name, shape=(1,), dtype=np.int64)
-
-        # self.temp_data = np.empty((self.blocksize, 5), dtype=np.int64)
-        self.temp_data = np.empty(self.blocksize, dtype=record_types)
-        self.temp_data_idx = 0
+        path, group_name = prStorage.device_record_location(file_directory, self.device_serial_number, self.device_layout, self.rotation_policy)
+        attrs = {'device_serial_number':str(self.device_serial_number), 'device_version':self.device_version}
+        self.record_writer = prStorage.RecordWriter(path, self.blocksize, self.rotation_policy, self.flush_policy, metrics=self.metrics, group_name=group_name, attrs=attrs)
+        if self.zero_timer_time is not None:
+            self.record_writer.add_event('zero_timer', self.zero_timer_time)
+        self.status['saved_counts'] = self.record_writer.saved_counts
         self.saving_records = True
         self.file_directory = file_directory
         self.save_temp_when_done = True
@@ -64,347 +270,384 @@ class SerialThread(QtCore.QThread):
         self.saving_records = False
         self.close_hdf_file = True
 
-    def add_data_to_dataset(self, new_data, num_new_entries, dset_records, dset_num_entries, blocksize=10000):
-        num_current_entries = dset_num_entries[0]
-        free_space = dset_records.size - num_current_entries
-        if num_new_entries > free_space:
-            dset_records.resize(dset_records.size + max(blocksize, num_new_entries) , axis=0)
-        #### THIS MIGHT BE WHERE THE OFF BY ONE ERROR IS THAT ANDY WAS SEEING, WHICH RESULTED IN OCCASSIONAL LINES OF ZEROS IN THE DATASETS
-        new_total_entries = num_current_entries + num_new_entries
-        dset_records[num_current_entries:new_total_entries] = new_data[:num_new_entries]
-        dset_num_entries[0] = new_total_entries
-        self.status['saved_counts'] = new_total_entries
+    def set_holdoff(self, holdoff_time):
+        ''' Sets the holdoff time (in clock cycles, as for encode_settings). While backpressure control has
+        raised the holdoff, the device is only given a holdoff at least as long as the raised one, and the new
+        value itself once the backpressure controller restores it. '''
+        self.holdoff_time = holdoff_time
+        backpressure = self.backpressure
+        if backpressure and backpressure.engaged and backpressure.policy == 'holdoff':
+            # A longer holdoff still goes straight to the device, since it makes fewer records too
+            holdoff_time = backpressure.raised_holdoff(holdoff_time)
+        self.write_command(encode_settings(holdoff_time=holdoff_time), coalesce_key='holdoff')
+
+    def set_backpressure(self, backpressure):
+        ''' Switches to a new BackpressureController, or turns backpressure control off if backpressure is None.
+        Safe to call from any thread. The switch is made by this thread between serial reads (see apply_backpressure),
+        since the controller is used, and writes to the hdf file, from here. '''
+        with self.backpressure_lock:
+            self.pending_backpressure = [backpressure]
+
+    def apply_backpressure(self):
+        with self.backpressure_lock:
+            pending_backpressure = self.pending_backpressure
+            self.pending_backpressure = None
+        if pending_backpressure is None:
+            return
+        # Restore the normal settings before the old controller is dropped
+        if self.backpressure and self.backpressure.engaged:
+            self.backpressure.release(self.backpressure.last_slots_used)
+        self.backpressure = pending_backpressure[0]
+
+    def zero_timer(self):
+        ''' Zeroes the device's pulse timer without waiting for the current serial read to time out. '''
+        self.write_command(encode_settings(zero_pulse_timer=True), coalesce_key='zero_timer', callback=self.zero_timer_sent)
+        self.wake()
+
+    def zero_timer_sent(self, success):
+        if success:
+            self.zero_timer_time = time.time()
+            if self.record_writer:
+                self.record_writer.add_event('zero_timer', self.zero_timer_time)
+
+    def close_hdf(self):
+        if self.record_writer:
+            self.record_writer.close()
+            self.status['saved_counts'] = self.record_writer.saved_counts
+            self.record_writer = None
+
+    def connect_device(self, reconnecting=False):
+        ''' Probes every port that looks like a Pulse Recorder at once and keeps the first one that authenticates.
+        When reconnecting, only ports with the serial number of the lost device are tried, and the serial
+        buffers are not reset so nothing the device sends after the reconnect is thrown away.
+        Ports held by other SerialThreads are skipped, and the ports being probed are claimed until
+        probing is done, so each thread ends up with a different device.
+        Returns the bytes read while authenticating (to be decoded as normal), or None if no device was found.'''
+        comports = find_device_ports(self.device_serial_number if reconnecting else None)
+        comports = claim_ports(comports)
+        found_devices = probe_ports(comports, reset_buffers=not reconnecting)
+        if not found_devices:
+            release_ports(comport.device for comport in comports)
+            return None
+        comport, ser, device_version, received_data = found_devices[0]
+        for _, other_ser, _, _ in found_devices[1:]:
+            other_ser.close()
+        release_ports(other.device for other in comports if other.device != comport.device)
+        self.ser = ser
+        self.device_serial_number = comport.serial_number
+        self.device_version = device_version
+        return received_data
+
+    def write_command(self, encoded_command, coalesce_key=None, callback=None):
+        ''' Queues a command to be written by this thread between serial reads. Safe to call from any thread.
+        callback(success) is called from this thread once the command has been written (or failed to be).
+        The commandack signal is also emitted with the coalesce_key, so the GUI can react to failures.'''
+        self.command_queue.put(encoded_command, coalesce_key, callback)
+
+    def service_commands(self):
+        commands = self.command_queue.take_all()
+        for command_idx, (encoded_command, coalesce_key, callbacks) in enumerate(commands):
+            try:
+                self.ser.write(encoded_command)
+                success = True
+            except serial.SerialTimeoutException:
+                success = False
+            except serial.serialutil.SerialException:
+                # The port is gone. Report every command that won't be written, then let run() deal with it
+                for encoded_command, coalesce_key, callbacks in commands[command_idx:]:
+                    self.acknowledge_command(coalesce_key, callbacks, False)
+                raise
+            self.acknowledge_command(coalesce_key, callbacks, success)
+
+    def acknowledge_command(self, coalesce_key, callbacks, success):
+        for callback in callbacks:
+            callback(success)
+        self.commandack.emit(coalesce_key, success)
+
+    def wake(self):
+        ''' Interrupts a serial read in progress, so queued commands are written without waiting for the read
+        timeout. Used for commands that several devices should get at nearly the same time, like zeroing the timer.'''
+        if self.ser is not None and self.ser.is_open:
+            try:
+                self.ser.cancel_read()
+            except (AttributeError, serial.serialutil.SerialException):
+                pass
 
-    def write_command(self, encoded_command):
-        self.ser.write(encoded_command)
+    def start(self):
+        # Set here rather than in run(), so a stop() straight after start() isn't undone when run() begins
+        self.alive = True
+        super().start()
 
     def stop(self):
         self.alive = False
 
     def run(self):
+        # Before looking for a device, so the decoder is ready when it starts sending
+        load_kernels()
+        self.metrics.mark('kernels_ready')
         if self.saving_records:
             self.start_saving(self.file_directory)
 
-        self.alive = True
         self.serial_thread_terminated = False
         remaining_data = np.array((), dtype=np.uint8)
+        in_sync = True
 
         last_record = np.zeros(5, dtype=np.int64)
         last_record_save = 0
+        disconnected_at = None
+        if self.ser is not None and self.ser.is_open:
+            self.metrics.mark('connected')
+            self.connected.emit(self.ser.port, self.device_version)
         while self.alive:
-            try:
-                new_data = self.ser.read(4000)
-            except serial.serialutil.SerialException as ex:
-                self.alive = False
-                self.serial_thread_terminated = True
-                self.error.emit(str(ex))
-                break
-            new_data_arr = np.array(list(new_data), dtype=np.uint8)
-            records, records_idx, other_messages, other_messages_idx, remaining_data, out_of_sync = quick_decode(remaining_data, new_data_arr)
-            if out_of_sync:
-                self.bytes_dropped = True
+            self.apply_backpressure()
+            if self.ser is None or not self.ser.is_open:
+                received_data = self.connect_device(reconnecting=disconnected_at is not None)
+                if received_data is None:
+                    if disconnected_at is not None and time.perf_counter() - disconnected_at < self.reconnect_fast_scan_period:
+                        time.sleep(self.reconnect_scan_interval)
+                    else:
+                        time.sleep(self.scan_interval)
+                    continue
+                if disconnected_at is not None:
+                    gap = time.perf_counter() - disconnected_at
+                    logger.info('Reconnected to %s after %.1f ms', self.ser.port, gap*1E3)
+                    self.error.emit('Reconnected after {:.1f} ms'.format(gap*1E3))
+                    if self.record_writer:
+                        self.record_writer.add_event('reconnect', gap)
+                    disconnected_at = None
+                # Any partial message left over belongs to the old connection
+                remaining_data = np.array((), dtype=np.uint8)
+                in_sync = True
+                self.pending_data = received_data
+                self.metrics.mark('connected')
+                self.connected.emit(self.ser.port, self.device_version)
+            if self.pending_data:
+                # quick_decode can only take about 4000 bytes at a time
+                new_data = self.pending_data[:4000]
+                self.pending_data = self.pending_data[4000:]
+            else:
+                try:
+                    self.service_commands()
+                    with self.metrics.timers['read']:
+                        new_data = self.ser.read(4000)
+                except serial.serialutil.SerialException as ex:
+                    # Keep the hdf file open and go straight back to looking for the same device
+                    disconnected_at = time.perf_counter()
+                    self.ser.close()
+                    release_ports([self.ser.port])
+                    self.last_status_counts = None
+                    self.status['count_rate'] = 0.0
+                    self.status_model.publish(self.status)
+                    logger.warning('Lost connection to %s: %s', self.ser.port, ex)
+                    self.error.emit(str(ex))
+                    self.disconnected.emit(str(ex))
+                    continue
+            self.metrics.bytes_per_read.add(len(new_data))
+            self.metrics.counters['bytes_read'] += len(new_data)
+            if self.raw_capture and self.saving_records:
+                # Backpressure: store the bytes as they are, to be decoded later with decode_raw_capture.
+                # Any partial message the decoder was holding on to goes first, so it isn't lost.
+                if remaining_data.size:
+                    self.record_writer.add_raw(remaining_data.tobytes())
+                self.record_writer.add_raw(new_data)
+                self.backpressure.update_raw()
+                # Where decoding picks up again is arbitrary, so make the decoder find its place
+                remaining_data = np.array((), dtype=np.uint8)
+                in_sync = False
+                continue
+            with self.metrics.timers['quick_decode']:
+                new_data_arr = np.array(list(new_data), dtype=np.uint8)
+                records, records_idx, other_messages, other_messages_idx, remaining_data, bytes_discarded, resync_events, in_sync = prKernels.quick_decode(remaining_data, new_data_arr, in_sync, self.resync_frames)
+            if bytes_discarded:
+                self.bytes_dropped += bytes_discarded
+                self.bytes_dropped_total += bytes_discarded
+                self.metrics.counters['bytes_discarded'] += bytes_discarded
+                if self.record_writer:
+                    self.record_writer.add_event('sync_loss', bytes_discarded)
+            if resync_events:
+                self.resync_events += resync_events
+                self.metrics.counters['resync_events'] += resync_events
 
             if records_idx:
+                if 'first_record' not in self.metrics.milestones:
+                    self.metrics.mark('first_record')
+                    logger.info('First record %.0f ms after the program started', self.metrics.milestone_seconds('first_record')*1E3)
                 self.counts_received += records_idx
+                self.metrics.counters['records_received'] += records_idx
+                if self.delta_histogram:
+                    self.delta_histogram.add_records(records, records_idx)
+                self.channel_counts += records[:records_idx, 1:5].sum(axis=0)
+                if self.record_server:
+                    self.record_server.publish(records, records_idx, self.device_index)
 
                 if self.saving_records:
+                    self.record_writer.add_to_rate_pyramid(records, records_idx)
                     # Decide here which records will be saved.
                     # create a new array which as the first column be save/not save. The last record of records will always be added as the first entry of
                     # savecheck_array, whether it has been determined to be saved or not. 
                     # I don't like this way of doing it, because I am creating extra arrays, and shuffeling data around when I don't need to. But It seems to work and I don't care enough.
                     if self.enable_retention_interval_filter:
-                        records, records_idx, last_record, last_record_save = savecheck(last_record, last_record_save, records, records_idx, self.retention_interval)
-
-
-                    self.temp_data['time'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 0]
-                    self.temp_data['ch0'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 1]
-                    self.temp_data['ch1'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 2]
-                    self.temp_data['ch2'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 3]
-                    self.temp_data['ch3'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 4]
-                    self.temp_data_idx += records_idx
-                    # if the next data dump can possibly overflow the temp_data, then clear the temp data now. the max records in the buffer is about 530
-                    if self.temp_data_idx + 550 > self.temp_data.size or self.save_now:
-                        #### THIS MIGHT BE WHERE THE OFF BY ONE ERROR IS THAT ANDY WAS SEEING, WHICH RESULTED IN OCCASSIONAL LINES OF ZEROS IN THE DATASETS
-                        self.add_data_to_dataset(self.temp_data, self.temp_data_idx, self.dset_records, self.dset_num_entries, self.blocksize)
-                        self.temp_data_idx = 0
-                        self.save_now = False
-                        self.hdf_file.flush()
+                        with self.metrics.timers['savecheck']:
+                            records, records_idx, last_record, last_record_save = prKernels.savecheck(last_record, last_record_save, records, records_idx, self.retention_interval)
+
+
+                    with self.metrics.timers['append']:
+                        self.record_writer.append(records, records_idx)
+            if self.saving_records:
+                if self.record_writer.flush_if_due():
+                    self.status['saved_counts'] = self.record_writer.saved_counts
+            if self.metrics_exporter:
+                self.metrics_exporter.write_if_due()
             if other_messages_idx:
-                for message_arr in other_messages[:other_messages_idx]:
-                    message_identifier = message_arr[0]
-                    message_bytes = bytes(message_arr[1:msgin_decodeinfo[message_identifier]['message_length']])
-                    message = msgin_decodeinfo[message_identifier]['decode_function'](message_bytes)
-                    if message_identifier == msgin_identifier['devicestatus']:
-                        self.status['counts_received'] = self.counts_received
-                        self.status['bytes_dropped'] = self.bytes_dropped
-                        self.bytes_dropped = False
-                        self.status.update(message)
-                        self.devicestatus.emit(self.status)
-                    elif message_identifier == msgin_identifier['error']:
-                        self.internal_error.emit(message)
-                    elif message_identifier == msgin_identifier['echo']:
-                        self.serialecho.emit(message)
-                    elif message_identifier == msgin_identifier['print']:
-                        self.easyprint.emit(message)
+                # Each type of message is decoded in one go. Only the latest status matters, as they are cumulative.
+                decoded_messages = prProtocol.decode_messages(other_messages[:other_messages_idx])
+                if 'devicestatus' in decoded_messages:
+                    message = prProtocol.last_message(decoded_messages['devicestatus'])
+                    self.status['counts_received'] = self.counts_received
+                    self.status['bytes_dropped'] = self.bytes_dropped
+                    self.status['bytes_dropped_total'] = self.bytes_dropped_total
+                    self.status['resync_events'] = self.resync_events
+                    self.bytes_dropped = 0
+                    self.status.update(message)
+                    # Records received, plus the change in records waiting in the device (2 per slot)
+                    status_time = time.perf_counter()
+                    if self.last_status_counts is not None and status_time > self.last_status_counts[0]:
+                        last_time, last_counts_received, last_slots_used, last_channel_counts = self.last_status_counts
+                        self.status['count_rate'] = ((self.counts_received - last_counts_received) + (message['slots_used'] - last_slots_used)*2)/(status_time - last_time)
+                        # Channel rates are of the records received, since the device doesn't say which channels the waiting ones are on
+                        channel_rates = (self.channel_counts - last_channel_counts)/(status_time - last_time)
+                        self.rate_history.add_sample(time.time(), np.concatenate(([self.status['count_rate']], channel_rates)))
+                    self.last_status_counts = (status_time, self.counts_received, message['slots_used'], self.channel_counts.copy())
+                    self.metrics.add_slots_used(message['slots_used'])
+                    if self.backpressure:
+                        self.backpressure.update(message['slots_used'])
+                    self.status_model.publish(self.status)
+                    self.devicestatus.emit(self.status_model.snapshot)
+                for message in prProtocol.message_rows(decoded_messages.get('error', {})):
+                    self.internal_error.emit(message)
+                for message in prProtocol.message_rows(decoded_messages.get('echo', {})):
+                    self.serialecho.emit(message)
+                for message in prProtocol.message_rows(decoded_messages.get('print', {})):
+                    self.easyprint.emit(message)
             # Close the hdf file if not saving records so the file itself can be modified externally
             if not self.saving_records:
                 if self.close_hdf_file:
-                    if self.hdf_file: 
-                        self.hdf_file.close()
+                    self.close_hdf()
                     self.close_hdf_file = False
-        if self.hdf_file: 
-            self.hdf_file.close()
+        self.close_hdf()
+        if self.ser is not None:
+            self.ser.close()
+            release_ports([self.ser.port])
         self.finished.emit(self.serial_thread_terminated)
         
-@jit(nopython=True, cache=True)
-def savecheck(last_record, last_record_save, records, records_idx, retention_interval):
-    save_array = np.zeros((600, 6), dtype=np.int64)
-    save_array[0, 1:] = last_record
-    if last_record_save:
-        save_array[0, 0] = 1
-    save_array[1:records_idx + 1, 1:] = records[:records_idx]
-    for idx in range(1, records_idx):
-        if save_array[idx, 1] - save_array[idx-1, 1] <= retention_interval:
-            save_array[idx-1, 0] = 1
-            save_array[idx, 0] = 1
-    save_idxs = (save_array[:, 0] == 1)
-    last_record = records[records_idx]
-    last_record_save = save_array[idx, 0]
-    saved_records = save_idxs.sum()
-    return save_array[save_idxs, 1:], saved_records, last_record, last_record_save
-
-@jit(nopython=True, cache=True)
-def quick_decode(remaining_data, new_data):
-    #both inputs are arrays
-    data = np.concatenate((remaining_data, new_data))#.astype(np.int64)
-    records_idx = 0
-    records = np.zeros((600, 5), dtype=np.int64)
-    other_messages_idx = 0
-    other_messages = np.zeros((20, 9), dtype=np.uint8)
-    out_of_sync = False
-    N = data.size
-    idx = 0
-    # find out how many bytes are in the message
-    if N != 0:
-        while True:
-            key = data[idx]
-            idx += 1
-            if key == 204:
-                message_bytes = 14
-            elif key == 203:
-                message_bytes = 4
-            elif key == 201:
-                message_bytes = 8
-            elif key == 200:
-                message_bytes = 2
-            elif key == 202:
-                message_bytes = 8
-            else:
-                # If out of sync, just discard bytes until a valid key is found.
-                out_of_sync = True
-                if idx == N:
-                    break
-                else:
-                    continue
-            #Check if the whole message is in the remaining array
-            if idx + message_bytes > N:
-                idx -= 1 #set the index back one so the key is included in the remaining data
-                break
-            #Read the whole message
-            message = data[idx:idx+message_bytes]
-            idx += message_bytes
-
-            if key == 204:
-                records[records_idx, 1] = (message[6] >> 4) & 0b1
-                records[records_idx, 2] = (message[6] >> 5) & 0b1
-                records[records_idx, 3] = (message[6] >> 6) & 0b1
-                records[records_idx, 4] = (message[6] >> 7) & 0b1
-                records[records_idx, 0] = (int(message[6] & 0b00001111) << 48) | (int(message[5]) << 40) | (int(message[4]) << 32) | (int(message[3]) << 24) | (int(message[2]) << 16) | (int(message[1]) << 8) | int(message[0])
-                records_idx += 1
-                records[records_idx, 1] = (message[13] >> 4) & 0b1
-                records[records_idx, 2] = (message[13] >> 5) & 0b1
-                records[records_idx, 3] = (message[13] >> 6) & 0b1
-                records[records_idx, 4] = (message[13] >> 7) & 0b1
-                records[records_idx, 0] = (int(message[13] & 0b00001111) << 48) | (int(message[12]) << 40) | (int(message[11]) << 32) | (int(message[10]) << 24) | (int(message[9]) << 16) | (int(message[8]) << 8) | int(message[7])
-                records_idx += 1
-            else:
-                other_messages[other_messages_idx, 0] = key
-                other_messages[other_messages_idx, 1:message_bytes+1] = message[:message_bytes]
-                if other_messages_idx < 19:
-                    other_messages_idx += 1
-            # If the data array was the perfect length, return
-            if idx == N:
-                break
-    return records, records_idx, other_messages, other_messages_idx, data[idx:], out_of_sync
-
-def decode_internal_error(message):
-    ''' Messagein identifier:  1 byte: 200
-    Message format:                     BITS USED   FPGA INDEX.
-    tags:               1 byte  [0]     2 bits      [0+:2]      unsigned int.
-        invalid_identifier_received     1 bit       [0]
-        timeout_waiting_for_full_msg    1 bit       [1]  
-        received_message_not_forwarded  1 bit       [2]  
-    error information:  1 byte  [1]     8 bits      [8+:8]     unsigned int.
-
-    The 'error_info' represents the "device_index" for the received message, which basically says where the meassage should have headed in the FPGA.
-    '''
-    tags, =         struct.unpack('<Q', message[0:1] + bytes(7))
-    error_info, =   struct.unpack('<Q', message[1:2] + bytes(7))
-    invalid_identifier_received_tag =       (tags >> 0) & 0b1        
-    timeout_waiting_for_msg_tag =           (tags >> 1) & 0b1     
-    received_message_not_forwarded_tag =    (tags >> 2) & 0b1 
-    invalid_identifier_received =       decode_lookup['invalid_identifier'][invalid_identifier_received_tag]
-    timeout_waiting_for_msg =           decode_lookup['msg_receive_timeout'][timeout_waiting_for_msg_tag]
-    received_message_not_forwarded =    decode_lookup['msg_not_forwarded'][received_message_not_forwarded_tag]
-    return {'invalid_identifier_received':invalid_identifier_received, 'timeout_waiting_to_receive_message':timeout_waiting_for_msg, 'received_message_not_forwarded':received_message_not_forwarded, 'error_info':error_info}
-
-def decode_serialecho(message):
-    ''' Messagein identifier:  1 byte: 201
-    Message format:                     BITS USED   FPGA INDEX.
-    echoed byte:        1 bytes [0:1]   8 bits      [0+:8]     
-    device version:     7 bytes [1:8]   56 bits     [8+:56]    '''
-    echoed_byte = message[0:1]
+def decode_raw_capture(hdf_file):
+    ''' Decodes the 'raw_capture' dataset written while the backpressure controller was in 'raw' mode.
+    Each capture starts at the offset given by a 'raw_capture' event and is decoded separately.
+    Returns an (N, 5) array of records (time, ch0, ch1, ch2, ch3).'''
+    load_kernels()
+    dset_raw = hdf_file['raw_capture']
+    num_bytes = int(dset_raw.attrs.get('num_bytes', dset_raw.size))
+    events = hdf_file['events'][...]
+    starts = sorted(int(event['value']) for event in events if event['kind'] == b'raw_capture')
+    boundaries = [start for start in starts if start < num_bytes] + [num_bytes]
+    decoded = [np.zeros((0, 5), dtype=np.int64)]
+    for capture_start, capture_end in zip(boundaries[:-1], boundaries[1:]):
+        remaining_data = np.array((), dtype=np.uint8)
+        in_sync = False
+        for chunk_start in range(capture_start, capture_end, 4000):
+            new_data_arr = dset_raw[chunk_start:min(chunk_start + 4000, capture_end)]
+            records, records_idx, other_messages, other_messages_idx, remaining_data, bytes_discarded, resync_events, in_sync = prKernels.quick_decode(remaining_data, new_data_arr, in_sync)
+            decoded.append(records[:records_idx].copy())
+    return np.concatenate(decoded)
+
+def load_kernels():
+    ''' Imports pulse_recorder_kernels (and so numba) and warms up the kernels, if that hasn't been done yet.
+    Takes a second or more the first time, so it is called from the SerialThreads rather than at startup. '''
+    global prKernels
+    import pulse_recorder_kernels
+    pulse_recorder_kernels.warm_up()
+    prKernels = pulse_recorder_kernels
+    prPlots.prKernels = pulse_recorder_kernels
+
+def claim_ports(comports):
+    ''' Claims the comports (ListPortInfo objects or port names) not already claimed and returns those. '''
+    claimed = []
+    with claimed_ports_lock:
+        for comport in comports:
+            port = getattr(comport, 'device', comport)
+            if port not in claimed_ports:
+                claimed_ports.add(port)
+                claimed.append(comport)
+    return claimed
+
+def release_ports(ports):
+    with claimed_ports_lock:
+        for port in ports:
+            claimed_ports.discard(port)
+
+def holdoff_setting(holdoff_time):
+    ''' Returns (cycles, setting) for a holdoff time in seconds. cycles is the holdoff in 5 ns clock cycles, kept
+    between 10 ns and 1.3 s, and setting is what to send as holdoff_time in encode_settings, since the device
+    holds off for 2 cycles more than it is sent. '''
+    cycles = round(min(max(holdoff_time, 10E-9), 1.3)/5E-9)
+    return cycles, int(cycles - 2)
+
+def find_device_ports(serial_number=None):
+    ''' Returns the comports with the Pulse Recorder's USB vid and pid, optionally only those with the given serial number. '''
+    comports = []
+    for comport in serial.tools.list_ports.comports():
+        if comport.vid == device_vid and comport.pid == device_pid:
+            if serial_number is None or comport.serial_number == serial_number:
+                comports.append(comport)
+    return comports
+
+def probe_port(comport, auth_timeout=0.25, reset_buffers=True):
+    ''' Opens the port, sends a random byte to echo and waits for a Pulse Recorder to echo it back.
+    Returns (ser, device_version, received_data) with the port left open, or None. received_data is
+    everything read from the port while waiting, which may include records.'''
+    ser = serial.Serial()
+    ser.port = comport.device
+    ser.baudrate = 12000000
+    ser.timeout = 0.01
+    ser.writeTimeout = 1
+    ser.exclusive = True
     try:
-        device_version = message[1:8].decode()
-        unprintable_byte = False
-    except UnicodeDecodeError as err:
-        device_version = message[1:8].decode(errors='ignore')
-        unprintable_byte = True
-    return {'echoed_byte':echoed_byte, 'device_version':device_version, 'unprintable_byte':unprintable_byte}
-
-def decode_easyprint(message):
-    ''' Messagein identifier:  1 byte: 202
-    Message format:                     BITS USED   FPGA INDEX.
-    printed message:    8 bytes [0:3]   64 bits     [0+:64]     '''
-    binary_representation = []
-    for letter in message[::-1]:
-        binary_representation.append('{:08b} '.format(letter))
-    return {'printed':''.join(binary_representation)}
-
-def decode_pulserecord(message):
-    ''' Messagein identifier:  1 byte: 204
-    Message format:                     BITS USED   FPGA INDEX.
-    record A:           7 bytes [0:7]   56 bits     [0+:56]     unsigned int.
-        record time                     52 bits     [0+:52]     unsigned int.
-        channel 0 tag                   1 bit       [52]
-        channel 1 tag                   1 bit       [53]
-        channel 2 tag                   1 bit       [54]
-        channel 3 tag                   1 bit       [55]
-    record B:           7 bytes [7:14]  56 bits     [56+:56]     unsigned int.
-        record time                     52 bits     [56+:52]     unsigned int.
-        channel 0 tag                   1 bit       [108]
-        channel 1 tag                   1 bit       [109]
-        channel 2 tag                   1 bit       [110]
-        channel 3 tag                   1 bit       [111]
-    '''
-    record_A, = struct.unpack('<Q', message[0:7] + bytes(1))
-    record_A_time = record_A & 2**52-1 # mask of 52 1's
-    record_A_ch0_tag = (record_A >> 52) & 0b1  
-    record_A_ch1_tag = (record_A >> 53) & 0b1  
-    record_A_ch2_tag = (record_A >> 54) & 0b1  
-    record_A_ch3_tag = (record_A >> 55) & 0b1
-    record_B, = struct.unpack('<Q', message[7:14] + bytes(1))      
-    record_B_time = record_B & 2**52-1 # mask of 52 1's
-    record_B_ch0_tag = (record_B >> 52) & 0b1  
-    record_B_ch1_tag = (record_B >> 53) & 0b1  
-    record_B_ch2_tag = (record_B >> 54) & 0b1  
-    record_B_ch3_tag = (record_B >> 55) & 0b1  
-    return (record_A_time, record_A_ch0_tag, record_A_ch1_tag, record_A_ch2_tag, record_A_ch3_tag), (record_B_time, record_B_ch0_tag, record_B_ch1_tag, record_B_ch2_tag, record_B_ch3_tag)
-    # return {'record_A:':[record_A_time, record_A_ch0_tag, record_A_ch1_tag, record_A_ch2_tag, record_A_ch3_tag], 'record_B:':[record_B_time, record_B_ch0_tag, record_B_ch1_tag, record_B_ch2_tag, record_B_ch3_tag]}
-
-def decode_devicestatus(message):
-    ''' Messagein identifier:  1 byte: 203
-    Message format:                     BITS USED   FPGA INDEX.
-    FIFO_slots_used:      bytes [0:3]   25 bits     [0+:25]     unsigned int.
-    '''
-    slots_used, = struct.unpack('<Q', message[0:4] + bytes(4))
-    return {'slots_used':slots_used}
-
-#### encode
-def encode_echo(byte_to_echo):
-    ''' Messageout identifier:  1 byte: 150
-    Message format:                             BITS USED   FPGA INDEX.
-    byte_to_echo:               1 byte  [0:18]  8 bits     [0+:8]  
-    '''    
-    message_identifier = struct.pack('B', msgout_identifier['echo'])
-    return message_identifier + byte_to_echo
-
-def encode_general_debug(message):
-    ''' Messageout identifier:  1 byte: 151
-    Message format:                             BITS USED   FPGA INDEX.
-    general_putpose_input:      8 bytes [0:8]   64 bits     [0+:64]     unsigned int.
-    '''
-    message_identifier =    struct.pack('B', msgout_identifier['general_input'])
-    message =               struct.pack('<Q', message)[:8]
-    return message_identifier + message
-
-def encode_settings(enable_record=None, enable_send_record=None, holdoff_time=None, request_status=False, purge_memory=False, zero_pulse_timer=False, reset_device=False):
-    ''' Messageout identifier:  1 byte: 152
-    Message format:                             BITS USED   FPGA INDEX.
-    Tag_settings:               1 byte  [0]     8 bits      [0+:8]       unsigned int.
-        enable_record                           1bit        [0]
-        update_enable_record                    1bit        [1]
-        enable_send_record                      1bit        [2]
-        update_enable_send_record               1bit        [3]
-        request_status                          1bit        [4]
-        purge_memory                            1bit        [5]
-        zero_pulse_timer                        1bit         [6]
-        reset_device                            1bit        [7]
-    holdoff_time                4 bytes         28bits      [7+:28]
-        update_holdoff_time                     1bit        [35]
-
-    Note, this is now a mix of setting and action requests.
-    '''
-    holdoff_time_val = 0
-    if holdoff_time         is not None: holdoff_time_val = holdoff_time | (1 << 28)
-    enable_record_tag       = encode_lookup['enable_record'][enable_record] << 0
-    enable_send_record_tag  = encode_lookup['enable_send_record'][enable_send_record] << 2
-    request_status_tag      = encode_lookup['request_status'][request_status] << 4
-    purge_memory_tag        = encode_lookup['purge_memory'][purge_memory] << 5
-    zero_pulse_timer_tag    = encode_lookup['zero_pulse_timer'][zero_pulse_timer] << 6
-    reset_device_tag        = encode_lookup['reset_device'][reset_device] << 7
-    tags = enable_record_tag | enable_send_record_tag | request_status_tag | purge_memory_tag | zero_pulse_timer_tag | reset_device_tag
-    message_identifier =    struct.pack('B', msgout_identifier['settings'])
-    tags =                  struct.pack('<Q', tags)[:1]
-    holdoff_time =          struct.pack('<Q', holdoff_time_val)[:4]
-    return message_identifier + tags + holdoff_time
-
-
-msgin_decodeinfo = {
-    200:{'message_length':3, 'decode_function':decode_internal_error},
-    201:{'message_length':9, 'decode_function':decode_serialecho},
-    202:{'message_length':9, 'decode_function':decode_easyprint},
-    203:{'message_length':5, 'decode_function':decode_devicestatus},
-    204:{'message_length':15, 'decode_function':decode_pulserecord}}
-
-msgin_identifier = {
-    'error':200,
-    'echo':201,
-    'print':202,
-    'devicestatus':203,
-    'pulserecord':204}
-
-decode_lookup = {
-    'invalid_identifier':{1:True, 0:False},
-    'msg_not_forwarded':{1:True, 0:False},
-    'msg_receive_timeout':{1:True, 0:False}
-}
-
-msgout_identifier = {
-    'echo':150,
-    'general_input':151,
-    'settings':152
-}
-
-encode_lookup = {
-    'request_status':{True:1, False:0},
-    'reset_device':{True:1, False:0},
-    'purge_memory':{True:1, False:0},
-    'zero_pulse_timer':{True:1, False:0},
-    'enable_record':{True:0b11, False:0b10, None:0b00},
-    'enable_send_record':{True:0b11, False:0b10, None:0b00}
-}
-
+        ser.open()
+    except (serial.serialutil.SerialException, OSError, ValueError):
+        return None
+    try:
+        if reset_buffers:
+            ser.reset_input_buffer()
+            ser.reset_output_buffer()
+        authentication_byte = np.random.bytes(1)
+        ser.write(encode_echo(authentication_byte))
+        received_data = b''
+        load_kernels()
+        remaining_data = np.array((), dtype=np.uint8)
+        in_sync = True
+        deadline = time.perf_counter() + auth_timeout
+        while time.perf_counter() < deadline:
+            new_data = ser.read(4000)
+            received_data += new_data
+            new_data_arr = np.frombuffer(new_data, dtype=np.uint8).copy()
+            records, records_idx, other_messages, other_messages_idx, remaining_data, bytes_discarded, resync_events, in_sync = prKernels.quick_decode(remaining_data, new_data_arr, in_sync)
+            for message in prProtocol.message_rows(prProtocol.decode_messages(other_messages[:other_messages_idx]).get('echo', {})):
+                if message['echoed_byte'] == authentication_byte:
+                    ser.timeout = 0.1
+                    return ser, message['device_version'], received_data
+    except serial.serialutil.SerialException:
+        pass
+    ser.close()
+    return None
+
+def probe_ports(comports, auth_timeout=0.25, reset_buffers=True):
+    ''' Probes all the comports at the same time. Returns a list of (comport, ser, device_version, received_data)
+    for every port that authenticated, each with its port left open. '''
+    if not comports:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(comports)) as executor:
+        results = list(executor.map(lambda comport: probe_port(comport, auth_timeout, reset_buffers), comports))
+    return [(comport,) + result for comport, result in zip(comports, results) if result is not None]
 
 def print_bytes(bytemessage):
     print('Message:')
@@ -0,0 +1,288 @@
+import asyncio
+import serial
+import numpy as np
+import time
+import logging
+
+import pulse_recorder_additional_classes as prExtras
+import pulse_recorder_protocol as prProtocol
+
+"""
+An asyncio client for the Pulse Recorder, for programs that control an experiment from an event loop rather than
+through the GUI. One event loop can run several devices (and anything else) without a thread per device:
+
+async def record(duration):
+    async with AsyncPulseRecorder() as device:
+        await device.set_holdoff(100E-9)
+        await device.zero_timer()
+        await device.enable_sending()
+        async for records in device:
+            # records is an (N, 5) int64 array of (time, ch0, ch1, ch2, ch3), as from quick_decode
+            ...
+
+The port is read without blocking. Where the port has a file descriptor (Linux and macOS) the event loop is told
+to wake when there is data. Elsewhere the port is polled every poll_interval. Decoded blocks wait in a queue of
+at most max_blocks. If the program doesn't keep up, reading stops until it does, and the records wait in the
+serial buffers and the device's memory (see status()['slots_used']) rather than being thrown away.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPulseRecorder:
+    ''' Connects to a Pulse Recorder on port, or the first one found (with serial_number if given). '''
+    def __init__(self, port=None, serial_number=None, max_blocks=256, read_size=32000, poll_interval=0.002, auth_timeout=0.25):
+        self.port = port
+        self.serial_number = serial_number
+        self.read_size = read_size
+        self.poll_interval = poll_interval
+        self.auth_timeout = auth_timeout
+        self.max_blocks = max_blocks
+        self.ser = None
+        self.device_version = None
+        # Made when the port is opened, so it belongs to the event loop the client is used from
+        self.blocks = None
+        self.closed = False
+        self.read_task = None
+        self.remaining_data = np.array((), dtype=np.uint8)
+        self.in_sync = True
+        # Futures waiting for the next message of each kind, set by handle_messages
+        self.waiting = {'echo':[], 'devicestatus':[]}
+        self.last_status = None
+        self.errors = []
+        self.counts_received = 0
+        self.bytes_dropped = 0
+        self.resync_events = 0
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        ''' Opens the port (or tries each Pulse Recorder port in turn) and authenticates. Returns the device version. '''
+        loop = asyncio.get_event_loop()
+        # Importing numba and loading the decoder takes a while, so it isn't done on the event loop
+        await loop.run_in_executor(None, prExtras.load_kernels)
+        if self.port is not None:
+            ports = [self.port]
+        else:
+            ports = [comport.device for comport in prExtras.find_device_ports(self.serial_number)]
+        # Ports held by SerialThreads (or other clients) in this program are left alone. Each port is claimed only
+        # while it is tried, so the ones that aren't used are free for others.
+        for port in ports:
+            if not prExtras.claim_ports([port]):
+                continue
+            try:
+                self.open(port)
+                self.device_version = await self.authenticate()
+                return self.device_version
+            except (serial.serialutil.SerialException, OSError, ValueError, asyncio.TimeoutError) as ex:
+                logger.info('No Pulse Recorder on %s: %s', port, ex)
+                await self.close_port()
+        raise serial.serialutil.SerialException('No Pulse Recorder found')
+
+    def open(self, port):
+        self.ser = serial.Serial()
+        self.ser.port = port
+        self.ser.baudrate = 12000000
+        # A timeout of 0 makes reads return straight away with whatever has arrived
+        self.ser.timeout = 0
+        self.ser.writeTimeout = 1
+        self.ser.exclusive = True
+        self.ser.open()
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+        self.blocks = asyncio.Queue(maxsize=self.max_blocks)
+        self.closed = False
+        self.remaining_data = np.array((), dtype=np.uint8)
+        self.in_sync = True
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def authenticate(self):
+        ''' Sends a random byte to be echoed, and waits for the echo. Returns the device version. '''
+        authentication_byte = np.random.bytes(1)
+        echo = self.wait_for('echo')
+        self.write(prExtras.encode_echo(authentication_byte))
+        deadline = time.perf_counter() + self.auth_timeout
+        while True:
+            message = await asyncio.wait_for(echo, max(deadline - time.perf_counter(), 0))
+            if message['echoed_byte'] == authentication_byte:
+                return message['device_version']
+            echo = self.wait_for('echo')
+
+    async def close(self):
+        await self.close_port()
+        self.end_blocks()
+
+    async def close_port(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+            self.read_task = None
+        if self.ser is not None:
+            self.ser.close()
+            prExtras.release_ports([self.ser.port])
+            self.ser = None
+        for futures in self.waiting.values():
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+            futures.clear()
+
+    def end_blocks(self):
+        # Ends any async for over the records, once the blocks already decoded have been taken
+        self.closed = True
+        if self.blocks is not None:
+            try:
+                self.blocks.put_nowait(None)
+            except asyncio.QueueFull:
+                # __anext__ stops once the queue is empty instead
+                pass
+
+    def write(self, encoded_command):
+        # Commands are a few bytes, which the OS takes straight away
+        self.ser.write(encoded_command)
+
+    async def set_holdoff(self, holdoff_time):
+        ''' Sets the holdoff time in seconds. As in the GUI, it is rounded to the 5 ns clock and kept between
+        10 ns and 1.3 s (see prExtras.holdoff_setting). Returns the holdoff time in clock cycles. '''
+        cycles, setting = prExtras.holdoff_setting(holdoff_time)
+        self.write(prExtras.encode_settings(holdoff_time=setting))
+        return cycles
+
+    async def zero_timer(self):
+        ''' Zeroes the device's pulse timer. Returns the host time (time.time()) the command was sent. '''
+        self.write(prExtras.encode_settings(zero_pulse_timer=True))
+        return time.time()
+
+    async def purge(self):
+        ''' Throws away the records waiting in the device's memory. '''
+        self.write(prExtras.encode_settings(purge_memory=True))
+
+    async def enable_sending(self, enable=True):
+        ''' Starts (or stops) the device recording and sending records. '''
+        self.write(prExtras.encode_settings(enable_record=enable, enable_send_record=enable))
+
+    async def status(self, timeout=1.0):
+        ''' Asks for and returns the device status, like {'slots_used':0}, along with what this client has counted. '''
+        devicestatus = self.wait_for('devicestatus')
+        self.write(prExtras.encode_settings(request_status=True))
+        return await asyncio.wait_for(devicestatus, timeout)
+
+    def wait_for(self, kind):
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[kind].append(future)
+        return future
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        ''' The next block of records, as an (N, 5) int64 array. Stops once the client is closed. '''
+        if self.blocks is None or (self.closed and self.blocks.empty()):
+            raise StopAsyncIteration
+        records = await self.blocks.get()
+        if records is None:
+            raise StopAsyncIteration
+        return records
+
+    async def read_loop(self):
+        try:
+            fileno = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            fileno = None
+        while True:
+            try:
+                new_data = self.ser.read(self.read_size)
+            except serial.serialutil.SerialException as ex:
+                logger.warning('Lost connection to %s: %s', self.ser.port, ex)
+                self.end_blocks()
+                return
+            if new_data:
+                records = self.decode(new_data)
+                if records.size:
+                    # Waits while the queue is full, which stops reading until the records are taken
+                    await self.blocks.put(records)
+                # put() doesn't wait if there is room, so let the other tasks run before reading again
+                await asyncio.sleep(0)
+            elif fileno is not None:
+                await self.wait_readable(fileno)
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def wait_readable(self, fileno):
+        loop = asyncio.get_event_loop()
+        readable = loop.create_future()
+        loop.add_reader(fileno, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fileno)
+
+    def decode(self, new_data):
+        ''' Decodes new_data, handling any control messages in it. Returns the records as one array. '''
+        blocks = []
+        # quick_decode can only take about 4000 bytes at a time
+        for chunk_start in range(0, len(new_data), 4000):
+            new_data_arr = np.frombuffer(new_data[chunk_start:chunk_start + 4000], dtype=np.uint8).copy()
+            records, records_idx, other_messages, other_messages_idx, self.remaining_data, bytes_discarded, resync_events, self.in_sync = prExtras.prKernels.quick_decode(self.remaining_data, new_data_arr, self.in_sync, 3)
+            self.bytes_dropped += bytes_discarded
+            self.resync_events += resync_events
+            if records_idx:
+                blocks.append(records[:records_idx].copy())
+            if other_messages_idx:
+                self.handle_messages(other_messages[:other_messages_idx])
+        if not blocks:
+            return np.zeros((0, 5), dtype=np.int64)
+        records = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        self.counts_received += len(records)
+        return records
+
+    def handle_messages(self, messages):
+        decoded_messages = prProtocol.decode_messages(messages)
+        if 'devicestatus' in decoded_messages:
+            message = prProtocol.last_message(decoded_messages['devicestatus'])
+            message.update({'counts_received':self.counts_received, 'bytes_dropped_total':self.bytes_dropped, 'resync_events':self.resync_events})
+            self.last_status = message
+            self.resolve('devicestatus', message)
+        for message in prProtocol.message_rows(decoded_messages.get('echo', {})):
+            self.resolve('echo', message)
+        for message in prProtocol.message_rows(decoded_messages.get('error', {})):
+            logger.warning('Device error on %s: %s', self.ser.port, message)
+            self.errors.append(message)
+
+    def resolve(self, kind, message):
+        futures = self.waiting[kind]
+        self.waiting[kind] = []
+        for future in futures:
+            if not future.done():
+                future.set_result(message)
+
+
+def check_holdoff():
+    ''' Checks set_holdoff sends the same settings command as the GUI does for the same holdoff time, which is
+    what a SerialThread queues after MainWindow.set_holdoff. '''
+    written = []
+    device = AsyncPulseRecorder()
+    device.write = written.append
+    serial_thread = prExtras.SerialThread()
+    for holdoff_time in [0, 10E-9, 12E-9, 100E-9, 1E-6, 3.3E-3, 1.3, 5.0]:
+        cycles = asyncio.run(device.set_holdoff(holdoff_time))
+        # As MainWindow.set_holdoff works it out
+        gui_cycles = round(max(min(holdoff_time, 1.3), 10E-9)/5E-9)
+        serial_thread.set_holdoff(int(gui_cycles - 2))
+        gui_command = serial_thread.command_queue.take_all()[0][0]
+        assert cycles == gui_cycles and written.pop() == gui_command, holdoff_time
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    check_holdoff()
+    print('set_holdoff sends the same commands as the GUI.')
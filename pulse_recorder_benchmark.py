@@ -0,0 +1,235 @@
+from PyQt5 import QtWidgets, QtCore
+
+import sys
+import os
+import time
+import json
+import argparse
+import subprocess
+import tempfile
+
+import pulse_recorder_additional_classes as prExtras
+import pulse_recorder_metrics as prMetrics
+
+"""
+Benchmarks for the parts of the program whose speed matters. Run with:
+
+python pulse_recorder_benchmark.py status
+python pulse_recorder_benchmark.py startup
+
+status: how the GUI copes with status messages arriving at different rates, when each message is emitted as a
+signal and handled straight away (as the GUI used to), compared to publishing each one to a StatusModel that
+the GUI reads on a display timer (as it does now). The GUI frame time is measured with a 10 ms heartbeat timer:
+the longer the GUI is busy, the later the heartbeat.
+
+startup: how long after starting the program the window is shown, the decoding kernels are ready, a device is
+connected and the first record is decoded. Each run is a new process running the whole program, with a stand in
+for the device that is found straight away and only sends records once the program tells it to. The first run
+starts with an empty numba cache (so the kernels are compiled), the rest use what it cached. Times are taken with
+time.perf_counter, which counts from the same point in every process.
+
+Add -platform offscreen to run it without a display.
+"""
+
+
+class StatusSource(QtCore.QThread):
+    ''' Sends status dicts like the SerialThread's at a given rate, either as signals or to a StatusModel. '''
+    status = QtCore.pyqtSignal(object)
+    def __init__(self, mode, rate, duration):
+        super().__init__()
+        self.mode = mode
+        self.rate = rate
+        self.duration = duration
+        self.status_model = prExtras.StatusModel()
+        self.num_sent = 0
+
+    def run(self):
+        status = {'saved_counts':0, 'slots_used':0, 'counts_received':0, 'bytes_dropped':0, 'bytes_dropped_total':0, 'resync_events':0, 'count_rate':0.0}
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.duration:
+            self.num_sent += 1
+            status['counts_received'] += 300
+            status['saved_counts'] += 300
+            status['slots_used'] = self.num_sent % 16000000
+            status['count_rate'] = 1.5E6
+            if self.mode == 'signal':
+                # A copy, since the receiver may not have handled the last one yet
+                self.status.emit(dict(status))
+            else:
+                self.status_model.publish(status)
+            # Keep to the rate, letting the GUI thread have the GIL in between
+            ahead = start + self.num_sent/self.rate - time.perf_counter()
+            time.sleep(max(ahead, 0))
+
+
+class StatusPanel(QtWidgets.QWidget):
+    ''' The labels the main window shows the status with. '''
+    def __init__(self):
+        super().__init__()
+        layout = QtWidgets.QVBoxLayout(self)
+        self.labelCountRateIndicator = QtWidgets.QLabel()
+        self.labelSavedCounts = QtWidgets.QLabel()
+        self.labelMemoryIndicator = QtWidgets.QLabel()
+        self.barMemoryIndicator = QtWidgets.QProgressBar()
+        for widget in [self.labelCountRateIndicator, self.labelSavedCounts, self.labelMemoryIndicator, self.barMemoryIndicator]:
+            layout.addWidget(widget)
+        self.update_time = prMetrics.Stat()
+
+    def show_status(self, status):
+        start = time.perf_counter()
+        self.labelCountRateIndicator.setText('{:,} cps'.format(int(status['count_rate'])))
+        self.labelSavedCounts.setText('{:,}'.format(status['saved_counts']))
+        self.labelMemoryIndicator.setText('{:,}\n/32,000,000'.format(status['slots_used']*2))
+        self.barMemoryIndicator.setValue(int(status['slots_used']/160000))
+        # Paint now, as the label changes would be on the next frame
+        self.repaint()
+        self.update_time.add(time.perf_counter() - start)
+
+
+def run_status_benchmark(app, mode, rate, duration, frame_interval=50):
+    ''' Returns (messages sent per second, GUI updates per second, mean and max heartbeat lateness in ms, GUI update time per second in ms). '''
+    panel = StatusPanel()
+    panel.show()
+    source = StatusSource(mode, rate, duration)
+    heartbeat = prMetrics.Stat()
+    last_beat = [time.perf_counter()]
+    def beat():
+        now = time.perf_counter()
+        heartbeat.add(max(now - last_beat[0] - 0.010, 0))
+        last_beat[0] = now
+    heartbeat_timer = QtCore.QTimer()
+    heartbeat_timer.setInterval(10)
+    heartbeat_timer.timeout.connect(beat)
+    if mode == 'signal':
+        source.status.connect(panel.show_status)
+    else:
+        last_version = [None]
+        def refresh_display():
+            version, snapshot = source.status_model.read()
+            if version != last_version[0] and snapshot:
+                last_version[0] = version
+                panel.show_status(snapshot)
+        display_timer = QtCore.QTimer()
+        display_timer.setInterval(frame_interval)
+        display_timer.timeout.connect(refresh_display)
+        display_timer.start()
+    start = time.perf_counter()
+    heartbeat_timer.start()
+    source.start()
+    # Keep going until every signal has been handled, which is how long the GUI was really behind
+    while source.isRunning() or (mode == 'signal' and panel.update_time.count < source.num_sent):
+        app.processEvents()
+        if time.perf_counter() - start > 10*duration:
+            break
+    elapsed = time.perf_counter() - start
+    heartbeat_timer.stop()
+    panel.close()
+    return (source.num_sent/duration, panel.update_time.count/elapsed, 1E3*heartbeat.sum/max(heartbeat.count, 1), 1E3*heartbeat.max, 1E3*panel.update_time.sum/elapsed)
+
+
+class BenchmarkPort:
+    ''' Looks enough like a ListPortInfo for SerialThread.connect_device. '''
+    device = 'benchmark'
+    serial_number = 'benchmark'
+
+
+class BenchmarkDevice:
+    ''' Stands in for an open serial.Serial to a Pulse Recorder. Once told to send records it sends full reads of them. '''
+    def __init__(self):
+        self.port = BenchmarkPort.device
+        self.is_open = True
+        self.sending = False
+        self.enable_command = prExtras.encode_settings(enable_record=True, enable_send_record=True)
+        message = bytes([204, 1, 0, 0, 0, 0, 0, 0x10, 2, 0, 0, 0, 0, 0, 0x30])
+        self.records_data = message*(4000//len(message))
+
+    def write(self, data):
+        if data == self.enable_command:
+            self.sending = True
+        return len(data)
+
+    def read(self, size):
+        time.sleep(0.001)
+        return self.records_data[:size] if self.sending else b''
+
+    def cancel_read(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def startup_child(app):
+    ''' Runs the program with a BenchmarkDevice until the first record is decoded, then prints when each
+    milestone was reached (as perf_counter times) on a line starting with 'startup'. '''
+    found = [False]
+    def find_device_ports(serial_number=None):
+        # The device is there the first time the SerialThread looks
+        return [] if found[0] else [BenchmarkPort()]
+    def probe_ports(comports, auth_timeout=0.25, reset_buffers=True):
+        found[0] = True
+        return [(comport, BenchmarkDevice(), 'bench', b'') for comport in comports]
+    prExtras.find_device_ports = find_device_ports
+    prExtras.probe_ports = probe_ports
+    import pulse_recorder
+    window = pulse_recorder.MainWindow()
+    window.show()
+    metrics = window.serial_thread.metrics
+    deadline = time.perf_counter() + 60
+    while (window.time_to_window is None or 'first_record' not in metrics.milestones) and time.perf_counter() < deadline:
+        app.processEvents()
+        time.sleep(0.001)
+    times = {'window':prMetrics.program_start + window.time_to_window if window.time_to_window is not None else None}
+    times.update({name:metrics.milestones.get(name) for name in metrics.milestone_names})
+    window.safe_close_serial_thread()
+    print('startup ' + json.dumps(times), flush=True)
+
+
+def run_startup_benchmark(qt_args, numba_cache_dir):
+    ''' Returns the ms from launching the program to each milestone, as a dict. '''
+    env = dict(os.environ, NUMBA_CACHE_DIR=numba_cache_dir)
+    launched = time.perf_counter()
+    output = subprocess.run([sys.executable, __file__, 'startup_child'] + qt_args, env=env, stdout=subprocess.PIPE, universal_newlines=True, timeout=120).stdout
+    for line in output.splitlines():
+        if line.startswith('startup '):
+            times = json.loads(line[len('startup '):])
+            return {name:(value - launched)*1E3 if value is not None else None for name, value in times.items()}
+    raise RuntimeError('The startup run failed:\n' + output)
+
+
+def startup_benchmark(qt_args, repeats):
+    names = ['window', 'kernels_ready', 'connected', 'first_record']
+    print('{:>6} {:>8} '.format('run', 'cache') + ' '.join('{:>16}'.format(name + ' ms') for name in names))
+    with tempfile.TemporaryDirectory() as numba_cache_dir:
+        for repeat in range(repeats):
+            results = run_startup_benchmark(qt_args, numba_cache_dir)
+            values = ' '.join('{:>16.0f}'.format(results[name]) if results[name] is not None else '{:>16}'.format('-') for name in names)
+            print('{:>6} {:>8} '.format(repeat, 'empty' if repeat == 0 else 'warm') + values, flush=True)
+
+
+def status_benchmark(app, rates, duration):
+    print('{:>8} {:>10} {:>12} {:>12} {:>14} {:>14} {:>16}'.format('mode', 'rate', 'sent/s', 'updates/s', 'late mean ms', 'late max ms', 'GUI ms per s'))
+    for rate in rates:
+        for mode in ['signal', 'model']:
+            results = run_status_benchmark(app, mode, rate, duration)
+            print('{:>8} {:>10,} {:>12,.0f} {:>12,.1f} {:>14.2f} {:>14.1f} {:>16.1f}'.format(mode, rate, *results), flush=True)
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pulse Recorder benchmarks.')
+    # startup_child is the program run by the startup benchmark
+    parser.add_argument('benchmark', choices=['status', 'startup', 'startup_child'])
+    parser.add_argument('--rates', nargs='+', type=int, default=[2, 100, 1000, 10000, 100000], help='Status messages per second')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds per run')
+    parser.add_argument('--repeats', type=int, default=4, help='Number of startup runs')
+    args, qt_args = parser.parse_known_args()
+    if args.benchmark == 'startup':
+        startup_benchmark(qt_args, args.repeats)
+        sys.exit()
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    if args.benchmark == 'status':
+        status_benchmark(app, args.rates, args.duration)
+    elif args.benchmark == 'startup_child':
+        startup_child(app)
@@ -0,0 +1,235 @@
+import numpy as np
+import threading
+from numba import jit
+
+"""
+The numba kernels used on every batch of data from the device.
+
+They are kept here, away from the GUI and serial code, so that importing numba and compiling these (or loading
+them from numba's cache) doesn't hold up the window appearing. Each SerialThread imports this module and calls
+warm_up() in the background when it starts (see prExtras.load_kernels), before it connects to a device. So by the
+time the device is told to start sending, the first batch of records is decoded straight away.
+"""
+
+warm_up_lock = threading.Lock()
+warmed_up = False
+
+
+def warm_up():
+    ''' Runs each kernel on a little data, with the same argument types the SerialThread uses, so they are
+    compiled (or loaded from the cache) now rather than on the first real data. Only does anything the first time. '''
+    global warmed_up
+    with warm_up_lock:
+        if warmed_up:
+            return
+        # A pulse record message (two records) and half of the next, then the rest of it, another one and half of
+        # the next. What is left over each time is passed back in, as it is in the serial loop.
+        message = np.array([204, 1, 0, 0, 0, 0, 0, 0x10, 2, 0, 0, 0, 0, 0, 0x30], dtype=np.uint8)
+        chunks = [np.concatenate((message, message[:8])), np.concatenate((message[8:], message, message[:8]))]
+        for resync_frames in [3, None]:
+            remaining_data = np.array((), dtype=np.uint8)
+            in_sync = True
+            for new_data in chunks:
+                if resync_frames is None:
+                    # As called while probing ports and decoding raw captures
+                    results = quick_decode(remaining_data, new_data, in_sync)
+                else:
+                    results = quick_decode(remaining_data, new_data, in_sync, resync_frames)
+                records, records_idx, other_messages, other_messages_idx, remaining_data, bytes_discarded, resync_events, in_sync = results
+        # The first batch, then a later one given what savecheck handed back from the one before
+        saved_records, saved_records_idx, last_record, last_record_save = savecheck(np.zeros(5, dtype=np.int64), 0, records, records_idx, np.int64(200))
+        savecheck(last_record, last_record_save, records, records_idx, np.int64(200))
+        fill_delta_histogram(np.zeros((4, 10), dtype=np.int64), np.full(4, -1, dtype=np.int64), records, records_idx, 0, 200)
+        warmed_up = True
+
+
+@jit(nopython=True, cache=True)
+def savecheck(last_record, last_record_save, records, records_idx, retention_interval):
+    save_array = np.zeros((600, 6), dtype=np.int64)
+    save_array[0, 1:] = last_record
+    if last_record_save:
+        save_array[0, 0] = 1
+    save_array[1:records_idx + 1, 1:] = records[:records_idx]
+    for idx in range(1, records_idx):
+        if save_array[idx, 1] - save_array[idx-1, 1] <= retention_interval:
+            save_array[idx-1, 0] = 1
+            save_array[idx, 0] = 1
+    save_idxs = (save_array[:, 0] == 1)
+    last_record = records[records_idx]
+    last_record_save = save_array[idx, 0]
+    saved_records = save_idxs.sum()
+    return save_array[save_idxs, 1:], saved_records, last_record, last_record_save
+
+@jit(nopython=True, cache=True)
+def message_length(key):
+    # Number of bytes following the key for each incoming message type, or -1 if key isn't a valid key
+    if key == 204:
+        return 14
+    elif key == 203:
+        return 4
+    elif key == 201:
+        return 8
+    elif key == 200:
+        return 2
+    elif key == 202:
+        return 8
+    return -1
+
+@jit(nopython=True, cache=True)
+def check_frames(data, start, num_frames):
+    # Checks that num_frames whole messages follow each other from data[start]. Returns 0 if they do,
+    # 1 if one of them doesn't start with a valid key, or 2 if the data runs out before it can tell.
+    N = data.size
+    idx = start
+    for frame in range(num_frames):
+        if idx >= N:
+            return 2
+        message_bytes = message_length(data[idx])
+        if message_bytes < 0:
+            return 1
+        if idx + 1 + message_bytes > N:
+            return 2
+        idx += 1 + message_bytes
+    return 0
+
+@jit(nopython=True, cache=True)
+def quick_decode(remaining_data, new_data, in_sync=True, resync_frames=3):
+    #both inputs are arrays
+    # When an invalid key is found the decoder is out of sync. It then scans ahead for a candidate key that is
+    # followed by resync_frames whole, back to back messages, and only carries on decoding from there. This
+    # stops a stray byte that happens to look like a key from being decoded as the start of a message.
+    # While in sync, a message is only decoded if the byte after it is a valid key (or the data ends there).
+    # Returns the number of bytes thrown away, the number of times sync was regained, and whether it is in
+    # sync at the end (which should be passed in with the next call).
+    data = np.concatenate((remaining_data, new_data))#.astype(np.int64)
+    records_idx = 0
+    records = np.zeros((600, 5), dtype=np.int64)
+    other_messages_idx = 0
+    other_messages = np.zeros((20, 9), dtype=np.uint8)
+    bytes_discarded = 0
+    resync_events = 0
+    N = data.size
+    idx = 0
+    while idx < N:
+        if not in_sync:
+            candidate_idx = idx
+            frames_check = 1
+            while candidate_idx < N:
+                if message_length(data[candidate_idx]) >= 0:
+                    frames_check = check_frames(data, candidate_idx, resync_frames)
+                    if frames_check != 1:
+                        break
+                candidate_idx += 1
+            bytes_discarded += candidate_idx - idx
+            idx = candidate_idx
+            if frames_check != 0:
+                # Either nothing in the data looks like a key, or the candidate needs more data to be checked
+                break
+            in_sync = True
+            resync_events += 1
+        # find out how many bytes are in the message
+        key = data[idx]
+        message_bytes = message_length(key)
+        if message_bytes < 0:
+            in_sync = False
+            continue
+        idx += 1
+        #Check if the whole message is in the remaining array
+        if idx + message_bytes > N:
+            idx -= 1 #set the index back one so the key is included in the remaining data
+            break
+        # When the byte after the message isn't a key, either this key is a stray byte that happens to look like
+        # one, or a stray byte follows a good message. If whole messages follow on from the next byte it was this
+        # key, which is skipped. Otherwise the message is kept, and the next pass resyncs from the byte after it.
+        # Either way idx moves forward, whatever resync_frames is.
+        if idx + message_bytes < N and message_length(data[idx + message_bytes]) < 0:
+            frames_check = check_frames(data, idx, resync_frames)
+            if frames_check == 2:
+                # Needs more data to tell, so the key is kept for the next call
+                idx -= 1
+                break
+            if frames_check == 0:
+                bytes_discarded += 1
+                resync_events += 1
+                continue
+        #Read the whole message
+        message = data[idx:idx+message_bytes]
+        idx += message_bytes
+
+        if key == 204:
+            records[records_idx, 1] = (message[6] >> 4) & 0b1
+            records[records_idx, 2] = (message[6] >> 5) & 0b1
+            records[records_idx, 3] = (message[6] >> 6) & 0b1
+            records[records_idx, 4] = (message[6] >> 7) & 0b1
+            records[records_idx, 0] = (int(message[6] & 0b00001111) << 48) | (int(message[5]) << 40) | (int(message[4]) << 32) | (int(message[3]) << 24) | (int(message[2]) << 16) | (int(message[1]) << 8) | int(message[0])
+            records_idx += 1
+            records[records_idx, 1] = (message[13] >> 4) & 0b1
+            records[records_idx, 2] = (message[13] >> 5) & 0b1
+            records[records_idx, 3] = (message[13] >> 6) & 0b1
+            records[records_idx, 4] = (message[13] >> 7) & 0b1
+            records[records_idx, 0] = (int(message[13] & 0b00001111) << 48) | (int(message[12]) << 40) | (int(message[11]) << 32) | (int(message[10]) << 24) | (int(message[9]) << 16) | (int(message[8]) << 8) | int(message[7])
+            records_idx += 1
+        else:
+            other_messages[other_messages_idx, 0] = key
+            other_messages[other_messages_idx, 1:message_bytes+1] = message[:message_bytes]
+            if other_messages_idx < 19:
+                other_messages_idx += 1
+    return records, records_idx, other_messages, other_messages_idx, data[idx:], bytes_discarded, resync_events, in_sync
+
+
+@jit(nopython=True, cache=True)
+def fill_delta_histogram(counts, last_times, records, records_idx, dt_min, bin_width):
+    num_channels, num_bins = counts.shape
+    for record_idx in range(records_idx):
+        record_time = records[record_idx, 0]
+        for channel in range(num_channels):
+            if records[record_idx, channel + 1]:
+                # A negative difference (after the timer is zeroed) is just out of range
+                if last_times[channel] >= 0:
+                    bin_idx = (record_time - last_times[channel] - dt_min)//bin_width
+                    if bin_idx >= 0 and bin_idx < num_bins:
+                        counts[channel, bin_idx] += 1
+                last_times[channel] = record_time
+
+
+def check_resync(num_records=6000, num_stray=10, seed=0):
+    ''' Decodes a stream of pulse records with stray bytes between some of the messages, in the 4000 byte pieces
+    the SerialThread uses, and checks no record is lost and only the stray bytes are thrown away. Stray bytes
+    that look like keys are mixed in with ones that don't, and resync_frames from 1 up is tried. '''
+    rng = np.random.default_rng(seed)
+    times = np.cumsum(rng.integers(1, 100000, num_records))
+    channels = rng.integers(0, 16, num_records)
+    messages = []
+    for message_idx in range(num_records//2):
+        message = [204]
+        for record_idx in [2*message_idx, 2*message_idx + 1]:
+            message += [(int(times[record_idx]) >> (8*byte)) & 0xFF for byte in range(6)]
+            message.append(((int(times[record_idx]) >> 48) & 0x0F) | (int(channels[record_idx]) << 4))
+        messages.append(bytes(message))
+    stray_bytes = [0x00, 0x55, 0xFF, 200, 204, 0x13, 201, 0xAA, 203, 0x01]
+    for message_idx, stray_byte in zip(sorted(rng.choice(np.arange(1, len(messages)), num_stray, replace=False))[::-1], stray_bytes):
+        messages.insert(message_idx, bytes([stray_byte]))
+    data = np.frombuffer(b''.join(messages), dtype=np.uint8)
+    for resync_frames in [1, 2, 3, 5]:
+        remaining_data = np.array((), dtype=np.uint8)
+        in_sync = True
+        decoded = []
+        total_discarded = 0
+        total_resyncs = 0
+        for chunk_start in range(0, data.size, 4000):
+            records, records_idx, other_messages, other_messages_idx, remaining_data, bytes_discarded, resync_events, in_sync = quick_decode(remaining_data, data[chunk_start:chunk_start + 4000].copy(), in_sync, resync_frames)
+            decoded.append(records[:records_idx].copy())
+            total_discarded += bytes_discarded
+            total_resyncs += resync_events
+        decoded = np.concatenate(decoded)
+        if resync_frames >= 2:
+            assert len(decoded) == num_records, (resync_frames, len(decoded))
+            assert (decoded[:, 0] == times).all() and (decoded[:, 1:] == (channels[:, None] >> np.arange(4)) & 1).all(), resync_frames
+            assert total_discarded == num_stray and total_resyncs == num_stray, (resync_frames, total_discarded, total_resyncs)
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    check_resync()
+    print('Stray bytes between messages are skipped without losing any records.')
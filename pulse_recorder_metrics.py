@@ -0,0 +1,158 @@
+import time
+import json
+import os
+import pathlib
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# When the program started, for the startup milestones. pulse_recorder.py sets this to a time taken before its imports.
+program_start = time.perf_counter()
+
+
+class Stat:
+    ''' Count, sum and maximum of a value. interval_max is the maximum since the last export. '''
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.interval_max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        if value > self.interval_max:
+            self.interval_max = value
+
+
+class Timer(Stat):
+    ''' A Stat of durations in seconds, used as a context manager around the code being timed. '''
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.add(time.perf_counter() - self.start)
+
+
+class HotPathMetrics:
+    ''' Counters for the SerialThread acquisition loop, so dropped bytes can be traced to the step that was slow.
+
+    Each SerialThread owns one of these and is the only thing that updates it. Other threads only read it
+    (through as_dict and slots_used_since) which is fine for the plain numbers stored here.
+    '''
+    timer_names = ['read', 'quick_decode', 'savecheck', 'append', 'add_data_to_dataset', 'flush']
+    counter_names = ['bytes_read', 'records_received', 'bytes_discarded', 'resync_events', 'backpressure_interventions']
+    milestone_names = ['kernels_ready', 'connected', 'first_record']
+
+    def __init__(self, history_length=7200):
+        self.started = time.time()
+        self.timers = {name:Timer() for name in self.timer_names}
+        self.bytes_per_read = Stat()
+        self.counters = {name:0 for name in self.counter_names}
+        self.slots_used = 0
+        self.slots_used_stat = Stat()
+        # (host time, slots_used) at each status message. 7200 covers an hour of 500ms status requests
+        self.slots_used_history = collections.deque(maxlen=history_length)
+        # perf_counter time each milestone was first reached
+        self.milestones = {}
+
+    def mark(self, name):
+        ''' Records the time of a startup milestone, unless it has already been reached. '''
+        if name not in self.milestones:
+            self.milestones[name] = time.perf_counter()
+
+    def milestone_seconds(self, name):
+        ''' Seconds from program_start to the milestone, or None if it hasn't been reached. '''
+        if name not in self.milestones:
+            return None
+        return self.milestones[name] - program_start
+
+    def add_slots_used(self, slots_used):
+        self.slots_used = slots_used
+        self.slots_used_stat.add(slots_used)
+        self.slots_used_history.append((time.time(), slots_used))
+
+    def slots_used_since(self, since=0):
+        ''' The (host time, slots_used) samples taken after since, oldest first. '''
+        # list() copies the deque in one step, so it can't change while it's being filtered
+        return [sample for sample in list(self.slots_used_history) if sample[0] > since]
+
+    def as_dict(self, reset_interval_max=False):
+        ''' Returns all the metrics as a flat dict of numbers. '''
+        metrics = {'time':time.time(), 'uptime':time.time() - self.started}
+        for name, timer in self.timers.items():
+            metrics[name + '_count'] = timer.count
+            metrics[name + '_seconds_sum'] = timer.sum
+            metrics[name + '_seconds_max'] = timer.interval_max
+        metrics['bytes_per_read_count'] = self.bytes_per_read.count
+        metrics['bytes_per_read_sum'] = self.bytes_per_read.sum
+        metrics['bytes_per_read_max'] = self.bytes_per_read.interval_max
+        metrics.update(self.counters)
+        metrics['slots_used'] = self.slots_used
+        metrics['slots_used_max'] = self.slots_used_stat.interval_max
+        for name in self.milestone_names:
+            if name in self.milestones:
+                metrics['time_to_' + name + '_seconds'] = self.milestone_seconds(name)
+        if reset_interval_max:
+            for stat in list(self.timers.values()) + [self.bytes_per_read, self.slots_used_stat]:
+                stat.interval_max = 0
+        return metrics
+
+    def summary(self):
+        ''' A human readable summary for the GUI. '''
+        lines = []
+        for name, timer in self.timers.items():
+            mean = timer.sum/timer.count if timer.count else 0
+            lines.append('{:<20} {:>10,} calls  mean {:>9.1f} µs  max {:>9.1f} µs'.format(name, timer.count, mean*1E6, timer.max*1E6))
+        mean_bytes = self.bytes_per_read.sum/self.bytes_per_read.count if self.bytes_per_read.count else 0
+        lines.append('{:<20} mean {:,.0f}  max {:,}'.format('bytes per read', mean_bytes, self.bytes_per_read.max))
+        for name, value in self.counters.items():
+            lines.append('{:<20} {:,}'.format(name, value))
+        lines.append('{:<20} {:,}'.format('slots_used', self.slots_used))
+        recent = self.slots_used_since(time.time() - 3600)
+        if recent:
+            lines.append('{:<20} {:,}'.format('slots_used max 1h', max(slots_used for sample_time, slots_used in recent)))
+        for name in self.milestone_names:
+            if name in self.milestones:
+                lines.append('{:<20} {:,.0f} ms after start'.format(name, self.milestone_seconds(name)*1E3))
+        return '\n'.join(lines)
+
+
+class MetricsExporter:
+    ''' Periodically writes HotPathMetrics to a file. A '.prom' file is rewritten each time in the Prometheus
+    textfile format (for the node exporter's textfile collector), and Prometheus builds the slots_used history by
+    scraping it. Any other file has a JSON line appended, which includes the slots_used samples since the last line. '''
+    def __init__(self, path, metrics, interval=10.0, prefix='pulse_recorder'):
+        self.path = pathlib.Path(path)
+        self.metrics = metrics
+        self.interval = interval
+        self.prefix = prefix
+        self.last_write = 0
+
+    def write_if_due(self):
+        if time.time() - self.last_write >= self.interval:
+            try:
+                self.write()
+            except OSError as ex:
+                # Losing some metrics is better than stopping acquisition
+                logger.warning('Could not write metrics to %s: %s', self.path, ex)
+                self.last_write = time.time()
+
+    def write(self):
+        last_write = self.last_write
+        metrics = self.metrics.as_dict(reset_interval_max=True)
+        if self.path.suffix == '.prom':
+            lines = ['{}_{} {}'.format(self.prefix, name, value) for name, value in metrics.items()]
+            temp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(str(temp_path), 'w') as metrics_file:
+                metrics_file.write('\n'.join(lines) + '\n')
+            os.replace(str(temp_path), str(self.path))
+        else:
+            metrics['slots_used_history'] = self.metrics.slots_used_since(last_write)
+            with open(str(self.path), 'a') as metrics_file:
+                metrics_file.write(json.dumps(metrics) + '\n')
+        self.last_write = time.time()
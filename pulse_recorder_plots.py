@@ -0,0 +1,297 @@
+from PyQt5 import QtWidgets, QtCore, QtGui
+
+import numpy as np
+import time
+
+# pulse_recorder_kernels, set by prExtras.load_kernels() once it has imported it. numba takes a while to import,
+# so this module (which is imported at startup) doesn't import it itself.
+prKernels = None
+
+# Line colours, cycled through for each curve
+curve_colours = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+
+
+class DeltaHistogram:
+    ''' Histograms of the time between consecutive pulses on each channel, filled from each batch of decoded records.
+
+    Only the time of the last pulse on each channel is kept between batches. The SerialThread fills 'counts' and
+    every publish_interval copies it into whichever of the two display buffers the GUI isn't looking at, then
+    makes that one current. The GUI takes a copy of the current buffer with snapshot(), so it never waits on the
+    serial thread and the serial thread never waits on it.
+    bin_width, dt_min and dt_max are in clock cycles. Changes made with configure() are picked up by the serial
+    thread at its next batch, and start the histograms again.
+    '''
+    def __init__(self, bin_width=200, dt_min=0, dt_max=400000, num_channels=4, publish_interval=0.05):
+        self.num_channels = num_channels
+        self.publish_interval = publish_interval
+        self.pending_configuration = None
+        self.last_publish = 0
+        self.apply_configuration(bin_width, dt_min, dt_max)
+
+    def configure(self, bin_width, dt_min, dt_max):
+        self.pending_configuration = (int(bin_width), int(dt_min), int(dt_max))
+
+    def apply_configuration(self, bin_width, dt_min, dt_max):
+        self.bin_width = max(int(bin_width), 1)
+        self.dt_min = int(dt_min)
+        self.dt_max = max(int(dt_max), self.dt_min + self.bin_width)
+        num_bins = int(np.ceil((self.dt_max - self.dt_min)/self.bin_width))
+        self.counts = np.zeros((self.num_channels, num_bins), dtype=np.int64)
+        self.last_times = np.full(self.num_channels, -1, dtype=np.int64)
+        self.buffers = [np.zeros_like(self.counts), np.zeros_like(self.counts)]
+        self.current_buffer = 0
+        # The configuration the buffers were filled with, published along with them
+        self.configuration = (self.bin_width, self.dt_min, self.dt_max)
+        self.version = 0
+
+    def add_records(self, records, records_idx):
+        ''' Adds a batch of decoded records (as returned by quick_decode). Called from the SerialThread only. '''
+        if self.pending_configuration is not None:
+            configuration = self.pending_configuration
+            self.pending_configuration = None
+            self.apply_configuration(*configuration)
+        prKernels.fill_delta_histogram(self.counts, self.last_times, records, records_idx, self.dt_min, self.bin_width)
+        if time.perf_counter() - self.last_publish >= self.publish_interval:
+            self.publish()
+
+    def publish(self):
+        back_buffer = 1 - self.current_buffer
+        np.copyto(self.buffers[back_buffer], self.counts)
+        self.current_buffer = back_buffer
+        self.version += 1
+        self.last_publish = time.perf_counter()
+
+    def snapshot(self):
+        ''' Returns (version, (bin_width, dt_min, dt_max), counts), with counts a copy the caller can keep. '''
+        configuration = self.configuration
+        version = self.version
+        return version, configuration, self.buffers[self.current_buffer].copy()
+
+
+class RateHistory:
+    ''' Count rates over the whole run in a fixed amount of memory, for plotting.
+
+    Each sample is a row of rates (total, then each channel). Samples are grouped into at most capacity columns,
+    each keeping the minimum and maximum of its samples, so short bursts and drop outs still show however long
+    the run. When all the columns are used, neighbouring pairs are merged and each column takes twice as many
+    samples from then on. Memory use and drawing time stay the same however long the run is.
+    The SerialThread adds samples and publishes a new read-only snapshot after each one, which the GUI can
+    read whenever it likes.
+    '''
+    def __init__(self, capacity=1024, num_series=5):
+        self.capacity = capacity - capacity % 2
+        self.times = np.zeros(self.capacity)
+        self.minimums = np.zeros((self.capacity, num_series))
+        self.maximums = np.zeros((self.capacity, num_series))
+        self.num_columns = 0
+        self.samples_per_column = 1
+        # The column being filled
+        self.column_time = 0.0
+        self.column_minimum = None
+        self.column_maximum = None
+        self.column_samples = 0
+        self.snapshot = (0, self.times[:0], self.minimums[:0], self.maximums[:0])
+
+    def add_sample(self, host_time, rates):
+        rates = np.asarray(rates, dtype=np.float64)
+        if not self.column_samples:
+            self.column_time = host_time
+            self.column_minimum = rates.copy()
+            self.column_maximum = rates.copy()
+        else:
+            np.minimum(self.column_minimum, rates, out=self.column_minimum)
+            np.maximum(self.column_maximum, rates, out=self.column_maximum)
+        self.column_samples += 1
+        if self.column_samples == self.samples_per_column:
+            if self.num_columns == self.capacity:
+                self.decimate()
+            self.times[self.num_columns] = self.column_time
+            self.minimums[self.num_columns] = self.column_minimum
+            self.maximums[self.num_columns] = self.column_maximum
+            self.num_columns += 1
+            self.column_samples = 0
+        self.publish()
+
+    def decimate(self):
+        half = self.capacity//2
+        self.times[:half] = self.times[0::2]
+        self.minimums[:half] = np.minimum(self.minimums[0::2], self.minimums[1::2])
+        self.maximums[:half] = np.maximum(self.maximums[0::2], self.maximums[1::2])
+        self.num_columns = half
+        self.samples_per_column *= 2
+
+    def publish(self):
+        times = self.times[:self.num_columns]
+        minimums = self.minimums[:self.num_columns]
+        maximums = self.maximums[:self.num_columns]
+        if self.column_samples:
+            # Include the column still being filled, so the plot is always up to date
+            times = np.append(times, self.column_time)
+            minimums = np.vstack([minimums, self.column_minimum])
+            maximums = np.vstack([maximums, self.column_maximum])
+        else:
+            times = times.copy()
+            minimums = minimums.copy()
+            maximums = maximums.copy()
+        self.snapshot = (self.snapshot[0] + 1, times, minimums, maximums)
+
+    def read(self):
+        ''' Returns (version, times, minimums, maximums). Rows of minimums and maximums are columns of the history. '''
+        return self.snapshot
+
+
+class PlotWidget(QtWidgets.QWidget):
+    ''' A minimal line plot drawn with QPainter, so live plots don't need a plotting library.
+    Curves are drawn as steps, each from x_min to x_max. Envelopes are drawn as a band between their minimum
+    and maximum at each x value. Everything is scaled to the largest value shown. '''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.curves = []
+        self.envelopes = []
+        self.x_values = None
+        self.x_min = 0
+        self.x_max = 1
+        self.x_label = ''
+        self.setMinimumSize(200, 120)
+
+    def set_curves(self, curves, x_min, x_max, x_label=''):
+        ''' curves is a list of (label, values). Values are evenly spaced between x_min and x_max. '''
+        self.curves = curves
+        self.envelopes = []
+        self.x_min = x_min
+        self.x_max = x_max
+        self.x_label = x_label
+        self.update()
+
+    def set_envelopes(self, envelopes, x_values, x_label=''):
+        ''' envelopes is a list of (label, minimums, maximums) at each of x_values, which must be increasing. '''
+        self.curves = []
+        self.envelopes = envelopes
+        self.x_values = x_values
+        self.x_min = x_values[0] if len(x_values) else 0
+        self.x_max = x_values[-1] if len(x_values) > 1 else self.x_min + 1
+        self.x_label = x_label
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        text_colour = self.palette().color(QtGui.QPalette.WindowText)
+        font_metrics = painter.fontMetrics()
+        margin_left = font_metrics.width('0000000') + 6
+        margin_bottom = 2*font_metrics.height() + 4
+        plot_rect = QtCore.QRectF(margin_left, 6, self.width() - margin_left - 8, self.height() - margin_bottom - 6)
+        painter.setPen(text_colour)
+        painter.drawRect(plot_rect)
+        y_max = max([values.max() for label, values in self.curves if len(values)] + [maximums.max() for label, minimums, maximums in self.envelopes if len(maximums)] + [1])
+        # Axis limits
+        painter.drawText(QtCore.QRectF(0, plot_rect.top() - 2, margin_left - 4, font_metrics.height()), QtCore.Qt.AlignRight, '{:,}'.format(int(y_max)))
+        painter.drawText(QtCore.QRectF(0, plot_rect.bottom() - font_metrics.height() + 2, margin_left - 4, font_metrics.height()), QtCore.Qt.AlignRight, '0')
+        painter.drawText(QtCore.QRectF(plot_rect.left(), plot_rect.bottom() + 2, plot_rect.width(), font_metrics.height()), QtCore.Qt.AlignLeft, '{:g}'.format(self.x_min))
+        painter.drawText(QtCore.QRectF(plot_rect.left(), plot_rect.bottom() + 2, plot_rect.width(), font_metrics.height()), QtCore.Qt.AlignRight, '{:g}'.format(self.x_max))
+        painter.drawText(QtCore.QRectF(plot_rect.left(), plot_rect.bottom() + 2 + font_metrics.height(), plot_rect.width(), font_metrics.height()), QtCore.Qt.AlignHCenter, self.x_label)
+        legend_x = plot_rect.right() - 4
+        for envelope_idx, (label, minimums, maximums) in enumerate(self.envelopes):
+            colour = QtGui.QColor(curve_colours[envelope_idx % len(curve_colours)])
+            if len(maximums):
+                xs = plot_rect.left() + (np.asarray(self.x_values) - self.x_min)*plot_rect.width()/(self.x_max - self.x_min)
+                ys_max = plot_rect.bottom() - np.asarray(maximums)*plot_rect.height()/y_max
+                ys_min = plot_rect.bottom() - np.asarray(minimums)*plot_rect.height()/y_max
+                top = [QtCore.QPointF(x, y) for x, y in zip(xs, ys_max)]
+                bottom = [QtCore.QPointF(x, y) for x, y in zip(xs[::-1], ys_min[::-1])]
+                fill_colour = QtGui.QColor(colour)
+                fill_colour.setAlpha(70)
+                painter.setPen(QtCore.Qt.NoPen)
+                painter.setBrush(fill_colour)
+                painter.drawPolygon(QtGui.QPolygonF(top + bottom))
+                painter.setBrush(QtCore.Qt.NoBrush)
+                painter.setPen(QtGui.QPen(colour, 1.2))
+                painter.drawPolyline(QtGui.QPolygonF(top))
+            painter.setPen(QtGui.QPen(colour, 1.2))
+            legend_x -= font_metrics.width(label) + 8
+            painter.drawText(QtCore.QPointF(legend_x, plot_rect.top() + font_metrics.ascent() + 2), label)
+        for curve_idx, (label, values) in enumerate(self.curves):
+            colour = QtGui.QColor(curve_colours[curve_idx % len(curve_colours)])
+            painter.setPen(QtGui.QPen(colour, 1.2))
+            if len(values) > plot_rect.width() > 0:
+                # No point drawing more than a bin per pixel, so keep the largest of each group of bins
+                group_size = int(np.ceil(len(values)/plot_rect.width()))
+                values = np.pad(values, (0, -len(values) % group_size)).reshape(-1, group_size).max(axis=1)
+            if len(values):
+                # Two points per bin, so the curve is drawn as steps
+                xs = plot_rect.left() + np.repeat(np.arange(len(values) + 1), 2)[1:-1]*plot_rect.width()/len(values)
+                ys = plot_rect.bottom() - np.repeat(values, 2)*plot_rect.height()/y_max
+                painter.drawPolyline(QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in zip(xs, ys)]))
+            legend_x -= font_metrics.width(label) + 8
+            painter.drawText(QtCore.QPointF(legend_x, plot_rect.top() + font_metrics.ascent() + 2), label)
+        painter.end()
+
+
+class DeltaHistogramView(QtWidgets.QGroupBox):
+    ''' Shows the DeltaHistograms of one or more SerialThreads. redraw() is called from the main window's display
+    timer, and only draws anything when one of them has published something new. '''
+    def __init__(self, parent=None):
+        super().__init__('Time between pulses', parent)
+        self.histograms = []
+        self.last_versions = []
+        self.plot = PlotWidget(self)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.plot)
+
+    def set_histograms(self, histograms):
+        self.histograms = histograms
+        self.last_versions = [None]*len(histograms)
+
+    def redraw(self):
+        if not self.isVisible():
+            return
+        snapshots = [histogram.snapshot() for histogram in self.histograms]
+        versions = [(id(histogram), snapshot[0], snapshot[1]) for histogram, snapshot in zip(self.histograms, snapshots)]
+        if versions == self.last_versions or not snapshots:
+            return
+        self.last_versions = versions
+        curves = []
+        for device_idx, (version, configuration, counts) in enumerate(snapshots):
+            for channel, channel_counts in enumerate(counts):
+                label = 'ch{}'.format(channel) if len(snapshots) == 1 else '{}:ch{}'.format(device_idx, channel)
+                curves.append((label, channel_counts))
+        bin_width, dt_min, dt_max = snapshots[0][1]
+        self.plot.set_curves(curves, dt_min*5E-9*1E6, dt_max*5E-9*1E6, 'Time between pulses (μs)')
+
+
+class RateHistoryView(QtWidgets.QGroupBox):
+    ''' Shows the RateHistory of one or more SerialThreads: the total and per channel rates for a single
+    device, or the total of each device. Times are in minutes before now. '''
+    def __init__(self, parent=None):
+        super().__init__('Count rate history', parent)
+        self.rate_histories = []
+        self.last_versions = []
+        self.plot = PlotWidget(self)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.plot)
+
+    def set_rate_histories(self, rate_histories):
+        self.rate_histories = rate_histories
+        self.last_versions = []
+
+    def redraw(self):
+        if not self.isVisible():
+            return
+        snapshots = [rate_history.read() for rate_history in self.rate_histories]
+        versions = [(id(rate_history), snapshot[0]) for rate_history, snapshot in zip(self.rate_histories, snapshots)]
+        if versions == self.last_versions or not snapshots:
+            return
+        self.last_versions = versions
+        now = time.time()
+        if len(snapshots) == 1:
+            version, times, minimums, maximums = snapshots[0]
+            labels = ['total', 'ch0', 'ch1', 'ch2', 'ch3']
+            envelopes = [(label, minimums[:, series], maximums[:, series]) for series, label in enumerate(labels)]
+        else:
+            # Devices publish at different times, so each is shown against the times of the first
+            version, times, minimums, maximums = snapshots[0]
+            envelopes = []
+            for device_idx, (version, device_times, device_minimums, device_maximums) in enumerate(snapshots):
+                if len(device_times) and len(times):
+                    envelopes.append(('{}:total'.format(device_idx), np.interp(times, device_times, device_minimums[:, 0]), np.interp(times, device_times, device_maximums[:, 0])))
+        self.plot.set_envelopes(envelopes, (times - now)/60, 'Minutes ago')
@@ -0,0 +1,336 @@
+import struct
+import functools
+import numpy as np
+
+"""
+The messages to and from the Pulse Recorder, described once in messages_in and messages_out.
+The encoders and decoders are made from these tables when the module is imported, so adding or changing a
+message only means changing its table entry.
+
+Each message is an identifier byte followed by its fields. A field is
+(name, first byte, number of bytes, first bit, number of bits, kind)
+where the bytes are a little endian unsigned int (a 'word') and the field is the given bits of it.
+Fields can share a word. kind says what the value is:
+    'uint'      an int
+    'flag'      a bool
+    'setting'   a bool that may be left unchanged: 2 bits, the value and then whether to update it (None leaves it)
+    'value'     an int that may be left unchanged: the value's bits, then 1 more bit for whether to update it
+    'bytes'     the bytes themselves
+    'text'      the bytes as text. Also gives 'unprintable_byte', True if any couldn't be decoded
+    'binary'    a string of the bits, most significant byte first, as the device's debug prints are shown
+
+Messages are encoded with a precompiled struct.Struct per message. They are decoded a batch at a time with
+numpy: decode_messages takes the other_messages rows from quick_decode and decodes each type's rows together.
+
+To check every message type round trips and the decoders cope with any bytes, run:
+python pulse_recorder_protocol.py
+"""
+
+messages_in = {
+    'error':{'identifier':200, 'length':2, 'fields':[
+        ('invalid_identifier_received',         0, 1, 0, 1, 'flag'),
+        ('timeout_waiting_to_receive_message',  0, 1, 1, 1, 'flag'),
+        ('received_message_not_forwarded',      0, 1, 2, 1, 'flag'),
+        # The device_index the message was meant for, which says where it should have gone in the FPGA
+        ('error_info',                          1, 1, 0, 8, 'uint')]},
+    'echo':{'identifier':201, 'length':8, 'fields':[
+        ('echoed_byte',                         0, 1, 0, 8, 'bytes'),
+        ('device_version',                      1, 7, 0, 56, 'text')]},
+    'print':{'identifier':202, 'length':8, 'fields':[
+        ('printed',                             0, 8, 0, 64, 'binary')]},
+    'devicestatus':{'identifier':203, 'length':4, 'fields':[
+        # 25 bits are used
+        ('slots_used',                          0, 4, 0, 32, 'uint')]},
+    'pulserecord':{'identifier':204, 'length':14, 'fields':[
+        ('record_A_time',                       0, 7, 0, 52, 'uint'),
+        ('record_A_ch0',                        0, 7, 52, 1, 'uint'),
+        ('record_A_ch1',                        0, 7, 53, 1, 'uint'),
+        ('record_A_ch2',                        0, 7, 54, 1, 'uint'),
+        ('record_A_ch3',                        0, 7, 55, 1, 'uint'),
+        ('record_B_time',                       7, 7, 0, 52, 'uint'),
+        ('record_B_ch0',                        7, 7, 52, 1, 'uint'),
+        ('record_B_ch1',                        7, 7, 53, 1, 'uint'),
+        ('record_B_ch2',                        7, 7, 54, 1, 'uint'),
+        ('record_B_ch3',                        7, 7, 55, 1, 'uint')]},
+}
+
+messages_out = {
+    'echo':{'identifier':150, 'length':1, 'fields':[
+        ('byte_to_echo',                        0, 1, 0, 8, 'bytes')]},
+    'general_input':{'identifier':151, 'length':8, 'fields':[
+        ('message',                             0, 8, 0, 64, 'uint')]},
+    # A mix of settings and actions
+    'settings':{'identifier':152, 'length':5, 'fields':[
+        ('enable_record',                       0, 1, 0, 2, 'setting'),
+        ('enable_send_record',                  0, 1, 2, 2, 'setting'),
+        ('request_status',                      0, 1, 4, 1, 'flag'),
+        ('purge_memory',                        0, 1, 5, 1, 'flag'),
+        ('zero_pulse_timer',                    0, 1, 6, 1, 'flag'),
+        ('reset_device',                        0, 1, 7, 1, 'flag'),
+        # In clock cycles
+        ('holdoff_time',                        1, 4, 0, 28, 'value')]},
+}
+
+# struct codes for words that are a whole number of bytes
+word_codes = {1:'B', 2:'H', 4:'I', 8:'Q'}
+
+
+def words_of(message):
+    ''' The (first byte, number of bytes) of each word of a message, in order. '''
+    return sorted(set((field[1], field[2]) for field in message['fields']))
+
+def field_bits(field):
+    # Number of bits the field takes up in its word
+    name, first_byte, num_bytes, first_bit, num_bits, kind = field
+    return num_bits + 1 if kind == 'value' else num_bits
+
+
+class MessageEncoder:
+    ''' Encodes one type of message, with a struct.Struct made from its table entry. '''
+    def __init__(self, name, message):
+        self.name = name
+        self.identifier = message['identifier']
+        self.words = words_of(message)
+        codes = []
+        # Words that are ints of a size struct doesn't have (like the 7 byte records) are packed as bytes
+        self.words_as_bytes = []
+        for first_byte, num_bytes in self.words:
+            fields = [field for field in message['fields'] if (field[1], field[2]) == (first_byte, num_bytes)]
+            if any(field[5] in ['bytes', 'text'] for field in fields):
+                codes.append('{}s'.format(num_bytes))
+                self.words_as_bytes.append(False)
+            elif num_bytes in word_codes:
+                codes.append(word_codes[num_bytes])
+                self.words_as_bytes.append(False)
+            else:
+                codes.append('{}s'.format(num_bytes))
+                self.words_as_bytes.append(True)
+        self.packer = struct.Struct('<B' + ''.join(codes))
+        # For each word, its fields as (name, first bit, mask, kind)
+        self.word_fields = []
+        for first_byte, num_bytes in self.words:
+            self.word_fields.append([(field[0], field[3], (1 << field[4]) - 1, field[5]) for field in message['fields'] if (field[1], field[2]) == (first_byte, num_bytes)])
+        self.field_names = [field[0] for field in message['fields']]
+
+    def encode(self, **values):
+        words = []
+        for (first_byte, num_bytes), fields, as_bytes in zip(self.words, self.word_fields, self.words_as_bytes):
+            word = 0
+            for name, first_bit, mask, kind in fields:
+                value = values.get(name)
+                if kind in ['bytes', 'text']:
+                    word = value.encode() if kind == 'text' else bytes(value)
+                elif kind == 'setting':
+                    if value is not None:
+                        word |= (0b10 | bool(value)) << first_bit
+                elif kind == 'value':
+                    if value is not None:
+                        word |= ((int(value) & mask) | (mask + 1)) << first_bit
+                elif value:
+                    word |= (int(value) & mask) << first_bit
+            words.append(word.to_bytes(num_bytes, 'little') if as_bytes else word)
+        return self.packer.pack(self.identifier, *words)
+
+
+class MessageDecoder:
+    ''' Decodes a batch of one type of message at once with numpy. '''
+    def __init__(self, name, message):
+        self.name = name
+        self.identifier = message['identifier']
+        self.length = message['length']
+        self.words = words_of(message)
+        # Shifts to put each byte of a word in place, when adding up the bytes as uint64s
+        self.word_shifts = [np.arange(num_bytes, dtype=np.uint64)*np.uint64(8) for first_byte, num_bytes in self.words]
+        self.fields = []
+        for field in message['fields']:
+            name, first_byte, num_bytes, first_bit, num_bits, kind = field
+            word_idx = self.words.index((first_byte, num_bytes))
+            self.fields.append((name, word_idx, np.uint64(first_bit), np.uint64((1 << field_bits(field)) - 1), num_bits, kind))
+
+    def decode_columns(self, payloads):
+        ''' payloads is an (N, length) uint8 array of the bytes after the identifier. Returns a dict of the
+        fields, each a numpy array (or a list for bytes, text and binary fields) of N values. '''
+        payloads = np.asarray(payloads, dtype=np.uint8)
+        words = []
+        for (first_byte, num_bytes), shifts in zip(self.words, self.word_shifts):
+            # The bytes don't overlap, so adding them up is the same as or'ing them
+            words.append((payloads[:, first_byte:first_byte + num_bytes].astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64))
+        columns = {}
+        for name, word_idx, first_bit, mask, num_bits, kind in self.fields:
+            first_byte, num_bytes = self.words[word_idx]
+            if kind in ['bytes', 'text']:
+                values = [row.tobytes() for row in payloads[:, first_byte:first_byte + num_bytes]]
+                if kind == 'text':
+                    columns['unprintable_byte'] = np.zeros(len(values), dtype=bool)
+                    for row_idx, value in enumerate(values):
+                        try:
+                            values[row_idx] = value.decode()
+                        except UnicodeDecodeError:
+                            values[row_idx] = value.decode(errors='ignore')
+                            columns['unprintable_byte'][row_idx] = True
+                columns[name] = values
+                continue
+            values = (words[word_idx] >> first_bit) & mask
+            if kind == 'flag':
+                columns[name] = values.astype(bool)
+            elif kind == 'binary':
+                columns[name] = [''.join('{:08b} '.format((int(value) >> 8*byte_idx) & 0xFF) for byte_idx in range(num_bytes - 1, -1, -1)) for value in values]
+            elif kind in ['setting', 'value']:
+                # A setting is its value then the update bit. A value has the update bit after all its bits.
+                value_bits = 1 if kind == 'setting' else num_bits
+                update = ((values >> np.uint64(value_bits)) & np.uint64(1)).astype(bool)
+                value = values & np.uint64((1 << value_bits) - 1)
+                if kind == 'setting':
+                    value = value.astype(bool)
+                columns[name] = [(python_value(value_item) if update_item else None) for value_item, update_item in zip(value, update)]
+            else:
+                columns[name] = values.astype(np.int64)
+        return columns
+
+    def decode(self, message_bytes):
+        ''' Decodes a single message (the bytes after the identifier) as a dict. '''
+        payloads = np.frombuffer(bytes(message_bytes[:self.length]), dtype=np.uint8).reshape(1, self.length)
+        return next(message_rows(self.decode_columns(payloads)))
+
+
+def python_value(value):
+    # numpy bools and ints as the Python types, so decoded messages look the same as they did before the tables
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+def message_rows(columns):
+    ''' Yields each message of a batch decoded by decode_messages as a dict. '''
+    names = list(columns)
+    num_messages = len(columns[names[0]]) if names else 0
+    for message_idx in range(num_messages):
+        yield {name:python_value(columns[name][message_idx]) for name in names}
+
+def last_message(columns):
+    ''' The last message of a batch, as a dict. '''
+    return {name:python_value(values[-1]) for name, values in columns.items()}
+
+
+encoders_out = {name:MessageEncoder(name, message) for name, message in messages_out.items()}
+decoders_in = {name:MessageDecoder(name, message) for name, message in messages_in.items()}
+# The other way round, for simulating a device and for checking the tables
+encoders_in = {name:MessageEncoder(name, message) for name, message in messages_in.items()}
+decoders_out = {name:MessageDecoder(name, message) for name, message in messages_out.items()}
+
+decoders_in_by_identifier = {decoder.identifier:decoder for decoder in decoders_in.values()}
+identifiers_in = {name:message['identifier'] for name, message in messages_in.items()}
+identifiers_out = {name:message['identifier'] for name, message in messages_out.items()}
+
+
+def decode_messages(messages):
+    ''' Decodes the other_messages rows from quick_decode (identifier then payload, zero padded) a type at a time.
+    Returns {message name: columns} (see MessageDecoder.decode_columns), with the messages of each type in the
+    order they arrived. Rows with an identifier not in messages_in are left out. '''
+    messages = np.asarray(messages, dtype=np.uint8)
+    decoded = {}
+    if not len(messages):
+        return decoded
+    identifiers = set(messages[:, 0].tolist())
+    for identifier in identifiers:
+        decoder = decoders_in_by_identifier.get(identifier)
+        if decoder is None:
+            continue
+        rows = messages[:, 1:] if len(identifiers) == 1 else messages[messages[:, 0] == identifier, 1:]
+        if rows.shape[1] < decoder.length:
+            rows = np.concatenate((rows, np.zeros((len(rows), decoder.length - rows.shape[1]), dtype=np.uint8)), axis=1)
+        decoded[decoder.name] = decoder.decode_columns(rows[:, :decoder.length])
+    return decoded
+
+def decode_message(name, message_bytes):
+    ''' Decodes one incoming message (the bytes after the identifier) as a dict. '''
+    return decoders_in[name].decode(message_bytes)
+
+
+def encode_echo(byte_to_echo):
+    ''' Asks the device to send byte_to_echo back, along with its firmware version. '''
+    return encoders_out['echo'].encode(byte_to_echo=byte_to_echo)
+
+def encode_general_debug(message):
+    return encoders_out['general_input'].encode(message=message)
+
+@functools.lru_cache(maxsize=256)
+def encode_settings(enable_record=None, enable_send_record=None, holdoff_time=None, request_status=False, purge_memory=False, zero_pulse_timer=False, reset_device=False):
+    ''' Settings left as None are not changed. holdoff_time is in clock cycles.
+    The same few commands are sent over and over, so encoded commands are remembered. '''
+    return encoders_out['settings'].encode(enable_record=enable_record, enable_send_record=enable_send_record, holdoff_time=holdoff_time, request_status=request_status, purge_memory=purge_memory, zero_pulse_timer=zero_pulse_timer, reset_device=reset_device)
+
+
+def check_protocol(num_trials=2000, seed=0):
+    ''' Round trips random values through every message type in both directions, checks the tables agree with
+    the numba decoder's message lengths, and feeds random bytes through quick_decode and decode_messages. '''
+    import pulse_recorder_kernels as prKernels
+    rng = np.random.default_rng(seed)
+
+    def random_values(message):
+        values = {}
+        for field in message['fields']:
+            name, first_byte, num_bytes, first_bit, num_bits, kind = field
+            if kind == 'bytes':
+                values[name] = rng.bytes(num_bytes)
+            elif kind == 'text':
+                values[name] = ''.join(chr(letter) for letter in rng.integers(32, 127, num_bytes))
+            elif kind == 'flag':
+                values[name] = bool(rng.integers(2))
+            elif kind == 'setting':
+                values[name] = [None, False, True][rng.integers(3)]
+            elif kind == 'value':
+                values[name] = None if rng.integers(2) else int(rng.integers(1 << num_bits))
+            elif kind == 'binary':
+                values[name] = None
+            else:
+                values[name] = int(rng.integers(1 << min(num_bits, 62)))
+        return values
+
+    for encoders, decoders, table in [(encoders_out, decoders_out, messages_out), (encoders_in, decoders_in, messages_in)]:
+        for name, message in table.items():
+            assert encoders[name].packer.size == 1 + message['length'], name
+            for trial in range(num_trials):
+                values = random_values(message)
+                encoded = encoders[name].encode(**values)
+                assert encoded[0] == message['identifier']
+                decoded = decoders[name].decode(encoded[1:])
+                for field_name, value in values.items():
+                    if value is not None or message['fields'][[field[0] for field in message['fields']].index(field_name)][5] in ['setting', 'value']:
+                        assert decoded[field_name] == value, (name, field_name, value, decoded[field_name])
+                # and again, as part of a batch
+                batch = np.frombuffer(encoded, dtype=np.uint8).reshape(1, -1)
+                if table is messages_in:
+                    assert last_message(decode_messages(batch)[name]) == decoded
+
+    for name, message in messages_in.items():
+        assert prKernels.message_length(message['identifier']) == message['length'], name
+    assert encode_settings(holdoff_time=1 << 28) == encoders_out['settings'].encode(holdoff_time=0), 'holdoff_time should be masked to 28 bits'
+
+    # Random bytes, and valid messages with random bytes mixed in, must decode without errors. Every message
+    # quick_decode finds must decode to the same values in a batch as one at a time.
+    valid_messages = [encoders_in[name].encode(**random_values(message)) for name, message in messages_in.items() for repeat in range(20)]
+    for trial in range(200):
+        if trial % 2:
+            data = rng.bytes(int(rng.integers(1, 4000)))
+        else:
+            pieces = [valid_messages[idx] for idx in rng.integers(len(valid_messages), size=200)]
+            for idx in rng.integers(len(pieces), size=5):
+                pieces[idx] = rng.bytes(int(rng.integers(1, 4)))
+            data = b''.join(pieces)[:4000]
+        results = prKernels.quick_decode(np.array((), dtype=np.uint8), np.frombuffer(data, dtype=np.uint8).copy(), True, 3)
+        other_messages, other_messages_idx = results[2], results[3]
+        decoded = decode_messages(other_messages[:other_messages_idx])
+        for name, columns in decoded.items():
+            rows = other_messages[:other_messages_idx][other_messages[:other_messages_idx, 0] == identifiers_in[name]]
+            for row, batch_message in zip(rows, message_rows(columns)):
+                assert decode_message(name, bytes(row[1:])) == batch_message, name
+    return True
+
+
+###############################################################################
+#Make program run now...
+if __name__ == "__main__":
+    check_protocol()
+    print('Every message type round trips, and random bytes decode without errors.')
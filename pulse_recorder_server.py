@@ -0,0 +1,270 @@
+import asyncio
+import threading
+import collections
+import socket
+import struct
+import numpy as np
+import logging
+
+"""
+Serves the live records to other programs, over TCP or a Unix socket, so other machines in the lab can see the
+pulses as they are recorded.
+
+Each SerialThread hands its records to the RecordServer as they are decoded (see publish). They are packed into
+one uint64 per record (see pack_records) and sent in frames of:
+
+header:     14 bytes    '<BBIQ'     kind (1 for records), device index, number of records, records dropped so far
+records:    8 bytes per record      little endian uint64: time (52 bits) | ch0 << 52 | ch1 << 53 | ch2 << 54 | ch3 << 55
+
+A client gets every channel until it sends a byte, whose lowest 4 bits are the channels it wants (bit 0 for ch0 and
+so on). It can change that at any time. Only records with a pulse on one of those channels are sent to it.
+
+Each client has its own queue of at most max_blocks batches. If a client can't keep up, its oldest batches are
+thrown away (and counted, in the frame header), so a slow client never holds up recording or the other clients.
+
+RecordClient reads the frames, for example:
+with RecordClient(('pulse-pc', 5405), channel_mask=0b0011) as client:
+    for device, records_dropped, records in client:
+        ...
+"""
+
+logger = logging.getLogger(__name__)
+
+frame_header = struct.Struct('<BBIQ')
+frame_kind_records = 1
+channel_shift = 52
+all_channels = 0b1111
+
+
+def parse_address(text, default_host='0.0.0.0'):
+    ''' The address to serve on from text: 'host:port' or a port number for TCP, anything else a Unix socket path. '''
+    text = text.strip()
+    if text.isdigit():
+        return (default_host, int(text))
+    host, colon, port = text.rpartition(':')
+    if colon and port.isdigit():
+        return (host or default_host, int(port))
+    return text
+
+
+def pack_records(records, records_idx=None):
+    ''' Packs (N, 5) records (time, ch0, ch1, ch2, ch3) into a uint64 each: time | ch0 << 52 | ... | ch3 << 55. '''
+    records = records[:records_idx] if records_idx is not None else records
+    packed = records[:, 0].astype(np.uint64)
+    for channel in range(4):
+        packed |= records[:, channel + 1].astype(np.uint64) << np.uint64(channel_shift + channel)
+    return packed
+
+def unpack_records(packed):
+    ''' The opposite of pack_records. Returns an (N, 5) int64 array. '''
+    packed = np.asarray(packed, dtype=np.uint64)
+    records = np.empty((packed.size, 5), dtype=np.int64)
+    records[:, 0] = packed & np.uint64((1 << channel_shift) - 1)
+    for channel in range(4):
+        records[:, channel + 1] = (packed >> np.uint64(channel_shift + channel)) & np.uint64(1)
+    return records
+
+
+class ClientQueue:
+    ''' The batches waiting to be sent to one client, oldest first. Filled by the SerialThreads, emptied by the server. '''
+    def __init__(self, max_blocks):
+        self.blocks = collections.deque(maxlen=max_blocks)
+        self.lock = threading.Lock()
+        self.channel_mask = all_channels
+        self.records_dropped = 0
+        self.records_sent = 0
+        # Set (from the server's loop) while the client's sender is waiting for something to send
+        self.idle = False
+        self.wake = None
+
+    def put(self, device, packed):
+        with self.lock:
+            if len(self.blocks) == self.blocks.maxlen:
+                self.records_dropped += self.blocks[0][1].size
+            self.blocks.append((device, packed))
+
+    def take(self):
+        with self.lock:
+            return self.blocks.popleft() if self.blocks else None
+
+
+class RecordServer:
+    ''' Serves records on address, which is (host, port) for TCP or a path for a Unix socket.
+    The server runs an asyncio event loop in its own thread, started by start() and stopped by stop(). '''
+    def __init__(self, address, max_blocks=1000):
+        self.address = address
+        self.max_blocks = max_blocks
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self, timeout=5.0):
+        ''' Starts serving. Raises OSError if the address can't be listened on, or the server isn't listening
+        within timeout seconds. '''
+        started = threading.Event()
+        errors = []
+        self.thread = threading.Thread(target=self.run, args=(started, errors), name='RecordServer', daemon=True)
+        self.thread.start()
+        if not started.wait(timeout):
+            raise OSError('The server did not start listening on {} within {} s'.format(self.address, timeout))
+        if errors:
+            self.thread.join()
+            if isinstance(errors[0], OSError):
+                raise errors[0]
+            raise OSError(str(errors[0])) from errors[0]
+
+    def run(self, started, errors):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if isinstance(self.address, tuple):
+                self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_client, *self.address))
+            elif not hasattr(socket, 'AF_UNIX'):
+                raise OSError('Unix sockets are not available here. Use host:port, or just a port number.')
+            else:
+                self.server = self.loop.run_until_complete(asyncio.start_unix_server(self.handle_client, self.address))
+        except Exception as ex:
+            # Whatever goes wrong, start() is told rather than waiting out its timeout
+            errors.append(ex)
+            started.set()
+            self.loop.close()
+            return
+        logger.info('Serving records on %s', self.address)
+        started.set()
+        self.loop.run_forever()
+        # Disconnect the clients, then stop listening
+        self.server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def publish(self, records, records_idx, device=0):
+        ''' Queues a batch of records (as from quick_decode) for every client. Called from the SerialThreads. '''
+        if not self.clients or not records_idx:
+            return
+        packed = pack_records(records, records_idx)
+        with self.clients_lock:
+            client_queues = list(self.clients.values())
+        for client_queue in client_queues:
+            client_queue.put(device, packed)
+            if client_queue.idle:
+                client_queue.idle = False
+                self.loop.call_soon_threadsafe(client_queue.wake.set)
+
+    def client_stats(self):
+        ''' A list of {'peer', 'channel_mask', 'records_sent', 'records_dropped'} for each client. '''
+        with self.clients_lock:
+            items = list(self.clients.items())
+        return [{'peer':peer, 'channel_mask':client_queue.channel_mask, 'records_sent':client_queue.records_sent, 'records_dropped':client_queue.records_dropped} for peer, client_queue in items]
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername') or writer.get_extra_info('sockname')
+        peer = '{}:{}'.format(*peer[:2]) if isinstance(peer, tuple) else '{} ({})'.format(peer, id(writer))
+        client_queue = ClientQueue(self.max_blocks)
+        client_queue.wake = asyncio.Event()
+        with self.clients_lock:
+            self.clients[peer] = client_queue
+        logger.info('Record client %s connected', peer)
+        subscriptions = asyncio.ensure_future(self.read_subscriptions(reader, client_queue))
+        try:
+            while not subscriptions.done():
+                block = client_queue.take()
+                if block is None:
+                    client_queue.wake.clear()
+                    client_queue.idle = True
+                    # Checked again, in case a batch came in before idle was set
+                    block = client_queue.take()
+                    if block is None:
+                        woken = asyncio.ensure_future(client_queue.wake.wait())
+                        await asyncio.wait([subscriptions, woken], return_when=asyncio.FIRST_COMPLETED)
+                        woken.cancel()
+                        continue
+                    client_queue.idle = False
+                device, packed = block
+                if client_queue.channel_mask != all_channels:
+                    packed = packed[(packed >> np.uint64(channel_shift)) & np.uint64(client_queue.channel_mask) != 0]
+                    if not packed.size:
+                        continue
+                writer.write(frame_header.pack(frame_kind_records, device, packed.size, client_queue.records_dropped))
+                writer.write(packed.astype('<u8', copy=False).tobytes())
+                client_queue.records_sent += packed.size
+                await writer.drain()
+        except (ConnectionError, OSError) as ex:
+            logger.info('Record client %s: %s', peer, ex)
+        except asyncio.CancelledError:
+            # The server is stopping
+            pass
+        finally:
+            subscriptions.cancel()
+            with self.clients_lock:
+                del self.clients[peer]
+            writer.close()
+            logger.info('Record client %s disconnected after %d records (%d dropped)', peer, client_queue.records_sent, client_queue.records_dropped)
+
+    async def read_subscriptions(self, reader, client_queue):
+        # Returns when the client disconnects
+        while True:
+            data = await reader.read(64)
+            if not data:
+                return
+            client_queue.channel_mask = data[-1] & all_channels
+
+
+class RecordClient:
+    ''' Connects to a RecordServer at address ((host, port) or a Unix socket path) and reads its frames.
+    Iterating over it gives (device, records_dropped, records), with records as unpacked (N, 5) arrays
+    (or packed uint64 arrays if unpack is False). '''
+    def __init__(self, address, channel_mask=all_channels, unpack=True, timeout=None):
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address, timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        self.unpack = unpack
+        self.subscribe(channel_mask)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def subscribe(self, channel_mask):
+        self.sock.sendall(bytes([channel_mask & all_channels]))
+
+    def close(self):
+        self.sock.close()
+
+    def read_exactly(self, num_bytes):
+        data = bytearray(num_bytes)
+        view = memoryview(data)
+        received = 0
+        while received < num_bytes:
+            chunk_size = self.sock.recv_into(view[received:])
+            if not chunk_size:
+                raise ConnectionError('The server closed the connection')
+            received += chunk_size
+        return data
+
+    def read_frame(self):
+        kind, device, num_records, records_dropped = frame_header.unpack(self.read_exactly(frame_header.size))
+        packed = np.frombuffer(self.read_exactly(num_records*8), dtype='<u8')
+        return device, records_dropped, unpack_records(packed) if self.unpack else packed
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.read_frame()
+        except ConnectionError:
+            return
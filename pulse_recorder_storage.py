@@ -0,0 +1,589 @@
+import numpy as np
+import pathlib
+import json
+import time
+import os
+import re
+
+import pulse_recorder_metrics as prMetrics
+
+# h5py is imported in the functions that use it, so the program doesn't wait for it at startup
+
+
+# Bin widths of the count-rate summary pyramid, in 5ns device clock cycles.
+rate_pyramid_levels = {
+    '1ms':200000,
+    '100ms':20000000,
+    '10s':2000000000,
+    '1000s':200000000000}
+
+record_types = [('time', np.int64), ('ch0', np.uint8), ('ch1', np.uint8), ('ch2', np.uint8), ('ch3', np.uint8)]
+
+# Things that happened during acquisition. record_index is the row of 'records' the event happened before.
+event_types = [('host_time', np.float64), ('record_index', np.int64), ('kind', 'S16'), ('value', np.float64)]
+
+# Records merged from several devices. 'device' is the index of the device in the list of sources.
+merged_record_types = record_types + [('device', np.uint8)]
+
+rate_summary_types = [('time', np.int64), ('counts', np.int64), ('ch0', np.int64), ('ch1', np.int64), ('ch2', np.int64), ('ch3', np.int64)]
+
+
+class RatePyramid:
+    ''' Per-channel count histograms at several time resolutions, kept next to the 'records' dataset.
+
+    Each level is a dataset in the 'rate_pyramid' group holding one row per non-empty bin. 'time' is the
+    start of the bin in clock cycles, 'counts' is the number of records in the bin and 'ch0'-'ch3' are the
+    number of records with that channel tag set. Empty bins are not stored. Bins are counted from every
+    record received, before the retention interval filter is applied.
+    If a file is appended to after the pulse timer has been zeroed, the same bin time can appear in more
+    than one row, so readers should sum rows with equal times.
+    '''
+    def __init__(self, hdf_file, group_name='rate_pyramid', levels=rate_pyramid_levels):
+        self.group = hdf_file.require_group(group_name)
+        self.levels = levels
+        self.dsets = {}
+        self.open_bins = {}
+        self.pending = {}
+        for level_name, bin_ticks in self.levels.items():
+            if level_name in self.group:
+                dset = self.group[level_name]
+            else:
+                dset = self.group.create_dataset(level_name, shape=(0,), dtype=rate_summary_types, maxshape=(None,), chunks=True)
+                dset.attrs['bin_ticks'] = bin_ticks
+            self.dsets[level_name] = dset
+            self.open_bins[level_name] = None
+            self.pending[level_name] = []
+
+    def add_records(self, records, records_idx):
+        ''' Adds a batch of decoded records (as returned by quick_decode) to every level.
+        The work done is a fixed number of vectorised operations per level, whatever the batch size.
+        Only the last bin of each level is kept open, because the next batch may add to it.'''
+        if not records_idx:
+            return
+        times = records[:records_idx, 0]
+        tags = records[:records_idx, 1:5]
+        for level_name, bin_ticks in self.levels.items():
+            bins = times // bin_ticks
+            segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+            rows = np.empty(segment_starts.size, dtype=rate_summary_types)
+            rows['time'] = bins[segment_starts]*bin_ticks
+            rows['counts'] = np.diff(np.append(segment_starts, records_idx))
+            channel_counts = np.add.reduceat(tags, segment_starts, axis=0)
+            for channel in range(4):
+                rows['ch{}'.format(channel)] = channel_counts[:, channel]
+
+            open_bin = self.open_bins[level_name]
+            if open_bin is not None:
+                if open_bin['time'] == rows[0]['time']:
+                    for field in rows.dtype.names[1:]:
+                        rows[field][0] += open_bin[field]
+                else:
+                    self.pending[level_name].append(np.array([open_bin], dtype=rate_summary_types))
+            if rows.size > 1:
+                self.pending[level_name].append(rows[:-1])
+            self.open_bins[level_name] = rows[-1].copy()
+
+    def flush(self):
+        ''' Appends all completed bins to their datasets. '''
+        for level_name, dset in self.dsets.items():
+            if self.pending[level_name]:
+                new_rows = np.concatenate(self.pending[level_name])
+                num_current_entries = dset.size
+                dset.resize(num_current_entries + new_rows.size, axis=0)
+                dset[num_current_entries:] = new_rows
+                self.pending[level_name] = []
+
+    def close(self):
+        ''' Writes out the open bins as well. Call this before the hdf file is closed. '''
+        for level_name, open_bin in self.open_bins.items():
+            if open_bin is not None:
+                self.pending[level_name].append(np.array([open_bin], dtype=rate_summary_types))
+                self.open_bins[level_name] = None
+        self.flush()
+
+
+def read_rate_history(hdf_file, level_name='10s', group_name='rate_pyramid'):
+    ''' Returns the bin start times (s), a structured array of counts and the bin width (s) for one level of
+    the pyramid. Rows with the same bin time are summed, and the result is sorted by time.'''
+    dset = hdf_file[group_name][level_name]
+    rows = dset[...]
+    bin_times, inverse = np.unique(rows['time'], return_inverse=True)
+    summed = np.zeros(bin_times.size, dtype=rate_summary_types)
+    summed['time'] = bin_times
+    for field in rows.dtype.names[1:]:
+        np.add.at(summed[field], inverse, rows[field])
+    return bin_times*5E-9, summed, dset.attrs['bin_ticks']*5E-9
+
+
+class RotationPolicy:
+    ''' When the RecordWriter rolls over to a new segment file. Limits left as None are not checked.
+    max_bytes is compared against the size of the saved records, not the size of the file on disk.'''
+    def __init__(self, max_bytes=None, max_records=None, max_seconds=None):
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+
+    def records_allowed(self, num_entries):
+        ''' Returns how many more records fit in a segment holding num_entries, or None if there is no limit. '''
+        limits = []
+        if self.max_records is not None:
+            limits.append(int(self.max_records))
+        if self.max_bytes is not None:
+            limits.append(int(self.max_bytes) // np.dtype(record_types).itemsize)
+        if not limits:
+            return None
+        return max(min(limits) - num_entries, 0)
+
+    def segment_expired(self, opened_at):
+        return self.max_seconds is not None and time.time() - opened_at >= self.max_seconds
+
+
+class FlushPolicy:
+    ''' When the RecordWriter writes its staged records to the file. A flush happens as soon as any limit
+    that is not None is reached. Larger limits mean fewer, bigger writes at the cost of more data waiting
+    in memory. With fsync the file is also synced to disk after each flush, which is slow but means a
+    power cut can't lose data that has already been flushed.'''
+    def __init__(self, max_bytes=None, max_records=10000, max_seconds=0.5, fsync=False):
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.fsync = fsync
+
+    def staged_records_limit(self):
+        limits = []
+        if self.max_records is not None:
+            limits.append(int(self.max_records))
+        if self.max_bytes is not None:
+            limits.append(int(self.max_bytes) // np.dtype(record_types).itemsize)
+        if not limits:
+            return None
+        return max(min(limits), 1)
+
+    def flush_due(self, num_staged, last_flush):
+        if not num_staged:
+            return False
+        staged_records_limit = self.staged_records_limit()
+        if staged_records_limit is not None and num_staged >= staged_records_limit:
+            return True
+        return self.max_seconds is not None and time.time() - last_flush >= self.max_seconds
+
+
+def segment_path(file_directory, segment_idx):
+    file_directory = pathlib.Path(file_directory)
+    return file_directory.with_name('{}_{:04d}{}'.format(file_directory.stem, segment_idx, file_directory.suffix))
+
+def manifest_path(file_directory):
+    file_directory = pathlib.Path(file_directory)
+    return file_directory.with_name(file_directory.stem + '_manifest.json')
+
+def read_manifest(path):
+    with open(str(path), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def select_segments(path, start_tick=None, end_tick=None):
+    ''' Returns the paths of the segment files listed in the manifest at path whose records overlap the
+    range [start_tick, end_tick]. Empty segments are skipped. '''
+    path = pathlib.Path(path)
+    selected = []
+    for segment in read_manifest(path)['segments']:
+        if not segment['rows']:
+            continue
+        if start_tick is not None and max(segment['start_tick'], segment['end_tick']) < start_tick:
+            continue
+        if end_tick is not None and min(segment['start_tick'], segment['end_tick']) > end_tick:
+            continue
+        selected.append(path.with_name(segment['file']))
+    return selected
+
+
+class RecordWriter:
+    ''' Appends records to the 'records' and 'total_entries' datasets of an hdf file, along with the rate pyramid.
+
+    Records are staged in memory and written out when the FlushPolicy says so. The number of entries is
+    tracked in memory, so 'total_entries' is only written once per flush. The records dataset grows
+    geometrically (by growth_factor, but at least blocksize records), and with trim_on_close the unused
+    space at the end is removed when the file is closed.
+
+    With group_name the datasets are put in that group rather than at the top of the file. Several writers
+    (one per device) can share a file this way.
+
+    Without a rotation policy everything is appended to file_directory, as it always has been.
+    With a RotationPolicy the records are split into segment files named <stem>_0000.hdf, <stem>_0001.hdf, ...
+    next to file_directory, and a <stem>_manifest.json file lists each segment with its row count and the
+    times (in clock cycles) of its first and last record. A flush that crosses a segment boundary is split,
+    so no record is lost or written twice. Reusing a file_directory that already has a manifest adds new
+    segments after the ones already listed in it. When rotating, the rate pyramid records and the events are
+    held back until the records they go with are written, so each segment's pyramid and event record_index
+    values match the records in that segment.
+    '''
+    def __init__(self, file_directory, blocksize=10000, rotation_policy=None, flush_policy=None, growth_factor=2.0, trim_on_close=True, metrics=None, group_name=None, attrs=None):
+        self.file_directory = pathlib.Path(file_directory)
+        self.group_name = group_name
+        # Attributes written to the group (or file) the records are in, like the device serial number
+        self.attrs = attrs if attrs is not None else {}
+        self.metrics = metrics if metrics is not None else prMetrics.HotPathMetrics()
+        self.blocksize = blocksize
+        self.rotation_policy = rotation_policy
+        self.flush_policy = flush_policy if flush_policy is not None else FlushPolicy()
+        self.growth_factor = growth_factor
+        self.trim_on_close = trim_on_close
+        self.dset_records_name = 'records'
+        self.dset_num_entries_name = 'total_entries'
+        self.hdf_file = None
+        self.rate_pyramid = None
+        self.dset_raw = None
+        self.segments = []
+        self.saved_counts = 0
+        self.num_flushes = 0
+        self.num_resizes = 0
+        staged_records_limit = self.flush_policy.staged_records_limit()
+        self.temp_data = np.empty(staged_records_limit if staged_records_limit is not None else blocksize, dtype=record_types)
+        self.temp_data_idx = 0
+        # With a rotation policy, the records for the rate pyramid wait here until the saved records they came
+        # with are written, so they go in the same segment (see add_pending_to_rate_pyramid)
+        self.pending_pyramid = []
+        self.last_flush = time.time()
+        if self.rotation_policy is not None:
+            self.manifest_path = manifest_path(self.file_directory)
+            if self.manifest_path.is_file():
+                self.segments = read_manifest(self.manifest_path)['segments']
+                self.saved_counts = sum(segment['rows'] for segment in self.segments)
+        self.open_segment()
+
+    def open_segment(self):
+        if self.rotation_policy is None:
+            path = self.file_directory
+        else:
+            path = segment_path(self.file_directory, len(self.segments))
+        import h5py
+        self.hdf_file = h5py.File(str(path), 'a')
+        # Everything goes in group_name if there is one (one group per device when recording from several)
+        self.root = self.hdf_file if self.group_name is None else self.hdf_file.require_group(self.group_name)
+        if self.dset_records_name in self.root:
+            self.dset_records = self.root[self.dset_records_name]
+            self.dset_num_entries = self.root[self.dset_num_entries_name]
+        else:
+            self.dset_records = self.root.create_dataset(self.dset_records_name, shape=(self.blocksize,), dtype=record_types, maxshape=(None,), chunks=True)
+            self.dset_num_entries = self.root.create_dataset(self.dset_num_entries_name, shape=(1,), dtype=np.int64)
+        for name, value in self.attrs.items():
+            self.root.attrs[name] = value
+        self.rate_pyramid = RatePyramid(self.root)
+        self.segment_opened = time.time()
+        # The only time the entry count is read back from the file
+        self.num_entries = int(self.dset_num_entries[0])
+        self.segment = {'file':path.name, 'rows':self.num_entries, 'start_tick':None, 'end_tick':None}
+        if self.rotation_policy is None:
+            self.saved_counts = self.num_entries
+        else:
+            self.segments.append(self.segment)
+            self.write_manifest()
+
+    def close_segment(self):
+        self.rate_pyramid.close()
+        self.rate_pyramid = None
+        self.dset_num_entries[0] = self.num_entries
+        if self.trim_on_close and self.dset_records.size > self.num_entries:
+            self.dset_records.resize(self.num_entries, axis=0)
+        if self.dset_raw is not None:
+            self.dset_raw.attrs['num_bytes'] = self.raw_entries
+            if self.trim_on_close and self.dset_raw.size > self.raw_entries:
+                self.dset_raw.resize(self.raw_entries, axis=0)
+            self.dset_raw = None
+        self.hdf_file.close()
+        self.hdf_file = None
+
+    def rotate(self):
+        self.close_segment()
+        self.open_segment()
+
+    def segment_full(self):
+        if self.rotation_policy is None or not self.segment['rows']:
+            return False
+        return self.rotation_policy.records_allowed(self.segment['rows']) == 0 or self.rotation_policy.segment_expired(self.segment_opened)
+
+    def append(self, records, records_idx):
+        ''' Stages the first records_idx rows of a decoded records array (time, ch0, ch1, ch2, ch3). '''
+        if self.temp_data_idx + records_idx > self.temp_data.size:
+            self.flush()
+            if records_idx > self.temp_data.size:
+                self.temp_data = np.empty(records_idx, dtype=record_types)
+        self.temp_data['time'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 0]
+        self.temp_data['ch0'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 1]
+        self.temp_data['ch1'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 2]
+        self.temp_data['ch2'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 3]
+        self.temp_data['ch3'][self.temp_data_idx:self.temp_data_idx+records_idx] = records[:records_idx, 4]
+        self.temp_data_idx += records_idx
+
+    def add_records(self, new_data, num_new_entries):
+        ''' Writes the first num_new_entries of the structured array new_data, rolling over to new segments as needed. '''
+        start = 0
+        while start < num_new_entries:
+            if self.segment_full():
+                self.rotate()
+            end = num_new_entries
+            if self.rotation_policy is not None:
+                records_allowed = self.rotation_policy.records_allowed(self.segment['rows'])
+                if records_allowed is not None:
+                    end = min(end, start + max(records_allowed, 1))
+            self.add_data_to_dataset(new_data[start:end], end - start)
+            self.add_pending_to_rate_pyramid(new_data['time'][end - 1])
+            start = end
+
+    def add_to_rate_pyramid(self, records, records_idx):
+        ''' Adds a batch of records, before the retention filter, to the rate pyramid. With a rotation policy
+        they are added once the saved records they came with are written (see add_pending_to_rate_pyramid). '''
+        if self.rotation_policy is None:
+            self.rate_pyramid.add_records(records, records_idx)
+        elif records_idx:
+            self.pending_pyramid.append(records[:records_idx].copy())
+
+    def add_pending_to_rate_pyramid(self, last_time=None):
+        # The saved records are a subset of the ones given to the pyramid, in the same order. So the pending
+        # records up to the one with the time of the last record written go in the segment it was written to.
+        # With last_time None (when closing) they all go in the current segment.
+        if not self.pending_pyramid:
+            return
+        pending = self.pending_pyramid[0] if len(self.pending_pyramid) == 1 else np.concatenate(self.pending_pyramid)
+        if last_time is None:
+            num_added = len(pending)
+        else:
+            matches = np.flatnonzero(pending[:, 0] == last_time)
+            if not matches.size:
+                # Records written without going through add_to_rate_pyramid
+                return
+            num_added = matches[0] + 1
+        self.rate_pyramid.add_records(pending, num_added)
+        self.pending_pyramid = [pending[num_added:]] if num_added < len(pending) else []
+
+    def add_data_to_dataset(self, new_data, num_new_entries):
+        with self.metrics.timers['add_data_to_dataset']:
+            free_space = self.dset_records.size - self.num_entries
+            if num_new_entries > free_space:
+                new_size = max(int(self.dset_records.size*self.growth_factor), self.dset_records.size + self.blocksize, self.num_entries + num_new_entries)
+                self.dset_records.resize(new_size, axis=0)
+                self.num_resizes += 1
+            new_total_entries = self.num_entries + num_new_entries
+            self.dset_records[self.num_entries:new_total_entries] = new_data[:num_new_entries]
+            self.num_entries = new_total_entries
+            if self.segment['start_tick'] is None:
+                self.segment['start_tick'] = int(new_data['time'][0])
+            self.segment['end_tick'] = int(new_data['time'][num_new_entries-1])
+            self.segment['rows'] = new_total_entries
+            self.saved_counts += num_new_entries
+
+    def add_event(self, kind, value=0.0):
+        ''' Records an event, like a reconnect, in the 'events' dataset of the current segment. Events are
+        rare, so each one is written straight away. With a rotation policy the staged records are written
+        first, and a full segment rotated, so the event goes in the segment of the record it comes before.'''
+        if self.rotation_policy is not None:
+            self.write_staged()
+            if self.segment_full():
+                self.rotate()
+        if 'events' in self.root:
+            dset_events = self.root['events']
+        else:
+            dset_events = self.root.create_dataset('events', shape=(0,), dtype=event_types, maxshape=(None,), chunks=True)
+        event = np.array([(time.time(), self.num_entries + self.temp_data_idx, kind, value)], dtype=event_types)
+        dset_events.resize(dset_events.size + 1, axis=0)
+        dset_events[-1:] = event
+
+    def add_raw(self, data):
+        ''' Appends undecoded bytes to the 'raw_capture' dataset of the current segment. Its 'num_bytes'
+        attribute says how much of the dataset is used. '''
+        self.require_raw_dataset()
+        num_new_bytes = len(data)
+        if self.raw_entries + num_new_bytes > self.dset_raw.size:
+            self.dset_raw.resize(max(int(self.dset_raw.size*self.growth_factor), self.raw_entries + num_new_bytes, 65536), axis=0)
+        self.dset_raw[self.raw_entries:self.raw_entries + num_new_bytes] = np.frombuffer(data, dtype=np.uint8)
+        self.raw_entries += num_new_bytes
+
+    def require_raw_dataset(self):
+        if self.dset_raw is None:
+            if 'raw_capture' in self.root:
+                self.dset_raw = self.root['raw_capture']
+                self.raw_entries = int(self.dset_raw.attrs.get('num_bytes', self.dset_raw.size))
+            else:
+                self.dset_raw = self.root.create_dataset('raw_capture', shape=(0,), dtype=np.uint8, maxshape=(None,), chunks=(65536,))
+                self.raw_entries = 0
+
+    def raw_position(self):
+        ''' The offset in 'raw_capture' the next raw bytes will be written to. '''
+        self.require_raw_dataset()
+        return self.raw_entries
+
+    def write_staged(self):
+        if self.temp_data_idx:
+            self.add_records(self.temp_data, self.temp_data_idx)
+            self.temp_data_idx = 0
+
+    def flush_if_due(self):
+        ''' Flushes if the flush policy says so. Returns True if it did. '''
+        if self.flush_policy.flush_due(self.temp_data_idx, self.last_flush):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        with self.metrics.timers['flush']:
+            self.write_staged()
+            self.dset_num_entries[0] = self.num_entries
+            if self.dset_raw is not None:
+                self.dset_raw.attrs['num_bytes'] = self.raw_entries
+            self.rate_pyramid.flush()
+            self.hdf_file.flush()
+            if self.flush_policy.fsync:
+                os.fsync(self.hdf_file.id.get_vfd_handle())
+            if self.rotation_policy is not None:
+                self.write_manifest()
+            self.last_flush = time.time()
+            self.num_flushes += 1
+
+    def close(self):
+        if self.hdf_file:
+            self.write_staged()
+            self.add_pending_to_rate_pyramid()
+            self.close_segment()
+            if self.rotation_policy is not None:
+                self.write_manifest()
+
+    def write_manifest(self):
+        # Write to a temporary file first, so readers never see a half written manifest
+        temp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        with open(str(temp_path), 'w') as manifest_file:
+            json.dump({'records_name':self.dset_records_name, 'segments':self.segments}, manifest_file, indent=1)
+        os.replace(str(temp_path), str(self.manifest_path))
+
+
+def device_record_location(path, serial_number, layout=None, rotation_policy=None):
+    ''' Where a device's records go when recording from several devices. Returns (path, group_name).
+    layout 'groups' puts each device in a 'device_<serial number>' group of path, 'files' in its own file
+    <stem>_device_<serial number>.hdf next to path. Segment rotation is done by each device on its own, so
+    it always uses separate files. With no layout the records go at the top of path, as for a single device.'''
+    path = pathlib.Path(path)
+    if layout is None:
+        return path, None
+    name = 'device_{}'.format(serial_number)
+    if layout == 'files' or rotation_policy is not None:
+        return path.with_name('{}_{}{}'.format(path.stem, name, path.suffix)), None
+    return path, name
+
+def find_device_sources(path):
+    ''' Finds the devices recorded to path with either layout of device_record_location. Returns a list of
+    dicts with the 'name' ('device_<serial number>'), 'path' and 'group_name' (None for separate files) of each.'''
+    import h5py
+    path = pathlib.Path(path)
+    sources = []
+    if path.is_file():
+        with h5py.File(str(path), 'r') as hdf_file:
+            for name in sorted(hdf_file):
+                if name.startswith('device_') and isinstance(hdf_file[name], h5py.Group):
+                    sources.append({'name':name, 'path':path, 'group_name':name})
+    # Separate files, or the manifests of rotated ones
+    file_pattern = re.compile(re.escape(path.stem) + r'_(device_[^_]+)(?:' + re.escape(path.suffix) + r'|_manifest\.json)$')
+    names = [source['name'] for source in sources]
+    for other_path in sorted(path.parent.glob(path.stem + '_device_*')):
+        match = file_pattern.match(other_path.name)
+        if match and match.group(1) not in names:
+            names.append(match.group(1))
+            sources.append({'name':match.group(1), 'path':path.with_name('{}_{}{}'.format(path.stem, match.group(1), path.suffix)), 'group_name':None})
+    return sources
+
+def source_files(source):
+    ''' The files holding a source's records in order: its segments if it was rotated, otherwise just its path. '''
+    source_manifest_path = manifest_path(source['path'])
+    if source_manifest_path.is_file():
+        return [source_manifest_path.with_name(segment['file']) for segment in read_manifest(source_manifest_path)['segments'] if segment['rows']]
+    return [pathlib.Path(source['path'])]
+
+def iter_source_records(source, chunk_size=1000000):
+    ''' Yields a source's records in chunks of at most chunk_size rows, so they are never all in memory. '''
+    import h5py
+    for file_path in source_files(source):
+        with h5py.File(str(file_path), 'r') as hdf_file:
+            root = hdf_file if source['group_name'] is None else hdf_file[source['group_name']]
+            total_entries = int(root['total_entries'][0])
+            dset_records = root['records']
+            for chunk_start in range(0, total_entries, chunk_size):
+                yield dset_records[chunk_start:min(chunk_start + chunk_size, total_entries)]
+
+def read_source_events(source):
+    import h5py
+    events = [np.zeros(0, dtype=event_types)]
+    for file_path in source_files(source):
+        with h5py.File(str(file_path), 'r') as hdf_file:
+            root = hdf_file if source['group_name'] is None else hdf_file[source['group_name']]
+            if 'events' in root:
+                events.append(root['events'][...])
+    return np.concatenate(events)
+
+def zero_timer_offsets(sources):
+    ''' Clock offsets (in clock cycles, to add to each source's times) from the host time the timer was
+    zeroed, which is the value of the last 'zero_timer' event of each source. A device zeroed later than the others counts from a later time, so
+    its offset is positive. Sources without a 'zero_timer' event get an offset of 0.'''
+    zero_times = {}
+    for source in sources:
+        events = read_source_events(source)
+        zero_events = events[events['kind'] == b'zero_timer']
+        if zero_events.size:
+            zero_times[source['name']] = zero_events['value'][-1]
+    reference = min(zero_times.values()) if zero_times else 0
+    return {source['name']:int(round((zero_times[source['name']] - reference)/5E-9)) if source['name'] in zero_times else 0 for source in sources}
+
+def iter_merged_records(sources, offsets=None, chunk_size=1000000):
+    ''' Streaming k-way merge of the records of several devices into one time ordered sequence of chunks
+    with merged_record_types. offsets maps source names to clock offsets in clock cycles (see
+    zero_timer_offsets). Each source must be in time order, which it is unless its timer was zeroed while
+    recording. Records with equal times keep the order of the sources.
+
+    Only records up to the earliest last time buffered from any source are output, because any source could
+    still have earlier records after that. So at most about chunk_size records per source are held in memory.'''
+    offsets = offsets if offsets is not None else {}
+    iterators = [iter_source_records(source, chunk_size) for source in sources]
+    buffers = [np.zeros(0, dtype=merged_record_types) for source in sources]
+    exhausted = [False for source in sources]
+    while True:
+        for device_idx, source in enumerate(sources):
+            while not exhausted[device_idx] and not buffers[device_idx].size:
+                chunk = next(iterators[device_idx], None)
+                if chunk is None:
+                    exhausted[device_idx] = True
+                    break
+                buffer = np.zeros(chunk.size, dtype=merged_record_types)
+                for field, _ in record_types:
+                    buffer[field] = chunk[field]
+                buffer['time'] += offsets.get(source['name'], 0)
+                buffer['device'] = device_idx
+                buffers[device_idx] = buffer
+        active = [buffer for buffer, done in zip(buffers, exhausted) if not done]
+        if not any(buffer.size for buffer in buffers):
+            return
+        safe_time = min(buffer['time'][-1] for buffer in active) if active else np.iinfo(np.int64).max
+        ready = []
+        for device_idx, buffer in enumerate(buffers):
+            num_ready = np.searchsorted(buffer['time'], safe_time, side='right')
+            ready.append(buffer[:num_ready])
+            buffers[device_idx] = buffer[num_ready:]
+        merged = np.concatenate(ready)
+        # A stable sort keeps equal times in source order, since the sources were concatenated in order
+        yield merged[np.argsort(merged['time'], kind='stable')]
+
+def merge_device_records(path, merged_path, offsets=None, chunk_size=1000000):
+    ''' Merges the records of every device recorded to path (see find_device_sources) into the 'records'
+    and 'total_entries' datasets of merged_path, with a 'device' field giving the index of each record's
+    device in the 'devices' attribute. offsets defaults to the offsets from zeroing the devices' timers
+    together. Returns the number of records written.'''
+    import h5py
+    sources = find_device_sources(path)
+    if offsets is None:
+        offsets = zero_timer_offsets(sources)
+    with h5py.File(str(merged_path), 'w') as merged_file:
+        dset_records = merged_file.create_dataset('records', shape=(0,), dtype=merged_record_types, maxshape=(None,), chunks=True)
+        num_entries = 0
+        for merged in iter_merged_records(sources, offsets, chunk_size):
+            dset_records.resize(num_entries + merged.size, axis=0)
+            dset_records[num_entries:] = merged
+            num_entries += merged.size
+        merged_file.create_dataset('total_entries', data=np.array([num_entries], dtype=np.int64))
+        merged_file.attrs['devices'] = json.dumps([source['name'] for source in sources])
+        merged_file.attrs['offsets'] = json.dumps([offsets.get(source['name'], 0) for source in sources])
+    return num_entries